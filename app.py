@@ -3,10 +3,53 @@
 
 import gradio as gr
 import plotly.graph_objects as go
+import plotly.io as pio
 from plotly.subplots import make_subplots
 import numpy as np
-from dataclasses import dataclass
-from typing import Dict, List
+import pandas as pd
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+import argparse
+import asyncio
+import atexit
+import hashlib
+import html
+import inspect
+import json
+import math
+import os
+import queue
+import re
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import asynccontextmanager
+from multiprocessing import get_context, resource_tracker, shared_memory
+from dataclasses import dataclass, fields
+from functools import cached_property, lru_cache
+from types import MappingProxyType
+from typing import Callable, Dict, List, Mapping
+
+try:
+    import brotli  # Необязательно: без него отдается gzip
+except ImportError:
+    brotli = None
+
+try:
+    import kaleido  # noqa: F401  Необязательно: без него отчеты только в HTML
+except ImportError:
+    kaleido = None
 
 # =========================
 # WORLD-CLASS DESIGN SYSTEM (Оптимизирован)
@@ -479,6 +522,34 @@ WORLD_CLASS_CSS = """
     margin-top: var(--space-4);
 }
 
+/* What-if bars (рисуются в браузере) */
+.whatif-row {
+    display: grid;
+    grid-template-columns: 10rem 1fr 12rem;
+    align-items: center;
+    gap: var(--space-3);
+    margin-bottom: var(--space-2);
+}
+
+.whatif-track {
+    background: var(--neutral-100);
+    border-radius: var(--radius-xl);
+    height: 1.25rem;
+    overflow: hidden;
+}
+
+.whatif-bar {
+    background: var(--primary);
+    height: 100%;
+    transition: width 80ms linear;
+}
+
+.whatif-value {
+    font-size: var(--font-size-sm);
+    color: var(--neutral-500);
+    font-variant-numeric: tabular-nums;
+}
+
 /* Footer */
 .footer {
     text-align: center;
@@ -539,11 +610,173 @@ WORLD_CLASS_CSS = """
 }
 """
 
+# =========================
+# STATIC STYLESHEET DELIVERY (Кэшируемый CSS-файл)
+# =========================
+
+STYLESHEET_ROUTE = "/visatier-static"
+
+
+def minify_css(css: str) -> str:
+    """Удаление комментариев и лишних пробелов"""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{}:;,>])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+STYLESHEET = minify_css(WORLD_CLASS_CSS).encode("utf-8")
+STYLESHEET_HASH = hashlib.sha256(STYLESHEET).hexdigest()[:12]
+STYLESHEET_URL = f"{STYLESHEET_ROUTE}/visatier.{STYLESHEET_HASH}.css"
+
+# Gradio 4 принимает оформление страницы в Blocks, Gradio 5+ - при запуске/монтировании
+PAGE_OPTIONS_IN_BLOCKS = "head" in inspect.signature(gr.Blocks.__init__).parameters
+
+
+def page_options() -> Dict:
+    return {
+        "theme": gr.themes.Soft(),
+        "head": f'<link rel="stylesheet" href="{STYLESHEET_URL}">',
+    }
+
+
+def serve_stylesheet(filename: str, request: Request) -> Response:
+    """CSS с контентным хэшем в имени: неизменяемый кэш на год + ETag"""
+    if not (filename.startswith("visatier.") and filename.endswith(".css")):
+        return Response(status_code=404)
+    etag = f'"{STYLESHEET_HASH}"'
+    if filename == f"visatier.{STYLESHEET_HASH}.css":
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        # Страница от предыдущего релиза: отдаем актуальный CSS, но без долгого кэша
+        cache_control = "no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(STYLESHEET, media_type="text/css; charset=utf-8", headers=headers)
+
+# =========================
+# STRUCTURED EVENT LOG (Журнал событий JSON Lines с фоновой записью)
+# =========================
+
+EVENT_LOG_PATH = os.environ.get(
+    "VISATIER_EVENT_LOG",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "events.jsonl")
+)
+EVENT_LOG_QUEUE_SIZE = int(os.environ.get("VISATIER_EVENT_LOG_QUEUE", "10000"))
+EVENT_LOG_MAX_BYTES = int(os.environ.get("VISATIER_EVENT_LOG_MAX_BYTES", str(50 << 20)))
+EVENT_LOG_BACKUPS = int(os.environ.get("VISATIER_EVENT_LOG_BACKUPS", "5"))
+
+
+class EventLog:
+    """Запись событий без блокировки вызывающего потока.
+
+    emit кладет запись в ограниченную очередь (при переполнении запись отбрасывается
+    и учитывается в dropped); фоновый поток сериализует записи пачками и дописывает
+    в JSONL с ротацией по размеру: events.jsonl -> events.jsonl.1 -> ... -> .backups.
+    Записи с message дублируются в консоль тем же потоком.
+    """
+
+    def __init__(self, path: str, queue_size: int = EVENT_LOG_QUEUE_SIZE,
+                 max_bytes: int = EVENT_LOG_MAX_BYTES, backups: int = EVENT_LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._writer = None
+        self.counters = {"emitted": 0, "written": 0, "dropped": 0, "rotations": 0, "write_errors": 0}
+
+    def emit(self, event: str, **fields) -> bool:
+        """Поставить событие в очередь; False - очередь полна, событие отброшено"""
+        if self._writer is None:
+            self._start()
+        try:
+            self._queue.put_nowait({"ts": round(time.time(), 3), "event": event, **fields})
+        except queue.Full:
+            with self._lock:
+                self.counters["dropped"] += 1
+            return False
+        with self._lock:
+            self.counters["emitted"] += 1
+        return True
+
+    def _start(self):
+        # Поток и файл создаются при первом событии, чтобы импорт модуля ничего не писал
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="event-log", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _write_loop(self):
+        while True:
+            records = [self._queue.get()]
+            while len(records) < 1000:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(records)
+            for _ in records:
+                self._queue.task_done()
+
+    def _write(self, records: List[Dict]):
+        for record in records:
+            if record.get("message"):
+                print(record["message"], flush=True)
+        if not self.path:
+            return
+        payload = "".join(json.dumps(record, ensure_ascii=False, default=str) + "\n" for record in records)
+        payload = payload.encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            try:
+                size = os.path.getsize(self.path)
+            except FileNotFoundError:
+                size = 0
+            if size and size + len(payload) > self.max_bytes:
+                self._rotate()
+            with open(self.path, "ab") as fh:
+                fh.write(payload)
+        except OSError as e:
+            with self._lock:
+                self.counters["write_errors"] += 1
+            print(f"Event log write failed, {len(records)} records lost: {e}", flush=True)
+            return
+        with self._lock:
+            self.counters["written"] += len(records)
+
+    def _rotate(self):
+        if self.backups <= 0:
+            os.remove(self.path)
+        else:
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.path}.{index}"):
+                    os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+            os.replace(self.path, f"{self.path}.1")
+        with self._lock:
+            self.counters["rotations"] += 1
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Дождаться записи поставленных событий (при остановке и в тестах)"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self.counters, "queued": self._queue.qsize(), "path": self.path}
+
+
+EVENTS = EventLog(EVENT_LOG_PATH)
+
 # =========================
 # REFINED DATA MODELS (Улучшенные)
 # =========================
 
-@dataclass
+@dataclass(frozen=True)
 class ProfileData:
     id: str
     name: str
@@ -554,7 +787,7 @@ class ProfileData:
     growth_potential: float
     description: str
 
-@dataclass
+@dataclass(frozen=True)
 class CountryData:
     name: str
     flag: str
@@ -566,74 +799,639 @@ class CountryData:
     ease_score: float
     key_benefit: str
     why_good: str
+    # Валюта living_cost и setup_cost; в расчет идут суммы в EUR
+    cost_currency: str = "EUR"
+    # Ступенчатые расписания по годам проекции: ((столбец, ((год, значение), ...)), ...)
+    schedules: tuple = ()
 
-# Обновленные профили с реалистичными данными
-PROFILES = {
-    "startup": ProfileData(
-        "startup", "Tech Startup", "🚀", 50000, 20, "High", 2.8,
-        "Building the next unicorn with VC funding and global ambitions"
-    ),
-    "crypto": ProfileData(
-        "crypto", "Crypto/Web3", "₿", 80000, 35, "Very High", 3.5,
-        "DeFi protocols, NFT marketplaces, and blockchain innovations"
-    ),
-    "consulting": ProfileData(
-        "consulting", "Strategic Consultant", "💼", 30000, 60, "Low", 1.8,
-        "High-value advisory services for Fortune 500 companies"
-    ),
-    "ecommerce": ProfileData(
-        "ecommerce", "E-commerce", "🛒", 45000, 15, "Medium", 2.2,
-        "Online retail, dropshipping, and digital product sales"
-    )
+# Допустимые уровни риска и их поправочные коэффициенты
+RISK_FACTORS = {"Low": 0.95, "Medium": 0.85, "High": 0.75, "Very High": 0.65}
+
+# Числовые столбцы стран для векторизованного расчета
+COUNTRY_COLUMNS = ("corp_tax", "pers_tax", "living_cost", "setup_cost", "growth_multiplier", "ease_score")
+
+# Параметры, которые могут меняться по годам проекции
+SCHEDULED_COLUMNS = ("corp_tax", "pers_tax", "living_cost", "setup_cost")
+# Годовые таблицы покрывают не меньше горизонта окупаемости (120 месяцев)
+MIN_SCHEDULE_YEARS = 10
+# Факторы разложения monthly_improvement (поля результата driver_<имя>), в порядке подстановки
+PROFIT_DRIVERS = {
+    "growth": "Revenue growth",
+    "margin": "Margin uplift",
+    "tax": "Tax rates",
+    "living": "Living costs",
+    "floor": "Zero-income floor",
 }
+DRIVER_FIELDS = tuple(f"driver_{name}" for name in PROFIT_DRIVERS)
+
+# =========================
+# CURRENCY (Валюты: таблица курсов из файла)
+# =========================
+
+FX_PATH = os.environ.get(
+    "VISATIER_FX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "fx_rates.json")
+)
+BASE_CURRENCY = "EUR"
+# Денежные поля результата, которые переводятся в валюту отображения
+MONEY_FIELDS = ("annual_savings", "monthly_improvement", "total_benefit", "setup_cost", "net_opportunity_value",
+                *DRIVER_FIELDS)
+# Столбцы стран, заданные в cost_currency
+COST_COLUMNS = ("living_cost", "setup_cost")
+
+
+class FxTable:
+    """Курсы валют (единиц валюты за 1 EUR), загружаются из файла один раз при старте"""
+
+    def __init__(self, rates: Dict[str, float], symbols: Dict[str, str], as_of: str, version: str):
+        self.rates = MappingProxyType(dict(rates))
+        self.symbols = MappingProxyType(dict(symbols))
+        self.as_of = as_of
+        self.version = version
+        self._codes = pd.Index(list(rates))
+        self._vector = np.array(list(rates.values()), dtype=float)
+
+    def rate(self, code: str) -> float:
+        if code not in self.rates:
+            raise ValueError(f"Unknown currency {code!r}, expected one of {list(self.rates)}")
+        return self.rates[code]
+
+    def rates_for(self, codes) -> np.ndarray:
+        """Курсы для столбца кодов валют одним индексированием"""
+        positions = self._codes.get_indexer(pd.Index(codes))
+        if (positions < 0).any():
+            unknown = sorted({str(code) for code in np.asarray(codes, dtype=object)[positions < 0]})
+            raise ValueError(f"Unknown currencies {unknown}, expected one of {list(self.rates)}")
+        return self._vector[positions]
 
-# Обновленные данные стран с точными налоговыми ставками
-COUNTRIES = {
-    "UAE": CountryData(
-        "UAE (Dubai)", "🇦🇪", 0.09, 0.00, 8500, 45000, 2.4, 9.4,
-        "0% personal tax paradise",
-        "Global financial hub with world-class infrastructure and zero personal income tax"
-    ),
-    "Singapore": CountryData(
-        "Singapore", "🇸🇬", 0.17, 0.22, 7200, 38000, 2.1, 9.6,
-        "Asian Silicon Valley",
-        "Gateway to 650M ASEAN consumers with unmatched government support for startups"
-    ),
-    "Estonia": CountryData(
-        "Estonia", "🇪🇪", 0.20, 0.20, 2800, 8000, 1.8, 9.0,
-        "Digital nomad haven",
-        "World's first digital society with e-Residency program and crypto-friendly laws"
-    ),
-    "Portugal": CountryData(
-        "Portugal", "🇵🇹", 0.21, 0.48, 2200, 12000, 1.6, 7.8,
-        "EU Golden Visa access",
-        "NHR tax regime offers massive savings for new residents in beautiful coastal setting"
+    def to_base(self, amounts, codes) -> np.ndarray:
+        """Суммы в валютах codes (одна валюта или столбец) -> EUR"""
+        if isinstance(codes, str):
+            return np.asarray(amounts, dtype=float) / self.rate(codes)
+        return np.asarray(amounts, dtype=float) / self.rates_for(codes)
+
+    def symbol(self, code: str) -> str:
+        return self.symbols.get(code, f"{code} ")
+
+
+def load_fx_rates(path: str) -> FxTable:
+    """Чтение и проверка таблицы курсов; версия = хэш содержимого"""
+    with open(path, "rb") as fh:
+        payload = fh.read()
+    raw = json.loads(payload.decode("utf-8"))
+    if raw.get("base") != BASE_CURRENCY:
+        raise ValueError(f"{path}: rates must be quoted against {BASE_CURRENCY}")
+    rates = raw.get("rates") or {}
+    for code, value in rates.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value <= 0:
+            raise ValueError(f"{path}: rate for {code} must be a positive number, got {value!r}")
+    if rates.get(BASE_CURRENCY) != 1:
+        raise ValueError(f"{path}: {BASE_CURRENCY} rate must be 1")
+    return FxTable(rates, raw.get("symbols") or {}, raw.get("as_of", ""), hashlib.sha256(payload).hexdigest()[:12])
+
+
+FX = load_fx_rates(FX_PATH)
+
+
+def convert_results(results: Dict[str, Dict], currency: str) -> Dict[str, Dict]:
+    """Все денежные поля сценария (все страны, все годы) переводятся одним умножением"""
+    if currency == BASE_CURRENCY:
+        return results
+    values = []
+    for result in results.values():
+        values.extend(result[name] for name in MONEY_FIELDS)
+        values.extend(result.get("monthly_by_year", ()))
+    converted = iter((np.asarray(values, dtype=float) * FX.rate(currency)).tolist())
+    output = {}
+    for country_id, result in results.items():
+        result = {**result, **{name: next(converted) for name in MONEY_FIELDS}}
+        if "monthly_by_year" in result:
+            result["monthly_by_year"] = [next(converted) for _ in result["monthly_by_year"]]
+        output[country_id] = result
+    return output
+
+
+@lru_cache(maxsize=64)
+def money_format(currency: str, fx_version: str = None) -> str:
+    """Шаблон суммы для валюты: '€{:,.0f}'"""
+    return FX.symbol(currency).replace("{", "{{").replace("}", "}}") + "{:,.0f}"
+
+
+def format_money(amount: float, currency: str = BASE_CURRENCY) -> str:
+    # Знак перед символом валюты: -€4,000, а не €-4,000
+    sign = "-" if round(amount) < 0 else ""
+    return sign + money_format(currency, FX.version).format(abs(amount))
+
+# =========================
+# HOT-RELOADABLE DATA SOURCE (Данные вынесены во внешний файл)
+# =========================
+
+DATA_PATH = os.environ.get(
+    "VISATIER_DATA_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "visatier_data.json")
+)
+DATA_POLL_SECONDS = float(os.environ.get("VISATIER_DATA_POLL_SECONDS", "5"))
+# Как часто открытые вкладки проверяют, не появились ли новые профили и страны
+CHOICES_REFRESH_SECONDS = float(os.environ.get("VISATIER_CHOICES_REFRESH_SECONDS", "30"))
+
+
+class DataValidationError(ValueError):
+    """Файл данных не прошел валидацию"""
+
+
+@dataclass(frozen=True)
+class DataSnapshot:
+    """Неизменяемый снимок данных; запрос работает с одним снимком от начала до конца"""
+    version: str
+    profiles: Mapping[str, ProfileData]
+    countries: Mapping[str, CountryData]
+    source: str
+    loaded_at: float
+
+    @cached_property
+    def country_table(self) -> Dict[str, np.ndarray]:
+        """Предвычисленные столбцы параметров стран (порядок как в countries)"""
+        return {name: np.array([country_columns(c)[name] for c in self.countries.values()], dtype=float)
+                for name in COUNTRY_COLUMNS}
+    
+    @cached_property
+    def profile_table(self) -> Dict[str, np.ndarray]:
+        """Предвычисленные столбцы параметров профилей (порядок как в profiles)"""
+        return {
+            "revenue": np.array([p.revenue for p in self.profiles.values()], dtype=float),
+            "margin": np.array([p.margin for p in self.profiles.values()], dtype=float),
+            "growth_potential": np.array([p.growth_potential for p in self.profiles.values()], dtype=float),
+            "risk_multiplier": np.array([RISK_FACTORS.get(p.risk_level, 0.8) for p in self.profiles.values()]),
+        }
+    
+    def year_table(self, horizon: int) -> Dict[str, np.ndarray]:
+        """Столбцы с расписаниями: (страны, годы 1..horizon); None - расписаний нет ни у одной страны"""
+        tables = self.__dict__.setdefault("_year_tables", {})
+        if horizon not in tables:
+            scheduled = [name for name in SCHEDULED_COLUMNS
+                         if any(name in dict(c.schedules) for c in self.countries.values())]
+            tables[horizon] = {
+                name: np.stack([schedule_values(c, name, horizon) for c in self.countries.values()])
+                for name in scheduled
+            } or None
+        return tables[horizon]
+    
+    def country_index(self, country_ids: List[str]) -> np.ndarray:
+        """Позиции стран в country_table"""
+        order = {cid: i for i, cid in enumerate(self.countries)}
+        return np.array([order[cid] for cid in country_ids], dtype=np.intp)
+    
+    def profile_index(self, profile_ids: List[str]) -> np.ndarray:
+        """Позиции профилей в profile_table"""
+        order = {pid: i for i, pid in enumerate(self.profiles)}
+        return np.array([order[pid] for pid in profile_ids], dtype=np.intp)
+
+    def diff(self, other: "DataSnapshot") -> Dict[str, set]:
+        """Идентификаторы профилей и стран, изменившихся между снимками"""
+        def changed(old: Mapping, new: Mapping) -> set:
+            return {k for k in set(old) | set(new) if old.get(k) != new.get(k)}
+        return {
+            "profiles": changed(self.profiles, other.profiles),
+            "countries": changed(self.countries, other.countries),
+        }
+
+
+def _require_number(record: Dict, field: str, where: str, low: float = None, high: float = None) -> float:
+    value = record.get(field)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise DataValidationError(f"{where}: '{field}' must be a finite number, got {value!r}")
+    if (low is not None and value < low) or (high is not None and value > high):
+        raise DataValidationError(f"{where}: '{field}'={value} is outside [{low}, {high}]")
+    return value
+
+
+def _require_fields(record: Dict, cls, where: str, skip: tuple = ()) -> None:
+    if not isinstance(record, dict):
+        raise DataValidationError(f"{where}: expected an object, got {type(record).__name__}")
+    expected = {f.name for f in fields(cls)} - set(skip)
+    missing = expected - set(record)
+    unknown = set(record) - expected
+    if missing:
+        raise DataValidationError(f"{where}: missing fields {sorted(missing)}")
+    if unknown:
+        raise DataValidationError(f"{where}: unknown fields {sorted(unknown)}")
+    for f in fields(cls):
+        if f.name not in skip and f.type is str and not isinstance(record[f.name], str):
+            raise DataValidationError(f"{where}: '{f.name}' must be a string")
+
+
+def _parse_schedules(raw: Dict, where: str) -> tuple:
+    """{"pers_tax": {"6": 0.48}} -> (("pers_tax", ((6, 0.48),)),); значение действует с указанного года"""
+    if not isinstance(raw, dict):
+        raise DataValidationError(f"{where}: 'schedules' must be an object")
+    bounds = {"corp_tax": (0, 0.99), "pers_tax": (0, 0.99), "living_cost": (0, None), "setup_cost": (0, None)}
+    schedules = []
+    for name, steps in raw.items():
+        if name not in bounds:
+            raise DataValidationError(f"{where}.schedules: '{name}' cannot be scheduled, "
+                                      f"expected one of {list(SCHEDULED_COLUMNS)}")
+        if not isinstance(steps, dict) or not steps:
+            raise DataValidationError(f"{where}.schedules.{name}: expected a non-empty {{year: value}} object")
+        parsed = []
+        for year, value in steps.items():
+            if not str(year).isdigit() or int(year) < 1:
+                raise DataValidationError(f"{where}.schedules.{name}: year {year!r} must be an integer >= 1")
+            low, high = bounds[name]
+            parsed.append((int(year), _require_number({year: value}, year, f"{where}.schedules.{name}", low, high)))
+        schedules.append((name, tuple(sorted(parsed))))
+    return tuple(schedules)
+
+
+def parse_data(raw: Dict) -> tuple:
+    """Валидация сырого JSON и построение профилей/стран"""
+    if not isinstance(raw, dict):
+        raise DataValidationError("data file must contain a JSON object")
+
+    profiles = {}
+    for pid, record in (raw.get("profiles") or {}).items():
+        where = f"profiles.{pid}"
+        _require_fields(record, ProfileData, where, skip=("id",))
+        _require_number(record, "revenue", where, low=1)
+        _require_number(record, "margin", where, low=0, high=100)
+        _require_number(record, "growth_potential", where, low=0)
+        if record["risk_level"] not in RISK_FACTORS:
+            raise DataValidationError(f"{where}: unknown risk_level {record['risk_level']!r}")
+        profiles[pid] = ProfileData(id=pid, **record)
+
+    countries = {}
+    for cid, record in (raw.get("countries") or {}).items():
+        where = f"countries.{cid}"
+        record = dict(record) if isinstance(record, dict) else record
+        schedules = record.pop("schedules", {}) if isinstance(record, dict) else {}
+        cost_currency = record.pop("cost_currency", BASE_CURRENCY) if isinstance(record, dict) else BASE_CURRENCY
+        if cost_currency not in FX.rates:
+            raise DataValidationError(f"{where}: cost_currency {cost_currency!r} is not in the rate table "
+                                      f"{list(FX.rates)}")
+        _require_fields(record, CountryData, where, skip=("schedules", "cost_currency"))
+        _require_number(record, "corp_tax", where, low=0, high=0.99)
+        _require_number(record, "pers_tax", where, low=0, high=0.99)
+        _require_number(record, "living_cost", where, low=0)
+        _require_number(record, "setup_cost", where, low=0)
+        _require_number(record, "growth_multiplier", where, low=0)
+        _require_number(record, "ease_score", where, low=0, high=10)
+        countries[cid] = CountryData(**record, cost_currency=cost_currency,
+                                     schedules=_parse_schedules(schedules, where))
+
+    if not profiles:
+        raise DataValidationError("data file defines no profiles")
+    if not countries:
+        raise DataValidationError("data file defines no countries")
+    return profiles, countries
+
+
+def load_data_file(path: str) -> DataSnapshot:
+    """Чтение и валидация файла данных; версия = хэш содержимого"""
+    with open(path, "rb") as fh:
+        payload = fh.read()
+    try:
+        raw = json.loads(payload.decode("utf-8"))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise DataValidationError(f"{path}: invalid JSON ({e})") from e
+    profiles, countries = parse_data(raw)
+    digest = hashlib.sha256(payload)
+    if any(c.cost_currency != BASE_CURRENCY for c in countries.values()):
+        # Суммы в EUR зависят и от курсов: их смена - новая версия данных
+        digest.update(FX.version.encode("utf-8"))
+    return DataSnapshot(
+        version=digest.hexdigest()[:12],
+        profiles=MappingProxyType(profiles),
+        countries=MappingProxyType(countries),
+        source=path,
+        loaded_at=time.time()
     )
-}
+
+
+class DataStore:
+    """Хранилище снимков данных с отслеживанием файла и атомарной заменой"""
+
+    def __init__(self, path: str, poll_seconds: float = DATA_POLL_SECONDS):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self._snapshot = self._load()  # Ошибка при старте должна быть громкой
+        self._mtime = self._stat()
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[DataSnapshot, DataSnapshot], None]] = []
+        self._watcher = None
+        self._stop = threading.Event()
+
+    def _load(self) -> DataSnapshot:
+        return load_data_file(self.path)
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def snapshot(self) -> DataSnapshot:
+        # Чтение ссылки атомарно: запрос получает целостный снимок
+        return self._snapshot
+
+    def subscribe(self, callback: Callable[[DataSnapshot, DataSnapshot], None]) -> None:
+        """callback(old, new) вызывается после каждой успешной замены снимка"""
+        self._listeners.append(callback)
+
+    def reload(self) -> bool:
+        """Перечитать файл; при ошибке валидации остается старый снимок"""
+        with self._lock:
+            self._mtime = self._stat()
+            try:
+                new = self._load()
+            except (OSError, DataValidationError) as e:
+                EVENTS.emit("data_reload_rejected", version=self._snapshot.version, error=str(e),
+                            message=f"Data reload rejected, keeping version {self._snapshot.version}: {e}")
+                return False
+            old = self._snapshot
+            if new.version == old.version:
+                return False
+            self._snapshot = new
+        for callback in self._listeners:
+            try:
+                callback(old, new)
+            except Exception as e:
+                EVENTS.emit("data_reload_listener_failed", error=f"{type(e).__name__}: {e}",
+                            message=f"Data reload listener failed: {e}")
+        EVENTS.emit("data_reloaded", old_version=old.version, version=new.version,
+                    message=f"Data reloaded: {old.version} -> {new.version}")
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_seconds):
+            if self._stat() != self._mtime:
+                self.reload()
+
+    def start_watching(self) -> None:
+        if self._watcher is None and self.poll_seconds > 0:
+            self._watcher = threading.Thread(target=self._watch, name="data-watcher", daemon=True)
+            self._watcher.start()
+
+    def stop_watching(self) -> None:
+        self._stop.set()
+
+
+# =========================
+# SHARED-MEMORY DATA (Общие таблицы для нескольких процессов)
+# =========================
+
+SHARED_CONTROL_BYTES = 256
+
+
+def attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """Подключение к существующему сегменту без регистрации в resource_tracker процесса"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def country_record(country: CountryData) -> Dict:
+    """Страна в формате файла данных"""
+    record = {f.name: getattr(country, f.name) for f in fields(CountryData)
+              if f.name not in ("schedules", "cost_currency")}
+    if country.cost_currency != BASE_CURRENCY:
+        record["cost_currency"] = country.cost_currency
+    if country.schedules:
+        record["schedules"] = {name: {str(year): value for year, value in steps} for name, steps in country.schedules}
+    return record
+
+
+def snapshot_payload(snapshot: DataSnapshot) -> bytes:
+    """Снимок обратно в формат файла данных"""
+    return json.dumps({
+        "profiles": {pid: {f.name: getattr(p, f.name) for f in fields(ProfileData) if f.name != "id"}
+                     for pid, p in snapshot.profiles.items()},
+        "countries": {cid: country_record(c) for cid, c in snapshot.countries.items()},
+    }, ensure_ascii=False).encode("utf-8")
+
+
+class SharedDataPublisher:
+    """Родительский процесс: публикует каждый снимок в отдельный сегмент shared memory.
+
+    Сегмент: [8 байт длина заголовка][заголовок JSON][данные JSON][числовые столбцы float64].
+    Управляющий блок фиксированного размера хранит имя актуального сегмента; рабочие
+    процессы опрашивают его вместо файла.
+    """
+
+    def __init__(self, retain_seconds: float = 60):
+        self.control = shared_memory.SharedMemory(create=True, size=SHARED_CONTROL_BYTES)
+        self.retain_seconds = retain_seconds
+        self._segments: List[tuple] = []  # (segment, published_at)
+
+    @property
+    def control_name(self) -> str:
+        return self.control.name
+
+    def publish(self, snapshot: DataSnapshot) -> str:
+        payload = snapshot_payload(snapshot)
+        arrays = {f"country.{k}": v for k, v in snapshot.country_table.items()}
+        arrays.update({f"profile.{k}": v for k, v in snapshot.profile_table.items()})
+        
+        header = {"version": snapshot.version, "source": snapshot.source, "payload": None, "arrays": {}}
+        # Заголовок с запасом под смещения; смещения массивов выровнены на 8 байт
+        reserve = len(json.dumps({**header, "arrays": {k: [0, 0, 10 ** 12] for k in arrays}})) + 64
+        offset = 8 + reserve
+        header["payload"] = [offset, len(payload)]
+        offset += len(payload)
+        for key, values in arrays.items():
+            offset += -offset % 8
+            header["arrays"][key] = [offset, len(values)]
+            offset += values.nbytes
+        
+        segment = shared_memory.SharedMemory(create=True, size=offset)
+        encoded = json.dumps(header).encode("utf-8")
+        segment.buf[:8] = len(encoded).to_bytes(8, "little")
+        segment.buf[8:8 + len(encoded)] = encoded
+        start, length = header["payload"]
+        segment.buf[start:start + length] = payload
+        for key, (start, count) in header["arrays"].items():
+            np.ndarray(count, dtype=np.float64, buffer=segment.buf, offset=start)[:] = arrays[key]
+        
+        name = segment.name.encode("utf-8")
+        self.control.buf[:SHARED_CONTROL_BYTES] = name.ljust(SHARED_CONTROL_BYTES, b"\0")
+        self._segments.append((segment, time.time()))
+        self._release_old()
+        return segment.name
+
+    def _release_old(self):
+        # Подключившиеся процессы держат свое отображение; unlink лишь освобождает имя
+        now = time.time()
+        *previous, latest = self._segments
+        keep = []
+        for segment, published_at in previous:
+            if now - published_at > self.retain_seconds:
+                segment.close()
+                segment.unlink()
+            else:
+                keep.append((segment, published_at))
+        self._segments = keep + [latest]
+
+    def close(self) -> None:
+        for segment, _ in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+        self.control.close()
+        self.control.unlink()
+
+
+def load_shared_data(control_name: str) -> DataSnapshot:
+    """Снимок из shared memory: числовые таблицы - представления без копирования"""
+    control = attach_shared_memory(control_name)
+    try:
+        name = bytes(control.buf[:SHARED_CONTROL_BYTES]).rstrip(b"\0").decode("utf-8")
+    finally:
+        control.close()
+    if not name:
+        raise DataValidationError(f"shared data block {control_name} has not been published yet")
+    segment = attach_shared_memory(name)
+    length = int.from_bytes(bytes(segment.buf[:8]), "little")
+    header = json.loads(bytes(segment.buf[8:8 + length]).decode("utf-8"))
+    start, size = header["payload"]
+    profiles, countries = parse_data(json.loads(bytes(segment.buf[start:start + size]).decode("utf-8")))
+    snapshot = DataSnapshot(
+        version=header["version"],
+        profiles=MappingProxyType(profiles),
+        countries=MappingProxyType(countries),
+        source=f"shm:{name}",
+        loaded_at=time.time()
+    )
+    tables = {"country": {}, "profile": {}}
+    for key, (start, count) in header["arrays"].items():
+        table, column = key.split(".", 1)
+        view = np.ndarray(count, dtype=np.float64, buffer=segment.buf, offset=start)
+        view.flags.writeable = False
+        tables[table][column] = view
+    # Заполняем cached_property заранее и держим ссылку на сегмент, пока жив снимок
+    snapshot.__dict__.update(country_table=tables["country"], profile_table=tables["profile"],
+                             _segment=segment)
+    return snapshot
+
+
+class SharedDataStore(DataStore):
+    """DataStore рабочего процесса: данные из shared memory, смена отслеживается по управляющему блоку"""
+
+    def _load(self) -> DataSnapshot:
+        return load_shared_data(self.path)
+
+    def _stat(self):
+        try:
+            control = attach_shared_memory(self.path)
+        except FileNotFoundError:
+            return None
+        try:
+            return bytes(control.buf[:SHARED_CONTROL_BYTES])
+        finally:
+            control.close()
+
+
+# Рабочий процесс многопроцессного режима получает данные от родителя через shared memory
+DATA = (SharedDataStore(os.environ["VISATIER_SHARED_DATA"], poll_seconds=1)
+        if os.environ.get("VISATIER_SHARED_DATA") else DataStore(DATA_PATH))
 
 # =========================
 # ENHANCED CALCULATOR (Исправленная логика)
 # =========================
 
+
+def country_columns(country: CountryData) -> Dict[str, float]:
+    """Числовые параметры одной страны в формате calculate_batch (суммы в EUR)"""
+    columns = {name: getattr(country, name) for name in COUNTRY_COLUMNS}
+    if country.cost_currency != BASE_CURRENCY:
+        rate = FX.rate(country.cost_currency)
+        for name in COST_COLUMNS:
+            columns[name] = columns[name] / rate
+    return columns
+
+
+def schedule_values(country: CountryData, column: str, horizon: int) -> np.ndarray:
+    """Значения параметра по годам проекции 1..horizon: поиск ступени без цикла по годам"""
+    steps = dict(country.schedules).get(column, ())
+    values = np.array([getattr(country, column)] + [value for _, value in steps], dtype=float)
+    if column in COST_COLUMNS and country.cost_currency != BASE_CURRENCY:
+        values = values / FX.rate(country.cost_currency)
+    if not steps:
+        return np.full(horizon, values[0])
+    starts = np.array([year for year, _ in steps])
+    return values[np.searchsorted(starts, np.arange(1, horizon + 1), side="right")]
+
+
+def country_schedules(country: CountryData, horizon: int) -> Dict[str, np.ndarray]:
+    """Расписания одной страны в формате calculate_batch; None - параметры постоянны"""
+    return {name: schedule_values(country, name, horizon) for name, _ in country.schedules} or None
+
+
+def schedule_horizon(years) -> int:
+    return max(MIN_SCHEDULE_YEARS, int(np.max(years)))
+
+
+def client_columns(profile: ProfileData, custom_revenue: float = None) -> Dict[str, float]:
+    """Параметры клиента (профиль + выручка) в формате calculate_batch"""
+    return {
+        "revenue": custom_revenue if custom_revenue and custom_revenue > 0 else profile.revenue,
+        "margin": profile.margin,
+        "growth_potential": profile.growth_potential,
+        "risk_multiplier": RISK_FACTORS.get(profile.risk_level, 0.8),
+    }
+
+
+def profit_drivers(current_after_tax, new_revenue, margin, new_profit, new_after_tax, living_cost,
+                   monthly_improvement) -> Dict[str, np.ndarray]:
+    """Аддитивное разложение monthly_improvement по факторам из промежуточных величин расчета.
+
+    Параметры EU заменяются новыми по очереди: выручка, маржа, налоги, расходы на жизнь;
+    вклад фактора - изменение чистого дохода на его шаге. floor - остаток от отсечения
+    max(0, .) в двух сценариях, поэтому сумма вкладов равна monthly_improvement.
+    """
+    eu_keep_rate = 0.75 * 0.85
+    grown_after_tax = new_revenue * margin * (eu_keep_rate / 100)  # Новая выручка, прежняя маржа и налоги
+    eu_after_tax = new_profit * eu_keep_rate
+    shape = np.shape(monthly_improvement)
+    drivers = {
+        "driver_growth": np.broadcast_to(grown_after_tax - current_after_tax, shape),
+        "driver_margin": np.broadcast_to(eu_after_tax - grown_after_tax, shape),
+        "driver_tax": np.broadcast_to(new_after_tax - eu_after_tax, shape),
+        "driver_living": np.broadcast_to(4500 - living_cost, shape),
+    }
+    drivers["driver_floor"] = monthly_improvement - sum(drivers.values())
+    return drivers
+
+
 class WorldClassROICalculator:
     @staticmethod
-    def calculate_comprehensive_roi(profile: ProfileData, country: CountryData, 
-                                  custom_revenue: float = None, years: int = 5) -> Dict:
-        """Исправленный ROI расчет с защитой от деления на ноль"""
+    def calculate_batch(clients: Mapping[str, np.ndarray], countries: Mapping[str, np.ndarray],
+                        years=5, schedules: Mapping[str, np.ndarray] = None) -> Dict[str, np.ndarray]:
+        """Векторизованный ROI расчет: все столбцы транслируются (broadcast) между собой.
+
+        schedules - годовые значения параметров (последняя ось - годы проекции 1..H,
+        H >= max(years) и >= 10); без них параметры одинаковы во всех годах.
+        """
+        if schedules:
+            return WorldClassROICalculator._calculate_scheduled(clients, countries, years, schedules)
         
-        monthly_revenue = custom_revenue if custom_revenue and custom_revenue > 0 else profile.revenue
+        monthly_revenue = np.asarray(clients["revenue"], dtype=float)
+        margin = np.asarray(clients["margin"], dtype=float)
+        setup_cost = np.asarray(countries["setup_cost"], dtype=float)
+        years = np.asarray(years, dtype=float)
         
         # Текущая ситуация (EU средние)
-        current_profit = monthly_revenue * (profile.margin / 100)
+        current_profit = monthly_revenue * (margin / 100)
         current_after_tax = current_profit * 0.75 * 0.85  # 25% корп + 15% личный
-        current_net = max(0, current_after_tax - 4500)  # Защита от отрицательных значений
+        current_net = np.maximum(0, current_after_tax - 4500)  # Защита от отрицательных значений
         
         # Будущая ситуация с релокацией
-        new_revenue = monthly_revenue * country.growth_multiplier * profile.growth_potential
-        new_margin = min(profile.margin + 12, 75)  # Реалистичное улучшение маржи
+        new_revenue = monthly_revenue * countries["growth_multiplier"] * clients["growth_potential"]
+        new_margin = np.minimum(margin + 12, 75)  # Реалистичное улучшение маржи
         new_profit = new_revenue * (new_margin / 100)
-        new_after_tax = new_profit * (1 - country.corp_tax) * (1 - country.pers_tax)
-        new_net = max(0, new_after_tax - country.living_cost)
+        new_after_tax = new_profit * (1 - countries["corp_tax"]) * (1 - countries["pers_tax"])
+        new_net = np.maximum(0, new_after_tax - countries["living_cost"])
         
         # Ключевые метрики
         monthly_improvement = new_net - current_net
@@ -641,43 +1439,405 @@ class WorldClassROICalculator:
         total_benefit = annual_improvement * years
         
         # Защита от деления на ноль
-        if country.setup_cost > 0 and total_benefit > country.setup_cost:
-            roi = ((total_benefit - country.setup_cost) / country.setup_cost) * 100
-        else:
-            roi = 0
-        
-        if monthly_improvement > 0:
-            payback_months = country.setup_cost / monthly_improvement
-        else:
-            payback_months = float('inf')
+        with np.errstate(divide="ignore", invalid="ignore"):
+            roi = np.where((setup_cost > 0) & (total_benefit > setup_cost),
+                           ((total_benefit - setup_cost) / setup_cost) * 100, 0.0)
+            payback_months = np.where(monthly_improvement > 0,
+                                      setup_cost / monthly_improvement, np.inf)
         
         # Risk-adjusted расчеты
-        risk_factors = {"Low": 0.95, "Medium": 0.85, "High": 0.75, "Very High": 0.65}
-        risk_multiplier = risk_factors.get(profile.risk_level, 0.8)
-        conservative_roi = roi * risk_multiplier
+        conservative_roi = roi * clients["risk_multiplier"]
         
         # Opportunity cost
         opportunity_cost = (monthly_revenue * 0.12 * years * 12)  # 12% годовая доходность
         net_opportunity_value = total_benefit - opportunity_cost
         
+        ease_score = np.asarray(countries["ease_score"], dtype=float)
         return {
-            "roi": max(0, roi),
-            "conservative_roi": max(0, conservative_roi),
+            "roi": np.maximum(0, roi),
+            "conservative_roi": np.maximum(0, conservative_roi),
             "annual_savings": annual_improvement,
             "monthly_improvement": monthly_improvement,
-            "payback_months": min(payback_months, 120),  # Максимум 10 лет для отображения
+            "payback_months": np.minimum(payback_months, 120),  # Максимум 10 лет для отображения
             "total_benefit": total_benefit,
-            "setup_cost": country.setup_cost,
-            "success_probability": min(95, country.ease_score * 10),
-            "risk_level": profile.risk_level,
+            "setup_cost": np.broadcast_to(setup_cost, total_benefit.shape),
+            "success_probability": np.broadcast_to(np.minimum(95, ease_score * 10), total_benefit.shape),
+            "net_opportunity_value": net_opportunity_value,
+            "confidence_score": np.minimum(100, (ease_score * 5) + np.where(roi > 100, 45, 25)),
+            **profit_drivers(current_after_tax, new_revenue, margin, new_profit, new_after_tax,
+                             countries["living_cost"], monthly_improvement)
+        }
+    
+    @staticmethod
+    def _calculate_scheduled(clients: Mapping[str, np.ndarray], countries: Mapping[str, np.ndarray],
+                             years, schedules: Mapping[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        """Расчет с годовыми параметрами: годы - дополнительная ось массивов, а не цикл"""
+        
+        def by_year(name):
+            if name in schedules:
+                return np.asarray(schedules[name], dtype=float)
+            return np.asarray(countries[name], dtype=float)[..., None]
+        
+        monthly_revenue = np.asarray(clients["revenue"], dtype=float)
+        margin = np.asarray(clients["margin"], dtype=float)
+        years = np.asarray(years, dtype=float)
+        setup_cost = by_year("setup_cost")[..., 0]  # Переезд в первый год проекции
+        
+        current_profit = monthly_revenue * (margin / 100)
+        current_after_tax = current_profit * 0.75 * 0.85
+        current_net = np.maximum(0, current_after_tax - 4500)
+        
+        new_revenue = monthly_revenue * countries["growth_multiplier"] * clients["growth_potential"]
+        new_margin = np.minimum(margin + 12, 75)
+        new_profit = (new_revenue * (new_margin / 100))[..., None]
+        new_after_tax = new_profit * (1 - by_year("corp_tax")) * (1 - by_year("pers_tax"))
+        new_net = np.maximum(0, new_after_tax - by_year("living_cost"))
+        
+        monthly_by_year = new_net - current_net[..., None]
+        monthly_by_year, setup_cost, years = np.broadcast_arrays(
+            monthly_by_year, setup_cost[..., None], years[..., None]
+        )
+        setup_cost = setup_cost[..., 0]
+        years = years[..., 0]
+        
+        # Первый год + накопленные отклонения следующих лет: для постоянных
+        # параметров поправка ровно 0 и результат совпадает с расчетом без расписаний
+        monthly_improvement = monthly_by_year[..., 0]
+        annual_improvement = monthly_improvement * 12
+        drift = np.cumsum((monthly_by_year - monthly_improvement[..., None]) * 12, axis=-1)
+        last_year = (years.astype(np.intp) - 1)[..., None]
+        total_benefit = annual_improvement * years + np.take_along_axis(drift, last_year, axis=-1)[..., 0]
+        
+        # Окупаемость по годовому денежному потоку: первый год, в котором
+        # накопленный поток покрывает затраты на переезд, и месяц внутри него
+        cumulative = np.cumsum(monthly_by_year * 12, axis=-1)
+        covered = cumulative >= setup_cost[..., None]
+        first = np.argmax(covered, axis=-1)[..., None]
+        before = np.take_along_axis(cumulative, first, axis=-1)[..., 0] - \
+            np.take_along_axis(monthly_by_year, first, axis=-1)[..., 0] * 12
+        remaining = np.maximum(setup_cost - before, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            within = first[..., 0] * 12 + np.where(
+                remaining > 0, remaining / np.take_along_axis(monthly_by_year, first, axis=-1)[..., 0], 0
+            )
+            # За пределами таблицы - поток последнего года
+            last = monthly_by_year[..., -1]
+            beyond = np.where(last > 0, monthly_by_year.shape[-1] * 12 + (setup_cost - cumulative[..., -1]) / last,
+                              np.inf)
+            scheduled_payback = np.where(covered.any(axis=-1), within, beyond)
+            flat_payback = np.where(monthly_improvement > 0, setup_cost / monthly_improvement, np.inf)
+        varies = np.any(monthly_by_year != monthly_improvement[..., None], axis=-1)
+        payback_months = np.where(varies, scheduled_payback, flat_payback)
+        
+        with np.errstate(divide="ignore", invalid="ignore"):
+            roi = np.where((setup_cost > 0) & (total_benefit > setup_cost),
+                           ((total_benefit - setup_cost) / setup_cost) * 100, 0.0)
+        conservative_roi = roi * clients["risk_multiplier"]
+        opportunity_cost = (monthly_revenue * 0.12 * years * 12)
+        net_opportunity_value = total_benefit - opportunity_cost
+        
+        ease_score = np.asarray(countries["ease_score"], dtype=float)
+        return {
+            "roi": np.maximum(0, roi),
+            "conservative_roi": np.maximum(0, conservative_roi),
+            "annual_savings": annual_improvement,
+            "monthly_improvement": monthly_improvement,
+            "monthly_by_year": monthly_by_year,
+            "payback_months": np.minimum(payback_months, 120),
+            "total_benefit": total_benefit,
+            "setup_cost": setup_cost,
+            "success_probability": np.broadcast_to(np.minimum(95, ease_score * 10), total_benefit.shape),
             "net_opportunity_value": net_opportunity_value,
-            "confidence_score": min(100, (country.ease_score * 5) + (45 if roi > 100 else 25))
+            "confidence_score": np.minimum(100, (ease_score * 5) + np.where(roi > 100, 45, 25)),
+            # Разложение улучшения первого года - по параметрам первого года
+            **profit_drivers(current_after_tax, new_revenue, margin, new_profit[..., 0],
+                             new_after_tax[..., 0], by_year("living_cost")[..., 0], monthly_improvement)
+        }
+    
+    @staticmethod
+    def calculate_comprehensive_roi(profile: ProfileData, country: CountryData, 
+                                  custom_revenue: float = None, years: int = 5) -> Dict:
+        """Исправленный ROI расчет с защитой от деления на ноль"""
+        
+        columns = country_columns(country)
+        metrics = WorldClassROICalculator.calculate_batch(
+            client_columns(profile, custom_revenue), columns, years,
+            country_schedules(country, schedule_horizon(years))
+        )
+        result = {
+            "roi": float(metrics["roi"]),
+            "conservative_roi": float(metrics["conservative_roi"]),
+            "annual_savings": float(metrics["annual_savings"]),
+            "monthly_improvement": float(metrics["monthly_improvement"]),
+            "payback_months": float(metrics["payback_months"]),
+            "total_benefit": float(metrics["total_benefit"]),
+            "setup_cost": columns["setup_cost"],
+            "success_probability": float(metrics["success_probability"]),
+            "risk_level": profile.risk_level,
+            "net_opportunity_value": float(metrics["net_opportunity_value"]),
+            "confidence_score": float(metrics["confidence_score"]),
+            **{name: float(metrics[name]) for name in DRIVER_FIELDS}
+        }
+        if "monthly_by_year" in metrics:
+            result["setup_cost"] = float(metrics["setup_cost"])
+            result["monthly_by_year"] = metrics["monthly_by_year"].tolist()
+        return result
+
+# =========================
+# MULTI-STAGE RELOCATION PATH (Последовательность переездов, динамическое программирование)
+# =========================
+
+HOME_STATE = "HOME"  # Остаться в EU: базовый сценарий, улучшение 0
+
+
+class RelocationPathOptimizer:
+    """Лучшая последовательность стран и лет переезда на горизонте планирования.
+
+    Состояния - (год, текущая страна) плюс HOME. Въезд в страну оплачивает ее setup_cost
+    в год въезда (год проекции 1..years), возврат в EU бесплатен. Год - шаг рекурсии,
+    переходы между всеми парами состояний - одна матричная операция.
+    Расписания календарные: страна, в которую въехали в год k, считается по значениям года k.
+    """
+
+    @staticmethod
+    def yearly_tables(profile: ProfileData, snapshot: DataSnapshot, country_ids: List[str], years: int,
+                      custom_revenue: float = None, revenue_growth: float = 0.0) -> tuple:
+        """(годовое улучшение, затраты на въезд): матрицы (годы x страны) в EUR"""
+        horizon = schedule_horizon(years)
+        idx = snapshot.country_index(country_ids)
+        client = client_columns(profile, custom_revenue)
+        # Выручка растет каждый год; год t оценивается со своей выручкой и своими ставками
+        revenue = client["revenue"] * (1 + revenue_growth) ** np.arange(years)
+        year_table = snapshot.year_table(horizon) or {}
+        schedules = {
+            name: (year_table[name][idx] if name in year_table
+                   else np.repeat(snapshot.country_table[name][idx][:, None], horizon, axis=1))[None, :, :]
+            for name in SCHEDULED_COLUMNS
+        }
+        metrics = WorldClassROICalculator.calculate_batch(
+            {**client, "revenue": revenue[:, None]},
+            {name: values[idx][None, :] for name, values in snapshot.country_table.items()},
+            years, schedules
+        )
+        year = np.arange(years)
+        benefit = metrics["monthly_by_year"][year, :, year] * 12  # (годы, страны)
+        entry = schedules["setup_cost"][0, :, :years].T
+        return benefit, entry
+
+    @staticmethod
+    def optimize(profile: ProfileData, snapshot: DataSnapshot, country_ids: List[str], years: int = 10,
+                 custom_revenue: float = None, revenue_growth: float = 0.0) -> Dict:
+        """Оптимальный путь по чистой выгоде за горизонт; суммы в EUR"""
+        benefit, entry = RelocationPathOptimizer.yearly_tables(
+            profile, snapshot, country_ids, years, custom_revenue, revenue_growth
+        )
+        states = [HOME_STATE] + list(country_ids)
+        benefit = np.hstack([np.zeros((years, 1)), benefit])
+        entry = np.hstack([np.zeros((years, 1)), entry])
+        n = len(states)
+        
+        value = np.full(n, -np.inf)
+        value[0] = 0.0  # До первого года клиент в EU
+        back = np.zeros((years, n), dtype=np.intp)
+        for t in range(years):
+            # candidates[откуда, куда]: смена состояния оплачивает въезд, остаться - бесплатно
+            candidates = value[:, None] - entry[t][None, :]
+            np.fill_diagonal(candidates, value)
+            back[t] = candidates.argmax(axis=0)
+            value = candidates[back[t], np.arange(n)] + benefit[t]
+        
+        path = [int(value.argmax())]
+        for t in range(years - 1, 0, -1):
+            path.append(int(back[t][path[-1]]))
+        path.reverse()
+        
+        moved = np.array([path[0] != 0] + [a != b for a, b in zip(path, path[1:])])
+        yearly = benefit[np.arange(years), path] - np.where(moved, entry[np.arange(years), path], 0.0)
+        stages = []
+        for t, state in enumerate(path):
+            if t == 0 or state != path[t - 1]:
+                stages.append({"country": states[state], "from_year": t + 1, "to_year": t + 1,
+                               "setup_cost": float(entry[t, state]), "benefit": 0.0})
+            stages[-1]["to_year"] = t + 1
+            stages[-1]["benefit"] += float(benefit[t, state])
+        
+        # Сравнение с одним решением в первый год (как calculate_comprehensive_roi): переезд
+        # в одну страну или остаться в EU, поэтому у пути "остаться" выигрыш всегда 0
+        single = benefit.sum(axis=0) - entry[0]
+        best_single = int(single.argmax())
+        return {
+            "years": years,
+            "revenue_growth": revenue_growth,
+            "path": [states[state] for state in path],
+            "stages": stages,
+            "stay": not any(path),
+            "total_benefit": float(value.max()),
+            "cumulative": np.cumsum(yearly).tolist(),
+            "best_single_country": states[best_single],
+            "best_single_benefit": float(single[best_single]),
+            "gain_vs_single_move": float(value.max() - single[best_single]),
         }
 
+# =========================
+# HOLDING / RESIDENCE STRUCTURES (Компания в одной стране, резидентство в другой)
+# =========================
+
+STRUCTURE_COLUMNS = ("corp_country", "residence_country", "conservative_roi", "roi", "annual_savings",
+                     "payback_months", "setup_cost", "success_probability")
+
+
+def structure_columns(snapshot: DataSnapshot, country_ids: List[str], years=5) -> tuple:
+    """Параметры всех пар (компания, резидентство): столбцы calculate_batch формы (C, C)
+
+    Компания дает рост и corp_tax, резидентство - pers_tax. При разных странах оплачиваются
+    обе регистрации и living_cost обеих стран, вероятность успеха - по более слабой стране.
+    """
+    idx = snapshot.country_index(country_ids)
+    table = {name: values[idx] for name, values in snapshot.country_table.items()}
+    split = 1.0 - np.eye(len(idx))
+    countries = {
+        "corp_tax": table["corp_tax"][:, None],
+        "growth_multiplier": table["growth_multiplier"][:, None],
+        "pers_tax": table["pers_tax"][None, :],
+        "living_cost": table["living_cost"][None, :] + table["living_cost"][:, None] * split,
+        "setup_cost": table["setup_cost"][:, None] + table["setup_cost"][None, :] * split,
+        "ease_score": np.minimum(table["ease_score"][:, None], table["ease_score"][None, :]),
+    }
+    year_table = snapshot.year_table(schedule_horizon(years))
+    if not year_table:
+        return countries, None
+    full = {name: (year_table[name][idx] if name in year_table
+                   else np.repeat(table[name][:, None], schedule_horizon(years), axis=1))
+            for name in SCHEDULED_COLUMNS}
+    schedules = {
+        "corp_tax": full["corp_tax"][:, None, :],
+        "pers_tax": full["pers_tax"][None, :, :],
+        "living_cost": full["living_cost"][None, :, :] + full["living_cost"][:, None, :] * split[:, :, None],
+        "setup_cost": full["setup_cost"][:, None, :] + full["setup_cost"][None, :, :] * split[:, :, None],
+    }
+    return countries, schedules
+
+
+def top_structures(profile: ProfileData, snapshot: DataSnapshot, country_ids: List[str] = None, k: int = 10,
+                   custom_revenue: float = None, years: int = 5) -> pd.DataFrame:
+    """Все C x C пар одной транслируемой операцией, лучшие k по conservative ROI (суммы в EUR)"""
+    country_ids = list(country_ids or snapshot.countries)
+    countries, schedules = structure_columns(snapshot, country_ids, years)
+    metrics = WorldClassROICalculator.calculate_batch(client_columns(profile, custom_revenue), countries,
+                                                      years, schedules)
+    roi = metrics["conservative_roi"].ravel()
+    k = min(k, roi.size)
+    # argpartition - O(C^2) отбор k лучших, сортируются только они
+    best = np.argpartition(-roi, k - 1)[:k]
+    best = best[np.argsort(-roi[best], kind="stable")]
+    corp, residence = np.unravel_index(best, metrics["conservative_roi"].shape)
+    ids = np.asarray(country_ids, dtype=object)
+    return pd.DataFrame({
+        "corp_country": ids[corp],
+        "residence_country": ids[residence],
+        **{name: np.broadcast_to(metrics[name], metrics["conservative_roi"].shape).ravel()[best]
+           for name in STRUCTURE_COLUMNS[2:]},
+    })
+
+# =========================
+# WHAT-IF RESPONSE SURFACE (Сетка метрик для ползунков без запросов к серверу)
+# =========================
+
+WHAT_IF_REVENUE_SPAN = (0.1, 10.0)  # Доля выручки профиля, логарифмическая сетка
+WHAT_IF_REVENUE_STEPS = 31
+WHAT_IF_MARGINS = np.linspace(5, 60, 12)
+
+
+def response_surface(profile: ProfileData, snapshot: DataSnapshot, country_ids: List[str],
+                     currency: str = BASE_CURRENCY) -> Dict:
+    """conservative ROI и годовая экономия на сетке выручка x маржа одним вызовом calculate_batch.
+
+    Браузер интерполирует сетку билинейно (по логарифму выручки), поэтому ползунки
+    не обращаются к серверу. Массивы - [страна][выручка][маржа]; суммы в валюте currency.
+    """
+    idx = snapshot.country_index(country_ids)
+    revenue = profile.revenue * np.geomspace(*WHAT_IF_REVENUE_SPAN, WHAT_IF_REVENUE_STEPS)
+    year_table = snapshot.year_table(schedule_horizon(5))
+    metrics = WorldClassROICalculator.calculate_batch(
+        {**client_columns(profile), "revenue": revenue[:, None, None], "margin": WHAT_IF_MARGINS[None, :, None]},
+        {name: values[idx][None, None, :] for name, values in snapshot.country_table.items()},
+        schedules=year_table and {name: values[idx][None, None, :, :] for name, values in year_table.items()}
+    )
+    rate = FX.rate(currency)
+    # Округление до точности отображения сокращает JSON в несколько раз
+    return {
+        "symbol": FX.symbol(currency),
+        "revenue": np.round(revenue * rate, 2).tolist(),
+        "margin": WHAT_IF_MARGINS.tolist(),
+        "ids": list(country_ids),
+        "countries": [html.escape(f"{snapshot.countries[cid].flag} {snapshot.countries[cid].name}")
+                      for cid in country_ids],
+        "roi": np.rint(np.moveaxis(metrics["conservative_roi"], -1, 0)).astype(int).tolist(),
+        "savings_unit": 100,
+        "savings": np.rint(np.moveaxis(metrics["annual_savings"], -1, 0) * rate / 100).astype(int).tolist(),
+    }
+
+
+# Рендер в браузере: (поверхность, выручка, маржа, панель) -> [HTML полос, панель].
+# Plotly не доступен глобально в Gradio, поэтому ROI-трассы панели (столбцы и ось X
+# диаграммы риска) меняются в копии значения gr.Plot, и Gradio перерисовывает график.
+WHAT_IF_JS = """
+(surface, revenue, margin, chart) => {
+    if (!surface || !surface.roi || !surface.countries.length) return ["", chart];
+    const locate = (grid, x, scale) => {
+        x = Math.min(Math.max(x, grid[0]), grid[grid.length - 1]);
+        let i = 0;
+        while (i < grid.length - 2 && grid[i + 1] < x) i++;
+        return [i, (scale(x) - scale(grid[i])) / (scale(grid[i + 1]) - scale(grid[i]))];
+    };
+    const [i, fr] = locate(surface.revenue, revenue || surface.revenue[0], Math.log);
+    const [j, fm] = locate(surface.margin, margin || surface.margin[0], (v) => v);
+    const at = (z) => z[i][j] * (1 - fr) * (1 - fm) + z[i + 1][j] * fr * (1 - fm)
+        + z[i][j + 1] * (1 - fr) * fm + z[i + 1][j + 1] * fr * fm;
+    const money = (v) => (Math.round(v) < 0 ? "-" : "") + surface.symbol
+        + Math.abs(Math.round(v)).toLocaleString("en-US");
+    const rows = surface.countries.map((name, c) =>
+        [name, at(surface.roi[c]), at(surface.savings[c]) * surface.savings_unit]);
+    const top = Math.max(1, ...rows.map((row) => row[1]));
+    const bars = rows.map(([name, roi, savings]) =>
+        `<div class="whatif-row"><span>${name}</span><div class="whatif-track">`
+        + `<div class="whatif-bar" style="width:${(100 * Math.max(roi, 0) / top).toFixed(1)}%"></div></div>`
+        + `<span class="whatif-value">${Math.round(roi).toLocaleString("en-US")}% ROI · ${money(savings)}/yr</span></div>`
+    ).join("");
+    if (!chart || !chart.plot) return [bars, chart];
+    const figure = typeof chart.plot === "string" ? JSON.parse(chart.plot) : structuredClone(chart.plot);
+    const [roiBars, riskScatter] = figure.data || [];
+    const roiById = Object.fromEntries(surface.ids.map((id, c) => [id, Math.round(rows[c][1] * 10) / 10]));
+    if (!roiBars || !riskScatter || !Array.isArray(roiBars.x) || !roiBars.x.every((id) => id in roiById)) {
+        return [bars, chart];
+    }
+    const rois = roiBars.x.map((id) => roiById[id]);
+    roiBars.y = rois;
+    roiBars.text = rois.map((roi) => `${roi.toFixed(0)}%`);
+    roiBars.marker = {...roiBars.marker,
+        color: rois.map((roi) => roi > 150 ? "#34C759" : roi > 75 ? "#FF9F0A" : "#FF3B30")};
+    riskScatter.x = rois;
+    return [bars, {...chart, plot: JSON.stringify(figure)}];
+}
+"""
+
 # =========================
 # WORLD-CLASS VISUALIZATION (Оптимизированная)
 # =========================
 
+# Облегченный шаблон: только используемые ключи layout из plotly_white (без шаблонов трасс)
+LEAN_TEMPLATE = go.layout.Template(layout={
+    key: value for key, value in pio.templates["plotly_white"].layout.to_plotly_json().items()
+    if key in ("colorway", "font", "hovermode", "hoverlabel", "paper_bgcolor", "plot_bgcolor",
+               "xaxis", "yaxis", "title", "shapedefaults", "annotationdefaults", "autotypenumbers")
+})
+
+
+def display_values(values: List[float], decimals: int = 1) -> List[float]:
+    """Округление значений трасс до точности отображения"""
+    return [round(float(v), decimals) for v in values]
+
+
 class EliteChartBuilder:
     @staticmethod
     def create_executive_dashboard(results: Dict, countries: List[str]) -> go.Figure:
@@ -732,7 +1892,7 @@ class EliteChartBuilder:
         # ROI сравнение с цветовым кодированием
         colors = ['#34C759' if r > 150 else '#FF9F0A' if r > 75 else '#FF3B30' for r in rois]
         fig.add_trace(
-            go.Bar(x=countries, y=rois, name="Conservative ROI (%)", 
+            go.Bar(x=countries, y=display_values(rois), name="Conservative ROI (%)", 
                   marker_color=colors,
                   text=[f"{r:.0f}%" for r in rois],
                   textposition="outside"),
@@ -742,7 +1902,7 @@ class EliteChartBuilder:
         # Risk vs Return scatter
         fig.add_trace(
             go.Scatter(
-                x=rois, y=risks,
+                x=display_values(rois), y=risks,
                 mode='markers+text',
                 text=countries,
                 textposition="top center",
@@ -754,7 +1914,7 @@ class EliteChartBuilder:
         
         # Payback анализ
         fig.add_trace(
-            go.Bar(x=countries, y=paybacks, name="Payback (months)",
+            go.Bar(x=countries, y=display_values(paybacks), name="Payback (months)",
                   marker_color='#5856D6',
                   text=[f"{p:.0f}mo" for p in paybacks],
                   textposition="outside"),
@@ -763,7 +1923,7 @@ class EliteChartBuilder:
         
         # Confidence scores
         fig.add_trace(
-            go.Bar(x=countries, y=confidence, name="Confidence Score",
+            go.Bar(x=countries, y=display_values(confidence), name="Confidence Score",
                   marker_color='#34C759',
                   text=[f"{c:.0f}" for c in confidence],
                   textposition="outside"),
@@ -773,7 +1933,7 @@ class EliteChartBuilder:
         fig.update_layout(
             height=600,
             showlegend=False,
-            template="plotly_white",
+            template=LEAN_TEMPLATE,
             font=dict(family="SF Pro Display, -apple-system, sans-serif", size=12),
             title_font_size=16
         )
@@ -781,7 +1941,7 @@ class EliteChartBuilder:
         return fig
     
     @staticmethod
-    def create_timeline_visualization(result: Dict, country_name: str) -> go.Figure:
+    def create_timeline_visualization(result: Dict, country_name: str, currency: str = BASE_CURRENCY) -> go.Figure:
         """Исправленная временная шкала с защитой от ошибок"""
         
         if not result:
@@ -797,9 +1957,10 @@ class EliteChartBuilder:
         months = list(range(1, 61))  # 5 лет
         monthly_cf = result.get("monthly_improvement", 0)
         setup_cost = result.get("setup_cost", 0)
+        monthly_by_year = result.get("monthly_by_year")
         
         # Защита от неверных данных
-        if monthly_cf == 0:
+        if monthly_cf == 0 and not any(monthly_by_year or ()):
             fig = go.Figure()
             fig.add_annotation(
                 text="Insufficient data for cash flow projection",
@@ -811,8 +1972,13 @@ class EliteChartBuilder:
         
         cumulative = [-setup_cost]
         
-        for month in months:
-            cumulative.append(cumulative[-1] + monthly_cf)
+        if monthly_by_year:
+            # Поток каждого месяца - по параметрам своего года
+            flows = np.repeat(np.asarray(monthly_by_year[:len(months) // 12], dtype=float), 12)
+            cumulative.extend((np.cumsum(flows) - setup_cost).tolist())
+        else:
+            for month in months:
+                cumulative.append(cumulative[-1] + monthly_cf)
         
         fig = go.Figure()
         
@@ -829,7 +1995,7 @@ class EliteChartBuilder:
         # Cumulative cash flow
         fig.add_trace(go.Scatter(
             x=months, 
-            y=cumulative[1:],
+            y=display_values(cumulative[1:], 0),
             mode='lines',
             name='Cash Flow Projection',
             line=dict(color='#007AFF', width=3),
@@ -851,8 +2017,8 @@ class EliteChartBuilder:
         fig.update_layout(
             title=f"Cash Flow Projection - {country_name}",
             xaxis_title="Months",
-            yaxis_title="Cumulative Cash Flow (€)",
-            template="plotly_white",
+            yaxis_title=f"Cumulative Cash Flow ({FX.symbol(currency).strip()})",
+            template=LEAN_TEMPLATE,
             height=400,
             font=dict(family="SF Pro Display, -apple-system, sans-serif"),
             showlegend=False
@@ -860,17 +2026,1309 @@ class EliteChartBuilder:
         
         return fig
 
+    @staticmethod
+    def create_driver_waterfall(result: Dict, country_name: str, currency: str = BASE_CURRENCY) -> go.Figure:
+        """Водопад факторов: из чего складывается ежемесячное улучшение дохода"""
+        
+        if not result or any(name not in result for name in DRIVER_FIELDS):
+            # Сценарии, сохраненные до появления разложения
+            fig = go.Figure()
+            fig.add_annotation(
+                text="No driver breakdown for this scenario",
+                xref="paper", yref="paper",
+                x=0.5, y=0.5, xanchor='center', yanchor='middle',
+                showarrow=False, font_size=16
+            )
+            return fig
+        
+        # Нулевой вклад отсечения (оба дохода положительны) не показывается
+        drivers = [(label, result[f"driver_{name}"]) for name, label in PROFIT_DRIVERS.items()
+                   if name != "floor" or abs(result["driver_floor"]) >= 0.5]
+        labels = [label for label, _ in drivers] + ["Monthly Improvement"]
+        values = [value for _, value in drivers] + [result["monthly_improvement"]]
+        
+        fig = go.Figure(go.Waterfall(
+            x=labels,
+            y=display_values(values, 0),
+            measure=["relative"] * len(drivers) + ["total"],
+            text=[format_money(value, currency) for value in values],
+            textposition="outside",
+            increasing=dict(marker_color="#34C759"),
+            decreasing=dict(marker_color="#FF3B30"),
+            totals=dict(marker_color="#007AFF"),
+            connector=dict(line=dict(color="#C7C7CC", width=1))
+        ))
+        
+        fig.update_layout(
+            title=f"What Drives the Monthly Gain - {country_name}",
+            yaxis_title=f"Monthly Net Income Change ({FX.symbol(currency).strip()})",
+            template=LEAN_TEMPLATE,
+            height=400,
+            font=dict(family="SF Pro Display, -apple-system, sans-serif"),
+            showlegend=False
+        )
+        
+        return fig
+
+    @staticmethod
+    def create_path_chart(cumulative: List[float], path_labels: List[str], currency: str = BASE_CURRENCY) -> go.Figure:
+        """Накопленная чистая выгода по годам многоэтапного пути (цвет - страна года)"""
+        
+        years = list(range(1, len(cumulative) + 1))
+        palette = ['#007AFF', '#34C759', '#FF9F0A', '#5856D6', '#FF3B30', '#AF52DE']
+        colors = {label: palette[i % len(palette)] for i, label in enumerate(dict.fromkeys(path_labels))}
+        
+        fig = go.Figure(go.Bar(
+            x=years,
+            y=display_values(cumulative, 0),
+            marker_color=[colors[label] for label in path_labels],
+            text=path_labels,
+            textposition="inside",
+            name="Cumulative Net Benefit"
+        ))
+        fig.add_hline(y=0, line_dash="dash", line_color="#FF3B30", line_width=1)
+        
+        fig.update_layout(
+            title="Cumulative Net Benefit along the Optimal Path",
+            xaxis_title="Year",
+            yaxis_title=f"Cumulative Net Benefit ({FX.symbol(currency).strip()})",
+            template=LEAN_TEMPLATE,
+            height=400,
+            font=dict(family="SF Pro Display, -apple-system, sans-serif"),
+            showlegend=False
+        )
+        
+        return fig
+
+    @staticmethod
+    def create_batch_overview(summary: pd.DataFrame, metric_label: str = "Conservative ROI (%)") -> go.Figure:
+        """Сводка пакетного расчета (результат ColumnarResults.aggregate)"""
+        
+        fig = go.Figure(go.Bar(
+            x=[str(label) for label in summary.index],
+            y=summary["mean"],
+            error_y=dict(type="data", array=summary["std"], visible=True),
+            marker_color='#007AFF',
+            text=[f"{m:,.0f}" for m in summary["mean"]],
+            textposition="outside",
+            name=metric_label
+        ))
+        
+        fig.update_layout(
+            title=f"{metric_label} by {summary.index.name} ({int(summary['count'].sum()):,} scenarios)",
+            yaxis_title=metric_label,
+            template=LEAN_TEMPLATE,
+            height=400,
+            font=dict(family="SF Pro Display, -apple-system, sans-serif"),
+            showlegend=False
+        )
+        
+        return fig
+
+# =========================
+# PERSISTENT SCENARIO STORE (SQLite, постоянные ссылки)
+# =========================
+
+SCENARIO_DB_PATH = os.environ.get(
+    "VISATIER_SCENARIO_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "scenarios.sqlite3")
+)
+
+
+def scenario_key(profile_id: str, revenue, countries: List[str], data_version: str,
+                 currency: str = BASE_CURRENCY) -> str:
+    """Контентный хэш входных данных и версии данных"""
+    inputs = {
+        "profile": profile_id,
+        "revenue": float(revenue) if revenue else None,
+        "countries": list(countries),
+        "data_version": data_version,
+    }
+    if currency != BASE_CURRENCY:
+        # Ключи сценариев в EUR не меняются; для других валют важна и версия курсов
+        inputs["currency"] = f"{currency}@{FX.version}"
+    canonical = json.dumps(inputs, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:20]
+
+
+class ScenarioStore:
+    """Постоянное хранилище рассчитанных сценариев с пакетной записью"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS scenarios (
+        key TEXT PRIMARY KEY,
+        data_version TEXT NOT NULL,
+        profile_id TEXT NOT NULL,
+        inputs TEXT NOT NULL,
+        results TEXT NOT NULL,
+        outputs BLOB NOT NULL,
+        created_at REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_scenarios_version ON scenarios (data_version, profile_id);
+    """
+
+    def __init__(self, path: str, batch_size: int = 200, flush_seconds: float = 0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._conn = None
+        self._lock = threading.Lock()
+        self._pending: Dict[str, tuple] = {}
+        self._wakeup = threading.Event()
+        self._flusher = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Соединение открывается лениво, чтобы импорт модуля не создавал файл
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+            self._conn = conn
+            self._flusher = threading.Thread(target=self._flush_loop, name="scenario-flusher", daemon=True)
+            self._flusher.start()
+            atexit.register(self.flush)
+        return self._conn
+
+    def put(self, key: str, data_version: str, inputs: Dict, results: Dict, outputs: Dict) -> None:
+        """Поставить сценарий в очередь на запись; outputs - сериализуемые HTML и JSON графиков"""
+        row = (
+            key, data_version, inputs["profile_id"],
+            json.dumps(inputs), json.dumps(results),
+            zlib.compress(json.dumps(outputs).encode("utf-8")), time.time()
+        )
+        with self._lock:
+            self._connection()
+            self._pending[key] = row
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def get(self, key: str) -> Dict:
+        """Сценарий по ключу (сначала из очереди записи) или None"""
+        with self._lock:
+            row = self._pending.get(key)
+            if row is None:
+                row = self._connection().execute(
+                    "SELECT * FROM scenarios WHERE key = ?", (key,)
+                ).fetchone()
+        if row is None:
+            return None
+        return {
+            "key": row[0],
+            "data_version": row[1],
+            "inputs": json.loads(row[3]),
+            "results": json.loads(row[4]),
+            "outputs": json.loads(zlib.decompress(row[5]).decode("utf-8")),
+            "created_at": row[6],
+        }
+
+    def flush(self) -> int:
+        """Записать накопленные сценарии одной транзакцией"""
+        with self._lock:
+            if not self._pending or self._conn is None:
+                return 0
+            rows = list(self._pending.values())
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO scenarios VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+                )
+            self._pending.clear()
+        return len(rows)
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_seconds)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                EVENTS.emit("scenario_flush_failed", error=str(e), message=f"Scenario store flush failed: {e}")
+
+
+SCENARIOS = ScenarioStore(SCENARIO_DB_PATH)
+
 # =========================
-# WORLD-CLASS APPLICATION (Исправленное)
-# =========================
+# STREAMING SKETCHES (Слияемые потоковые сводки)
+# =========================
+
+SKETCH_RELATIVE_ACCURACY = 0.01  # Относительная ошибка квантилей для |x| >= SKETCH_MIN_VALUE
+SKETCH_MIN_VALUE = 1e-2          # Меньшие по модулю значения попадают в нулевую корзину
+SKETCH_MAX_VALUE = 1e12          # Большие по модулю - в крайнюю корзину
+SKETCH_PERCENTILES = (1, 5, 10, 25, 50, 75, 90, 95, 99)
+
+
+class MetricSketch:
+    """Потоковая сводка метрики по группам в постоянной памяти.
+
+    Квантили - по гистограмме на фиксированной логарифмической сетке (как в DDSketch):
+    оценка отличается от точного значения не более чем на relative_accuracy.
+    Среднее и дисперсия конечных значений - по формулам Чана. Сводки с одной сеткой
+    сливаются без потери точности, поэтому блоки и процессы считаются независимо.
+    """
+
+    def __init__(self, groups: int = 1, relative_accuracy: float = SKETCH_RELATIVE_ACCURACY,
+                 min_value: float = SKETCH_MIN_VALUE, max_value: float = SKETCH_MAX_VALUE):
+        self.groups = groups
+        self.layout = (relative_accuracy, min_value, max_value)
+        gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(gamma)
+        self._offset = int(np.ceil(np.log(min_value) / self._log_gamma))
+        self._bins = int(np.ceil(np.log(max_value) / self._log_gamma)) - self._offset + 1
+        # Корзины: [-inf | отрицательные по убыванию модуля | 0 | положительные | +inf]
+        magnitudes = 2 * gamma ** np.arange(self._offset, self._offset + self._bins) / (gamma + 1)
+        self._values = np.concatenate([[-np.inf], -magnitudes[::-1], [0.0], magnitudes, [np.inf]])
+        self.counts = np.zeros((groups, len(self._values)), dtype=np.int64)
+        self.finite = np.zeros(groups, dtype=np.int64)
+        self.mean = np.zeros(groups)
+        self.m2 = np.zeros(groups)
+        self.min = np.full(groups, np.inf)
+        self.max = np.full(groups, -np.inf)
+
+    def _positions(self, values: np.ndarray) -> np.ndarray:
+        zero = self._bins + 1
+        magnitude = np.abs(values)
+        small = magnitude < self.layout[1]
+        # Номер корзины по модулю: 1..bins (0 - нулевая корзина); бесконечности - отдельно ниже
+        k = np.log(np.maximum(magnitude, self.layout[1], out=magnitude), out=magnitude)
+        k *= 1 / self._log_gamma
+        np.ceil(k, out=k)
+        k -= self._offset - 1
+        np.minimum(k, self._bins, out=k)
+        k[small] = 0
+        positions = k.astype(np.intp)
+        np.negative(positions, out=positions, where=values < 0)
+        positions += zero
+        infinite = np.isinf(values)
+        if infinite.any():
+            positions[infinite] = np.where(values[infinite] > 0, 2 * zero, 0)
+        return positions
+
+    def _merge_moments(self, n: np.ndarray, mean: np.ndarray, m2: np.ndarray) -> None:
+        total = self.finite + n
+        delta = mean - self.mean
+        with np.errstate(invalid="ignore", divide="ignore"):
+            share = np.where(total > 0, n / total, 0.0)
+        self.mean = self.mean + delta * share
+        self.m2 = self.m2 + m2 + delta * delta * self.finite * share
+        self.finite = total
+
+    def update(self, values: np.ndarray, keys: np.ndarray = None) -> "MetricSketch":
+        """Добавить блок значений; keys - номера групп (по умолчанию группа 0), NaN пропускаются"""
+        values = np.asarray(values, dtype=float).ravel()
+        keys = np.zeros(len(values), dtype=np.intp) if keys is None else np.asarray(keys, dtype=np.intp).ravel()
+        known = ~np.isnan(values)
+        if not known.all():
+            values, keys = values[known], keys[known]
+        if not len(values):
+            return self
+        np.add.at(self.counts.reshape(-1), keys * self.counts.shape[1] + self._positions(values), 1)
+        np.minimum.at(self.min, keys, values)
+        np.maximum.at(self.max, keys, values)
+
+        # Моменты блока (два прохода по блоку), затем слияние с накопленными
+        finite = np.isfinite(values)
+        v, k = (values, keys) if finite.all() else (values[finite], keys[finite])
+        n = np.bincount(k, minlength=self.groups)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.nan_to_num(np.bincount(k, weights=v, minlength=self.groups) / n)
+        m2 = np.bincount(k, weights=(v - mean[k]) ** 2, minlength=self.groups)
+        self._merge_moments(n, mean, m2)
+        return self
+
+    def merge(self, other: "MetricSketch") -> "MetricSketch":
+        """Слить сводку с той же сеткой и числом групп (например, из другого процесса)"""
+        if other.layout != self.layout or other.groups != self.groups:
+            raise ValueError("Sketches with different layouts or groups cannot be merged")
+        self.counts += other.counts
+        self._merge_moments(other.finite, other.mean, other.m2)
+        np.minimum(self.min, other.min, out=self.min)
+        np.maximum(self.max, other.max, out=self.max)
+        return self
+
+    def quantile(self, q) -> np.ndarray:
+        """Квантили (доли 0..1) по группам: массив (группы, len(q)); NaN для пустых групп"""
+        q = np.atleast_1d(np.asarray(q, dtype=float))
+        cumulative = np.cumsum(self.counts, axis=1)
+        total = cumulative[:, -1]
+        ranks = q[None, :] * np.maximum(total - 1, 0)[:, None]
+        bins = np.stack([np.searchsorted(c, r, side="right") for c, r in zip(cumulative, ranks)])
+        estimates = self._values[np.minimum(bins, len(self._values) - 1)]
+        with np.errstate(invalid="ignore"):
+            estimates = np.clip(estimates, self.min[:, None], self.max[:, None])
+        return np.where(total[:, None] > 0, estimates, np.nan)
+
+    def summary(self, labels: List, name: str = None,
+                percentiles: List[float] = SKETCH_PERCENTILES) -> pd.DataFrame:
+        """count/mean/std/min/max и перцентили p1..p99 по группам"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            table = {
+                "count": self.counts.sum(axis=1),
+                "mean": np.where(self.finite > 0, self.mean, np.nan),
+                "std": np.sqrt(self.m2 / self.finite),
+                "min": self.min,
+                "max": self.max,
+            }
+        if len(percentiles):
+            estimates = self.quantile(np.asarray(percentiles, dtype=float) / 100)
+            table.update({f"p{p:g}": estimates[:, i] for i, p in enumerate(percentiles)})
+        return pd.DataFrame(table, index=pd.Index(labels, name=name))
+
+# =========================
+# OUT-OF-CORE BATCH RESULTS (Колоночный формат на memmap)
+# =========================
+
+BATCH_KEY_COLUMNS = {"client": np.int32, "country": np.int16, "years": np.int16, "simulation": np.int32}
+BATCH_METRIC_COLUMNS = ("roi", "conservative_roi", "annual_savings", "monthly_improvement",
+                        "payback_months", "total_benefit", "net_opportunity_value", "confidence_score")
+
+
+def portfolio_columns(snapshot: DataSnapshot, portfolio: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """Портфель клиентов (столбцы profile и revenue) -> столбцы calculate_batch"""
+    unknown = set(portfolio["profile"]) - set(snapshot.profiles)
+    if unknown:
+        raise ValueError(f"Unknown profiles in portfolio: {sorted(map(str, unknown))}")
+    idx = pd.Index(list(snapshot.profiles)).get_indexer(portfolio["profile"])
+    columns = {name: values[idx] for name, values in snapshot.profile_table.items()}
+    if "revenue" in portfolio:
+        # Пустая выручка -> значение профиля по умолчанию; нечисловая или неположительная - ошибка
+        blank = portfolio["revenue"].isna() | portfolio["revenue"].astype(str).str.strip().eq("")
+        revenue = pd.to_numeric(portfolio["revenue"].where(~blank), errors="coerce").to_numpy(dtype=float)
+        invalid = ~blank.to_numpy() & ~(np.isfinite(revenue) & (revenue > 0))
+        if invalid.any():
+            labels = portfolio["client_id"] if "client_id" in portfolio else portfolio.index.to_series()
+            rows = labels[invalid].astype(str).tolist()
+            raise ValueError(f"Revenue must be a positive number; invalid for {len(rows)} clients: "
+                             f"{', '.join(rows[:10])}{' ...' if len(rows) > 10 else ''}")
+        if "currency" in portfolio:
+            # Выручка в валюте клиента -> EUR одним индексированием по таблице курсов
+            codes = portfolio["currency"].fillna(BASE_CURRENCY).astype(str).str.strip().str.upper()
+            revenue = FX.to_base(revenue, codes.to_numpy())
+        columns["revenue"] = np.where(blank.to_numpy(), columns["revenue"], revenue)
+    return columns
+
+
+class ColumnarResultWriter:
+    """Запись пакетных результатов блоками в .npy memmap (по файлу на столбец)"""
+
+    def __init__(self, path: str, rows: int, dtypes: Dict[str, type], meta: Dict):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.rows = rows
+        self.meta = meta
+        self._columns = {
+            name: np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode="w+",
+                                            dtype=dtype, shape=(rows,))
+            for name, dtype in dtypes.items()
+        }
+
+    def write(self, start: int, chunk: Dict[str, np.ndarray]) -> None:
+        stop = start + len(next(iter(chunk.values())))
+        for name, values in chunk.items():
+            self._columns[name][start:stop] = values
+
+    def close(self) -> "ColumnarResults":
+        for column in self._columns.values():
+            column.flush()
+        self._columns.clear()
+        # schema.json пишется последним: его наличие означает завершенный набор
+        schema = {"rows": self.rows, "columns": list(BATCH_KEY_COLUMNS) + list(BATCH_METRIC_COLUMNS), **self.meta}
+        tmp = os.path.join(self.path, "schema.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(schema, fh, ensure_ascii=False)
+        os.replace(tmp, os.path.join(self.path, "schema.json"))
+        return ColumnarResults(self.path)
+
+
+class ColumnarResults:
+    """Чтение пакетных результатов без копирования (mmap) и поблочная агрегация"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "schema.json"), encoding="utf-8") as fh:
+            self.schema = json.load(fh)
+        self.rows = self.schema["rows"]
+        self._columns = {}
+
+    def column(self, name: str) -> np.ndarray:
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+        return self._columns[name]
+
+    def labels(self, key: str) -> List:
+        """Подписи для ключевого столбца (client/country/years/simulation)"""
+        return {
+            "client": self.schema["clients"],
+            "country": self.schema["countries"],
+            "years": self.schema["horizons"],
+            "simulation": list(range(self.schema["simulations"])),
+        }[key]
+
+    def iter_chunks(self, columns: List[str], chunk_rows: int = 1_000_000):
+        """Срезы memmap-столбцов блоками; данные читаются с диска по мере обращения"""
+        arrays = [self.column(name) for name in columns]
+        for start in range(0, self.rows, chunk_rows):
+            yield {name: a[start:start + chunk_rows] for name, a in zip(columns, arrays)}
+
+    def sketch(self, by: str, metrics: List[str], chunk_rows: int = 1_000_000) -> Dict[str, MetricSketch]:
+        """MetricSketch каждой метрики по группам за один проход в постоянной памяти"""
+        groups = len(self.labels(by))
+        horizons = np.asarray(self.schema["horizons"])
+        sketches = {name: MetricSketch(groups) for name in metrics}
+        for chunk in self.iter_chunks([by, *metrics], chunk_rows):
+            keys = group_index(by, chunk[by], horizons)
+            for name, sketch in sketches.items():
+                sketch.update(chunk[name], keys)
+        return sketches
+
+    def aggregate(self, by: str, metric: str = "conservative_roi", chunk_rows: int = 1_000_000,
+                  percentiles: List[float] = ()) -> pd.DataFrame:
+        """count/mean/std/min/max (и перцентили) метрики по группам; mean/std - по конечным значениям"""
+        return self.sketch(by, [metric], chunk_rows)[metric].summary(self.labels(by), by, percentiles)
+
+
+def group_index(by: str, keys: np.ndarray, horizons: np.ndarray) -> np.ndarray:
+    """Ключевой столбец пакета -> номер группы (горизонты хранятся в годах)"""
+    return np.searchsorted(horizons, keys) if by == "years" else keys
+
+
+def batch_plan(data: DataSnapshot, portfolio: pd.DataFrame, country_ids: List[str], horizons: List[int],
+               simulations: int = 1, growth_volatility: float = 0.25, seed: int = 0) -> Dict:
+    """Входные столбцы пакетного расчета; только массивы numpy - передается в процессы пула"""
+    clients = portfolio_columns(data, portfolio)
+    country_idx = data.country_index(country_ids)
+    horizons = np.asarray(sorted(horizons), dtype=np.int16)
+    year_table = data.year_table(schedule_horizon(horizons))
+    return {
+        "clients": clients,
+        "countries": {name: values[country_idx] for name, values in data.country_table.items()},
+        "schedules": year_table and {name: values[country_idx] for name, values in year_table.items()},
+        "horizons": horizons,
+        "shape": (len(portfolio), len(country_idx), len(horizons), simulations),
+        "growth_volatility": growth_volatility,
+        "seed": seed,
+    }
+
+
+def batch_chunks(plan: Dict, start: int, stop: int, chunk_rows: int):
+    """Блоки результатов строк [start, stop) в формате столбцов ColumnarResults
+
+    При simulations > 1 рост выручки в каждой строке умножается на логнормальный шок
+    со средним 1 (генератор инициализируется seed и началом блока, поэтому диапазоны,
+    выровненные по chunk_rows, дают те же строки в любом процессе).
+    """
+    shape, horizons = plan["shape"], plan["horizons"]
+    for begin in range(start, stop, chunk_rows):
+        flat = np.arange(begin, min(begin + chunk_rows, stop))
+        ci, ki, hi, si = np.unravel_index(flat, shape)
+        countries = {name: values[ki] for name, values in plan["countries"].items()}
+        schedules = plan["schedules"] and {name: values[ki] for name, values in plan["schedules"].items()}
+        if shape[3] > 1:
+            rng = np.random.default_rng([plan["seed"], begin])
+            countries["growth_multiplier"] = countries["growth_multiplier"] * rng.lognormal(
+                -plan["growth_volatility"] ** 2 / 2, plan["growth_volatility"], len(flat)
+            )
+        metrics = WorldClassROICalculator.calculate_batch(
+            {name: values[ci] for name, values in plan["clients"].items()}, countries, horizons[hi], schedules
+        )
+        yield begin, {
+            "client": ci, "country": ki, "years": horizons[hi], "simulation": si,
+            **{name: metrics[name] for name in BATCH_METRIC_COLUMNS}
+        }
+
+
+def run_batch(portfolio: pd.DataFrame, country_ids: List[str], horizons: List[int], out_dir: str,
+              simulations: int = 1, growth_volatility: float = 0.25, seed: int = 0,
+              chunk_rows: int = 250_000, snapshot: DataSnapshot = None) -> ColumnarResults:
+    """Пакетный расчет портфель x страны x горизонты x симуляции с записью на диск блоками"""
+    data = snapshot or DATA.snapshot()
+    plan = batch_plan(data, portfolio, country_ids, horizons, simulations, growth_volatility, seed)
+    rows = int(np.prod(plan["shape"]))
+    client_labels = (portfolio["client_id"] if "client_id" in portfolio else portfolio.index).astype(str).tolist()
+    
+    dtypes = {**BATCH_KEY_COLUMNS, **{name: np.float64 for name in BATCH_METRIC_COLUMNS}}
+    writer = ColumnarResultWriter(out_dir, rows, dtypes, meta={
+        "data_version": data.version,
+        "clients": client_labels,
+        "countries": list(country_ids),
+        "horizons": plan["horizons"].tolist(),
+        "simulations": simulations,
+        "growth_volatility": growth_volatility,
+        "seed": seed,
+    })
+    for start, chunk in batch_chunks(plan, 0, rows, chunk_rows):
+        writer.write(start, chunk)
+    return writer.close()
+
+
+def sketch_rows(task: Dict) -> Dict[str, MetricSketch]:
+    """Сводки метрик по строкам [start, stop) пакета (выполняется в процессе пула)"""
+    plan = task["plan"]
+    sketches = {name: MetricSketch(task["groups"]) for name in task["metrics"]}
+    for _, chunk in batch_chunks(plan, task["start"], task["stop"], task["chunk_rows"]):
+        keys = group_index(task["by"], chunk[task["by"]], plan["horizons"])
+        for name, sketch in sketches.items():
+            sketch.update(chunk[name], keys)
+    return sketches
+
+
+def sketch_batch(portfolio: pd.DataFrame, country_ids: List[str], horizons: List[int], by: str = "country",
+                 metrics: List[str] = BATCH_METRIC_COLUMNS, simulations: int = 1, growth_volatility: float = 0.25,
+                 seed: int = 0, chunk_rows: int = 250_000, workers: int = 1,
+                 snapshot: DataSnapshot = None) -> Dict[str, pd.DataFrame]:
+    """Пакетный расчет без хранения строк: метрики сразу сворачиваются в MetricSketch по группам by.
+
+    Строки делятся на диапазоны по границам блоков и считаются в пуле из workers
+    процессов (spawn); сводки процессов сливаются. Строки те же, что у run_batch
+    с теми же параметрами. Возвращает сводку (MetricSketch.summary) по каждой метрике.
+    """
+    data = snapshot or DATA.snapshot()
+    plan = batch_plan(data, portfolio, country_ids, horizons, simulations, growth_volatility, seed)
+    rows = int(np.prod(plan["shape"]))
+    labels = {
+        "client": (portfolio["client_id"] if "client_id" in portfolio else portfolio.index).astype(str).tolist(),
+        "country": list(country_ids),
+        "years": plan["horizons"].tolist(),
+        "simulation": list(range(simulations)),
+    }[by]
+    
+    # Диапазоны из целых блоков, по несколько на процесс для равномерной загрузки
+    chunks = -(-rows // chunk_rows)
+    bounds = np.unique(np.linspace(0, chunks, min(chunks, 4 * max(1, workers)) + 1).astype(int)) * chunk_rows
+    tasks = [{"plan": plan, "start": int(start), "stop": int(min(stop, rows)), "chunk_rows": chunk_rows,
+              "by": by, "metrics": list(metrics), "groups": len(labels)}
+             for start, stop in zip(bounds[:-1], bounds[1:])]
+    sketches = {name: MetricSketch(len(labels)) for name in metrics}
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as pool:
+            parts = pool.map(sketch_rows, tasks)
+            for part in parts:
+                for name, sketch in part.items():
+                    sketches[name].merge(sketch)
+    else:
+        for task in tasks:
+            for name, sketch in sketch_rows(task).items():
+                sketches[name].merge(sketch)
+    return {name: sketch.summary(labels, by) for name, sketch in sketches.items()}
+
+
+def run_batch_cli(args: argparse.Namespace) -> None:
+    """python app.py --batch portfolio.csv: расчет на диск, сводка в консоль и график обзора"""
+    data = DATA.snapshot()
+    portfolio = read_portfolio_csv(args.batch)
+    country_ids = args.countries.split(",") if args.countries else list(data.countries)
+    unknown = set(country_ids) - set(data.countries)
+    if unknown:
+        raise SystemExit(f"Unknown countries: {sorted(unknown)}")
+    horizons = [int(h) for h in args.horizons.split(",")]
+
+    started = time.perf_counter()
+    results = run_batch(portfolio, country_ids, horizons, args.batch_out, simulations=args.simulations,
+                        seed=args.seed, snapshot=data)
+    summary = results.aggregate(args.by, args.metric, percentiles=(5, 50, 95))
+    print(f"{results.rows:,} scenarios in {time.perf_counter() - started:.1f}s -> {args.batch_out}")
+    print(summary.round(1).to_string())
+
+    chart_path = os.path.join(args.batch_out, f"overview_{args.by}_{args.metric}.html")
+    EliteChartBuilder.create_batch_overview(summary, args.metric).write_html(chart_path)
+    print(f"Overview chart: {chart_path}")
+
+# =========================
+# CLIENT PORTFOLIO ANALYTICS (Анализ клиентского портфеля)
+# =========================
+
+REVENUE_BANDS = [0, 10_000, 50_000, 200_000, np.inf]
+REVENUE_BAND_LABELS = ["< €10k", "€10k-50k", "€50k-200k", "€200k+"]
+
+
+def read_portfolio_csv(path: str) -> pd.DataFrame:
+    """Загрузка CSV клиентов: обязательный столбец profile, опционально revenue и client_id"""
+    portfolio = pd.read_csv(path)
+    portfolio.columns = [str(c).strip().lower() for c in portfolio.columns]
+    if "profile" not in portfolio:
+        raise ValueError("CSV must contain a 'profile' column")
+    portfolio["profile"] = portfolio["profile"].astype(str).str.strip().str.lower()
+    return portfolio
+
+
+def analyze_portfolio(portfolio: pd.DataFrame, country_ids: List[str],
+                      snapshot: DataSnapshot = None) -> Dict[str, pd.DataFrame]:
+    """Оценка каждого клиента в каждой стране одной матричной операцией + сводки pandas"""
+    data = snapshot or DATA.snapshot()
+    clients = portfolio_columns(data, portfolio)
+    table = data.country_table
+    year_table = data.year_table(schedule_horizon(5))
+    idx = data.country_index(country_ids)
+    
+    # (клиенты, 1) x (1, страны) -> матрицы метрик
+    metrics = WorldClassROICalculator.calculate_batch(
+        {name: values[:, None] for name, values in clients.items()},
+        {name: values[idx][None, :] for name, values in table.items()},
+        schedules=year_table and {name: values[idx][None, :, :] for name, values in year_table.items()}
+    )
+    roi = metrics["conservative_roi"]
+    n_clients, n_countries = roi.shape
+    
+    scores = pd.DataFrame({
+        "profile": np.repeat(portfolio["profile"].to_numpy(), n_countries),
+        "revenue_band": np.repeat(
+            pd.cut(clients["revenue"], REVENUE_BANDS, labels=REVENUE_BAND_LABELS, right=False), n_countries
+        ),
+        "country": np.tile(np.asarray(country_ids, dtype=object), n_clients),
+        "conservative_roi": roi.ravel(),
+        "fast_payback": (metrics["payback_months"] < 24).ravel(),
+    })
+    best = pd.DataFrame({
+        "profile": portfolio["profile"].to_numpy(),
+        "best_country": np.asarray(country_ids, dtype=object)[roi.argmax(axis=1)],
+    })
+    
+    median_roi = scores.pivot_table(index="profile", columns="country", values="conservative_roi",
+                                    aggfunc="median", observed=True)[list(country_ids)]
+    fast_payback = scores.pivot_table(index="profile", columns="country", values="fast_payback",
+                                      aggfunc="mean", observed=True)[list(country_ids)] * 100
+    
+    segments = scores.groupby(["profile", "revenue_band", "country"], observed=True)["conservative_roi"].median()
+    best_by_segment = segments.groupby(level=["profile", "revenue_band"], observed=True).agg(
+        best_country=lambda s: s.idxmax()[2], median_roi="max"
+    )
+    best_by_segment["clients"] = scores.groupby(["profile", "revenue_band"], observed=True).size() // n_countries
+    best_share = best.groupby("profile")["best_country"].value_counts(normalize=True).mul(100)
+    
+    return {
+        "median_roi": median_roi.round(0),
+        "fast_payback_share": fast_payback.round(1),
+        "best_by_segment": best_by_segment.round({"median_roi": 0}),
+        "best_country_share": best_share.rename("share_pct").round(1).reset_index(),
+    }
+
+# =========================
+# HTML FRAGMENT CACHE (Предкомпилированные шаблоны)
+# =========================
+
+def compact_html(html: str) -> str:
+    """Удаление отступов и переводов строк из статической разметки"""
+    return re.sub(r">\s+<", "><", re.sub(r"\s*\n\s*", " ", html.strip()))
+
+
+class HtmlFragments:
+    """Шаблоны компилируются один раз; блоки, зависящие только от данных, мемоизируются.
+
+    Ключи кэшей - сами неизменяемые записи ProfileData/CountryData, поэтому после
+    перезагрузки данных промахиваются только действительно изменившиеся записи.
+    """
+
+    _PROFILE_CARD_SOURCE = """
+            <div style="background: #f8f9fa; padding: 1rem; border-radius: 0.75rem; margin: 1rem 0;">
+                <h4 style="color: #333; margin-bottom: 0.5rem;">{icon} {name}</h4>
+                <p style="color: #666; margin-bottom: 0.75rem;">{description}</p>
+                <div style="display: flex; gap: 1rem; flex-wrap: wrap;">
+                    <span style="background: #007AFF; color: white; padding: 0.25rem 0.75rem; border-radius: 0.5rem; font-size: 0.875rem;">
+                        Revenue: {revenue}/month
+                    </span>
+                    <span style="background: #34C759; color: white; padding: 0.25rem 0.75rem; border-radius: 0.5rem; font-size: 0.875rem;">
+                        Margin: {margin}%
+                    </span>
+                    <span style="background: #FF9F0A; color: white; padding: 0.25rem 0.75rem; border-radius: 0.5rem; font-size: 0.875rem;">
+                        Risk: {risk_level}
+                    </span>
+                </div>
+            </div>
+            """
+
+    _KPI_SOURCE = """
+            <div class="kpi-grid">
+                <div class="kpi-card {roi_status}">
+                    <div class="kpi-label">Conservative ROI</div>
+                    <div class="kpi-value">{roi:.0f}%</div>
+                    <div class="kpi-note">5-year risk-adjusted return</div>
+                </div>
+                <div class="kpi-card">
+                    <div class="kpi-label">Annual Savings</div>
+                    <div class="kpi-value">{annual_savings}</div>
+                    <div class="kpi-note">Per year after relocation</div>
+                </div>
+                <div class="kpi-card">
+                    <div class="kpi-label">Payback Period</div>
+                    <div class="kpi-value">{payback}</div>
+                    <div class="kpi-note">Months to break even</div>
+                </div>
+                <div class="kpi-card">
+                    <div class="kpi-label">Confidence Score</div>
+                    <div class="kpi-value">{confidence:.0f}/100</div>
+                    <div class="kpi-note">Success probability rating</div>
+                </div>
+            </div>
+            """
+
+    _RECOMMENDATION_HEAD_SOURCE = """
+            <div class="recommendation-card">
+                <div class="recommendation-header">
+                    <div class="recommendation-icon">🏆</div>
+                    <div class="recommendation-title">Recommended: {name}</div>
+                </div>
+                <div class="recommendation-content">
+                    <strong>{key_benefit}</strong><br>
+                    {why_good}
+                    <br><br>
+                    <strong>For {profile_name}s:</strong> """
+
+    _RECOMMENDATION_TAIL_SOURCE = """{roi:.0f}% conservative ROI 
+                    with {payback:.0f}-month payback period.
+                </div>
+            </div>
+            """
+
+    _CTA_SOURCE = """
+            <div class="cta-section">
+                <div class="value-badge">Limited Time: 40% Off</div>
+                <h3 class="cta-title">{title}</h3>
+                <p class="cta-description">{description}</p>
+                
+                <div class="price-container">
+                    <span class="price-old">{price_old}</span>
+                    <span class="price-new">{price_new}</span>
+                </div>
+                
+                <button class="cta-button">Get Your Migration Plan</button>
+                
+                <div class="guarantee-text">
+                    30-day money-back guarantee • Secure payment • Instant access
+                </div>
+            </div>
+            """
+
+    PROFILE_CARD = compact_html(_PROFILE_CARD_SOURCE)
+    KPI = compact_html(_KPI_SOURCE)
+    RECOMMENDATION_HEAD = compact_html(_RECOMMENDATION_HEAD_SOURCE) + " "
+    RECOMMENDATION_TAIL = compact_html(_RECOMMENDATION_TAIL_SOURCE)
+    CTA = compact_html(_CTA_SOURCE)
+
+    # Пакеты услуг по уровню консервативного ROI: (порог, старая цена, новая цена, заголовок, описание)
+    CTA_TIERS = {
+        "concierge": (200, "€2,497", "€1,497", "Complete {name} Relocation Concierge",
+                      "White-glove service with personal immigration lawyer, tax optimization, and 12-month support"),
+        "blueprint": (100, "€997", "€497", "{name} Business Migration Blueprint",
+                      "Comprehensive guide with legal requirements, tax strategies, and step-by-step timeline"),
+        "exploration": (-np.inf, "€297", "€97", "{name} Exploration Package",
+                        "Essential information to evaluate your relocation opportunity"),
+    }
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def profile_card(profile: ProfileData, currency: str = BASE_CURRENCY) -> str:
+        return HtmlFragments.PROFILE_CARD.format(
+            icon=profile.icon, name=profile.name, description=profile.description,
+            revenue=format_money(profile.revenue * FX.rate(currency), currency),
+            margin=profile.margin, risk_level=profile.risk_level
+        )
+
+    @staticmethod
+    def cta_tier(conservative_roi: float) -> str:
+        for tier, (threshold, *_) in HtmlFragments.CTA_TIERS.items():
+            if conservative_roi > threshold:
+                return tier
+        return "exploration"
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def cta(country: CountryData, tier: str) -> str:
+        _, price_old, price_new, title, description = HtmlFragments.CTA_TIERS[tier]
+        return HtmlFragments.CTA.format(
+            title=title.format(name=country.name), description=description,
+            price_old=price_old, price_new=price_new
+        )
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def recommendation_head(country: CountryData, profile: ProfileData) -> str:
+        return HtmlFragments.RECOMMENDATION_HEAD.format(
+            name=country.name, key_benefit=country.key_benefit,
+            why_good=country.why_good, profile_name=profile.name
+        )
+
+    @staticmethod
+    def render_results(result: Dict, country: CountryData, profile: ProfileData,
+                       currency: str = BASE_CURRENCY) -> tuple:
+        """KPI, рекомендация и CTA; на каждый запрос форматируются только числовые слоты.
+
+        Денежные поля result уже в валюте currency; цены CTA остаются в EUR (валюта оплаты).
+        """
+        roi = result["conservative_roi"]
+        payback = result["payback_months"]
+        kpi_html = HtmlFragments.KPI.format(
+            roi_status="success" if roi > 150 else "warning" if roi > 75 else "error",
+            roi=roi,
+            annual_savings=format_money(result["annual_savings"], currency),
+            payback=f"{payback:.0f}" if payback < 120 else "120+",
+            confidence=result["confidence_score"]
+        )
+        rec_html = HtmlFragments.recommendation_head(country, profile) + \
+            HtmlFragments.RECOMMENDATION_TAIL.format(roi=roi, payback=payback)
+        cta_html = HtmlFragments.cta(country, HtmlFragments.cta_tier(roi))
+        return kpi_html, rec_html, cta_html
+
+# =========================
+# REPORT EXPORT (Отчеты по клиентам: пул рендеринга и контентный кэш)
+# =========================
+
+REPORT_CACHE_DIR = os.environ.get(
+    "VISATIER_REPORT_CACHE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "reports")
+)
+REPORT_CACHE_BYTES = int(os.environ.get("VISATIER_REPORT_CACHE_BYTES", str(512 << 20)))
+REPORT_WORKERS = int(os.environ.get("VISATIER_REPORT_WORKERS", str(min(4, os.cpu_count() or 1))))
+REPORT_TEMPLATE_VERSION = "2"  # Увеличить при любом изменении разметки или графиков отчета
+REPORT_PLOTLY_JS = "plotly.min.js"  # Одна копия plotly.js рядом с HTML-отчетами: работают без сети
+
+
+def report_formats() -> tuple:
+    """PNG и PDF рендерит kaleido; без него доступен только HTML"""
+    return ("html", "png", "pdf") if kaleido is not None else ("html",)
+
+
+def report_key(inputs: Dict, data_version: str, fmt: str) -> str:
+    """Контентный хэш (входные данные, версия данных, версия шаблона, формат)"""
+    payload = {"inputs": inputs, "data_version": data_version, "template": REPORT_TEMPLATE_VERSION, "format": fmt}
+    if inputs["currency"] != BASE_CURRENCY:
+        payload["fx_version"] = FX.version
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:24]
+
+
+def report_figure(results: Dict, countries: Mapping[str, CountryData], best: str, currency: str) -> go.Figure:
+    """Одностраничный отчет для PNG/PDF: таблица KPI по странам и денежный поток лучшей страны"""
+    ids = list(results)
+    timeline = EliteChartBuilder.create_timeline_visualization(results[best], countries[best].name, currency)
+    fig = make_subplots(rows=2, cols=1, row_heights=[0.4, 0.6], vertical_spacing=0.08,
+                        specs=[[{"type": "table"}], [{"type": "xy"}]],
+                        subplot_titles=("", timeline.layout.title.text))
+    fig.add_trace(go.Table(
+        header=dict(values=["Country", "Conservative ROI", "Annual Savings", "Payback", "Confidence"],
+                    fill_color="#007AFF", font=dict(color="white")),
+        cells=dict(values=[
+            [f"{countries[cid].flag} {countries[cid].name}" for cid in ids],
+            [f"{results[cid]['conservative_roi']:.0f}%" for cid in ids],
+            [format_money(results[cid]["annual_savings"], currency) for cid in ids],
+            [f"{results[cid]['payback_months']:.0f} mo" for cid in ids],
+            [f"{results[cid]['confidence_score']:.0f}" for cid in ids],
+        ])
+    ), row=1, col=1)
+    for trace in timeline.data:
+        fig.add_trace(trace, row=2, col=1)
+    # add_hline не работает в фигуре с таблицей: линия безубыточности - обычная фигура на осях x/y
+    fig.add_shape(type="line", xref="x domain", yref="y", x0=0, x1=1, y0=0, y1=0,
+                  line=dict(color="#FF3B30", dash="dash"))
+    fig.update_layout(template=LEAN_TEMPLATE, height=900, width=800, showlegend=False,
+                      font=dict(family="SF Pro Display, -apple-system, sans-serif"))
+    return fig
+
+
+def render_report(task: Dict) -> str:
+    """Рендер одного отчета в файл кэша (выполняется в процессе пула); возвращает путь"""
+    path = task["path"]
+    if os.path.exists(path):
+        return path
+    profile, countries, currency = task["profile"], task["countries"], task["currency"]
+    results, best = task["results"], task["best"]
+    if task["format"] == "html":
+        kpi_html, rec_html, _ = HtmlFragments.render_results(results[best], countries[best], profile, currency)
+        dashboard = EliteChartBuilder.create_executive_dashboard(results, list(results))
+        timeline = EliteChartBuilder.create_timeline_visualization(results[best], countries[best].name, currency)
+        drivers = EliteChartBuilder.create_driver_waterfall(results[best], countries[best].name, currency)
+        client = html.escape(task["client"])
+        body = (
+            "<!DOCTYPE html><html><head><meta charset=\"utf-8\">"
+            f"<title>VisaTier ROI Report - {client}</title>"
+            f"<style>{STYLESHEET.decode('utf-8')}</style>"
+            f'<script src="{REPORT_PLOTLY_JS}"></script></head><body><main class="main-container">'
+            f"<h1>VisaTier ROI Report - {client}</h1>"
+            f"<p>Monthly revenue: {format_money(task['revenue'], currency)} · data {task['data_version']}</p>"
+            + HtmlFragments.profile_card(profile, currency) + kpi_html + rec_html
+            + dashboard.to_html(full_html=False, include_plotlyjs=False, div_id="dashboard")
+            + timeline.to_html(full_html=False, include_plotlyjs=False, div_id="timeline")
+            + drivers.to_html(full_html=False, include_plotlyjs=False, div_id="drivers")
+            + "</main></body></html>"
+        ).encode("utf-8")
+    else:
+        body = pio.to_image(report_figure(results, countries, best, currency), format=task["format"])
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(body)
+    os.replace(tmp, path)
+    return path
+
+
+class ReportExporter:
+    """Пакетный экспорт отчетов: расчет блоками в родителе, рендеринг в пуле процессов.
+
+    Готовые файлы лежат в кэше под контентным ключом, поэтому повторный экспорт
+    неизмененных клиентов не рендерит ничего. В памяти одновременно - один блок
+    клиентов и не более 2 x workers задач рендеринга.
+    """
+
+    def __init__(self, cache_dir: str = REPORT_CACHE_DIR, workers: int = REPORT_WORKERS,
+                 max_cache_bytes: int = REPORT_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.workers = max(1, workers)
+        self.max_cache_bytes = max_cache_bytes
+        self._pool = None
+        self._lock = threading.Lock()
+        self.counters = {"exports": 0, "reports": 0, "cache_hits": 0, "rendered": 0}
+
+    def pool(self) -> ProcessPoolExecutor:
+        # Пул создается лениво и переиспользуется; spawn - родитель многопоточный
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=get_context("spawn"))
+                atexit.register(self._pool.shutdown, cancel_futures=True)
+            return self._pool
+
+    def tasks(self, portfolio: pd.DataFrame, country_ids: List[str], formats: List[str], currency: str,
+              data: DataSnapshot, chunk_clients: int):
+        """Задачи рендеринга (по одной на клиента и формат), блоками по chunk_clients"""
+        revenue = portfolio_columns(data, portfolio)["revenue"]
+        labels = (portfolio["client_id"] if "client_id" in portfolio else portfolio.index).astype(str).tolist()
+        profiles = portfolio["profile"].tolist()
+        countries = {cid: data.countries[cid] for cid in country_ids}
+        for start in range(0, len(portfolio), chunk_clients):
+            rows = range(start, min(start + chunk_clients, len(portfolio)))
+            items = [{"profile": profiles[i], "country": cid, "revenue": float(revenue[i]), "years": 5,
+                      "currency": currency} for i in rows for cid in country_ids]
+            scores = iter(score_batch(items, data))
+            for i in rows:
+                results = {cid: next(scores) for cid in country_ids}
+                best = max(results, key=lambda cid: results[cid]["conservative_roi"])
+                inputs = {"client": labels[i], "profile": profiles[i], "revenue": round(float(revenue[i]), 2),
+                          "countries": list(country_ids), "currency": currency}
+                for fmt in formats:
+                    yield {
+                        "client": labels[i], "format": fmt, "currency": currency,
+                        "path": os.path.join(self.cache_dir, f"{report_key(inputs, data.version, fmt)}.{fmt}"),
+                        "profile": data.profiles[profiles[i]], "countries": countries,
+                        "results": results, "best": best,
+                        "revenue": float(revenue[i]) * FX.rate(currency), "data_version": data.version,
+                    }
+
+    def export(self, portfolio: pd.DataFrame, country_ids: List[str], out_path: str, formats: List[str] = ("html",),
+               currency: str = BASE_CURRENCY, snapshot: DataSnapshot = None, chunk_clients: int = 256) -> Dict:
+        """ZIP с отчетами по всем клиентам портфеля; возвращает счетчики экспорта"""
+        data = snapshot or DATA.snapshot()
+        unsupported = set(formats) - set(report_formats())
+        if unsupported:
+            raise ValueError(f"Unsupported report formats: {sorted(unsupported)} (PNG/PDF need kaleido)")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        stats = {"reports": 0, "cache_hits": 0, "rendered": 0}
+        names = set()
+        
+        def add(archive, task, path):
+            name = re.sub(r"[^\w.-]+", "_", task["client"]) or "client"
+            while f"{name}.{task['format']}" in names:
+                name += "_"
+            names.add(f"{name}.{task['format']}")
+            archive.write(path, f"{name}.{task['format']}")
+            stats["reports"] += 1
+        
+        pending = {}
+        with zipfile.ZipFile(out_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            if "html" in formats:
+                from plotly.offline import get_plotlyjs
+                archive.writestr(REPORT_PLOTLY_JS, get_plotlyjs())
+            for task in self.tasks(portfolio, country_ids, formats, currency, data, chunk_clients):
+                if os.path.exists(task["path"]):
+                    os.utime(task["path"])  # Недавнее использование для очистки кэша
+                    stats["cache_hits"] += 1
+                    add(archive, task, task["path"])
+                    continue
+                # Не больше 2 x workers задач в работе: память не растет с размером портфеля
+                while len(pending) >= 2 * self.workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        add(archive, pending.pop(future), future.result())
+                pending[self.pool().submit(render_report, task)] = {"client": task["client"], "format": task["format"]}
+                stats["rendered"] += 1
+            for future in list(pending):
+                add(archive, pending.pop(future), future.result())
+        
+        with self._lock:
+            self.counters["exports"] += 1
+            for name, value in stats.items():
+                self.counters[name] += value
+        self.prune()
+        return {**stats, "path": out_path}
+
+    def prune(self) -> int:
+        """Удаление давно не использованных отчетов сверх лимита кэша; возвращает число файлов"""
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir) if entry.is_file()]
+        except FileNotFoundError:
+            return 0
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        total, removed = 0, 0
+        for entry in entries:
+            total += entry.stat().st_size
+            if total > self.max_cache_bytes:
+                os.remove(entry.path)
+                removed += 1
+        return removed
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self.counters, "workers": self.workers, "formats": list(report_formats())}
+
+
+REPORTS = ReportExporter()
+
+# =========================
+# SESSION MEMORY (Учет памяти сессий и вытеснение неактивных)
+# =========================
+
+SESSION_IDLE_SECONDS = float(os.environ.get("VISATIER_SESSION_IDLE_SECONDS", "1800"))
+SESSION_CACHE_BYTES = int(os.environ.get("VISATIER_SESSION_CACHE_BYTES", str(1 << 20)))
+SESSION_MAX_SESSIONS = int(os.environ.get("VISATIER_MAX_SESSIONS", "2000"))
+SESSION_SWEEP_SECONDS = min(60.0, max(1.0, SESSION_IDLE_SECONDS / 4))
+
+
+class SessionCache:
+    """LRU-кэш одной сессии с ограничением по байтам"""
+
+    def __init__(self, max_bytes: int = SESSION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items: "OrderedDict[object, tuple]" = OrderedDict()  # key -> (value, size)
+        # Обработчики одной сессии выполняются параллельно (concurrency_limit=None)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, size: int) -> bool:
+        """False - значение больше всего лимита и не кэшируется"""
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._items[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._items.popitem(last=False)
+                self.nbytes -= evicted
+        return True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+
+@dataclass
+class SessionInfo:
+    started: float
+    last_seen: float
+    requests: int = 0
+    output_bytes: int = 0  # последние выходы, которые Gradio держит для сессии
+    cache: SessionCache = None
+
+
+# Внутренние атрибуты Gradio, через которые освобождается память брошенной сессии (проверены
+# на 4.44.1, 5.0-5.49 и 6.0-6.30). Публичные механизмы - TTL gr.State, unload и
+# state_session_capacity - не удаляют копию конфигурации сессии и ее почтовый ящик в очереди
+GRADIO_SESSION_INTERNALS = {
+    "state_holder": ("lock", "session_data", "time_last_used"),
+    "_queue": ("pending_event_ids_session", "pending_messages_per_session"),
+}
+
+
+class SessionRegistry:
+    """Учет памяти по сессиям; неактивные сессии освобождаются вместе с состоянием Gradio"""
+
+    def __init__(self, idle_seconds: float = SESSION_IDLE_SECONDS, cache_bytes: int = SESSION_CACHE_BYTES,
+                 max_sessions: int = SESSION_MAX_SESSIONS):
+        self.idle_seconds = idle_seconds
+        self.cache_bytes = cache_bytes
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, SessionInfo]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._blocks = None
+        self._internals = False  # True после check_gradio_internals без расхождений
+        self._sweeper = None
+        self._stop = threading.Event()
+        self.counters = {"evicted_idle": 0, "evicted_capacity": 0, "closed": 0}
+
+    def attach(self, blocks: gr.Blocks) -> None:
+        """Вытеснение также удаляет состояние сессии в StateHolder Gradio"""
+        self._blocks = blocks
+        blocks.state_session_capacity = self.max_sessions
+
+    def check_gradio_internals(self) -> List[str]:
+        """Проверка после монтирования приложения; при расхождении - предупреждение в журнал,
+        и сессии освобождают только публичные механизмы Gradio"""
+        missing = []
+        for owner, names in GRADIO_SESSION_INTERNALS.items():
+            target = getattr(self._blocks, owner, None)
+            if target is None:
+                missing.append(owner)
+            else:
+                missing += [f"{owner}.{name}" for name in names if not hasattr(target, name)]
+        self._internals = not missing
+        if missing:
+            EVENTS.emit("session_cleanup_degraded", gradio=gr.__version__, missing=missing,
+                        message=f"Gradio {gr.__version__} has no {', '.join(missing)}: idle sessions are released "
+                                f"only by gr.State TTL and state_session_capacity")
+        return missing
+
+    def touch(self, session_id: str, output_bytes: int = None) -> SessionInfo:
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            info = self._sessions.pop(session_id, None) or SessionInfo(started=now, last_seen=now)
+            info.last_seen = now
+            info.requests += 1
+            if output_bytes is not None:
+                info.output_bytes = output_bytes
+            self._sessions[session_id] = info
+            while len(self._sessions) > self.max_sessions:
+                evicted.append(self._sessions.popitem(last=False)[0])
+                self.counters["evicted_capacity"] += 1
+        for old_id in evicted:
+            self._release_gradio_state(old_id)
+        return info
+
+    def cache(self, session_id: str) -> SessionCache:
+        """Кэш сессии создается при первом обращении"""
+        info = self.touch(session_id)
+        with self._lock:
+            if info.cache is None:
+                info.cache = SessionCache(self.cache_bytes)
+            return info.cache
+
+    def drop(self, session_id: str) -> None:
+        """Вкладка закрыта - память сессии освобождается сразу"""
+        with self._lock:
+            if self._sessions.pop(session_id, None) is not None:
+                self.counters["closed"] += 1
+        self._release_gradio_state(session_id)
+
+    def _gradio_sessions(self) -> Dict:
+        return self._blocks.state_holder.time_last_used if self._internals else {}
+
+    def _release_gradio_state(self, session_id: str) -> None:
+        if not self._internals:
+            return
+        holder = self._blocks.state_holder
+        with holder.lock:
+            holder.session_data.pop(session_id, None)
+            holder.time_last_used.pop(session_id, None)
+        # Почтовый ящик сессии в очереди Gradio живет до отключения heartbeat,
+        # которого у брошенных вкладок и API-клиентов не бывает
+        queue = self._blocks._queue
+        if not queue.pending_event_ids_session.get(session_id):
+            queue.pending_event_ids_session.pop(session_id, None)
+            queue.pending_messages_per_session.pop(session_id, None)
+
+    def evict_idle(self) -> int:
+        """Освободить сессии без активности дольше idle_seconds (и наши, и только-Gradio)"""
+        now = time.monotonic()
+        with self._lock:
+            idle = [sid for sid, info in self._sessions.items() if now - info.last_seen > self.idle_seconds]
+            for sid in idle:
+                del self._sessions[sid]
+        # Сессии, которые видел только Gradio (загрузка страницы без расчетов)
+        cutoff = time.time() - self.idle_seconds
+        idle += [sid for sid, used in list(self._gradio_sessions().items())
+                 if used.timestamp() < cutoff and sid not in self._sessions]
+        idle = list(dict.fromkeys(idle))
+        for sid in idle:
+            self._release_gradio_state(sid)
+        with self._lock:
+            self.counters["evicted_idle"] += len(idle)
+        return len(idle)
+
+    def stats(self, top: int = 5) -> Dict:
+        with self._lock:
+            sessions = [(sid, info.output_bytes + (info.cache.nbytes if info.cache else 0), info)
+                        for sid, info in self._sessions.items()]
+            counters = dict(self.counters)
+        now = time.monotonic()
+        sessions.sort(key=lambda s: s[1], reverse=True)
+        return {
+            **counters,
+            "sessions": len(sessions),
+            "gradio_sessions": len(self._gradio_sessions()),
+            "gradio_internals": self._internals,
+            "tracked_bytes": sum(size for _, size, _ in sessions),
+            "cache_bytes": sum(info.cache.nbytes for _, _, info in sessions if info.cache),
+            "idle_seconds": self.idle_seconds,
+            "largest": [{"session": sid[:8], "bytes": size, "requests": info.requests,
+                         "idle_s": round(now - info.last_seen, 1)} for sid, size, info in sessions[:top]],
+        }
+
+    def _sweep(self):
+        while not self._stop.wait(SESSION_SWEEP_SECONDS):
+            self.evict_idle()
+
+    def start_sweeping(self) -> None:
+        if self._sweeper is None and self.idle_seconds > 0:
+            self._sweeper = threading.Thread(target=self._sweep, name="session-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def stop_sweeping(self) -> None:
+        self._stop.set()
+
+
+SESSIONS = SessionRegistry()
+
+
+def session_id(request: gr.Request) -> str:
+    return getattr(request, "session_hash", None) or "anonymous"
+
+# =========================
+# WORLD-CLASS APPLICATION (Исправленное)
+# =========================
+
+def profile_choices(snapshot: DataSnapshot, currency: str = BASE_CURRENCY) -> List[tuple]:
+    """Варианты выбора профиля в формате Gradio (label, value); кэш на снимке по валюте"""
+    labels = snapshot.__dict__.setdefault("_profile_choices", {})
+    if currency not in labels:
+        revenue = snapshot.profile_table["revenue"] * FX.rate(currency)
+        labels[currency] = [
+            (f"{profile.icon} {profile.name} - {format_money(amount, currency)}/month · {profile.margin}% margin", pid)
+            for (pid, profile), amount in zip(snapshot.profiles.items(), revenue)
+        ]
+    return labels[currency]
+
+
+def currency_choices() -> List[tuple]:
+    return [(f"{code} ({FX.symbol(code).strip()})", code) for code in FX.rates]
+
+
+def country_choices(snapshot: DataSnapshot) -> List[tuple]:
+    """Варианты выбора стран в формате Gradio (label, value)"""
+    return [(f"{v.flag} {v.name}", k) for k, v in snapshot.countries.items()]
+
 
 def create_world_class_app():
     """Создание исправленного приложения мирового класса"""
     
-    with gr.Blocks(css=WORLD_CLASS_CSS, title="VisaTier 4.0", theme=gr.themes.Soft()) as app:
+    DATA.start_watching()
+    SESSIONS.start_sweeping()
+    startup_data = DATA.snapshot()
+    
+    # Загруженные CSV удаляются вместе с неактивными сессиями
+    with gr.Blocks(title="VisaTier 4.0", delete_cache=(int(SESSION_SWEEP_SECONDS), int(SESSION_IDLE_SECONDS)),
+                   **(page_options() if PAGE_OPTIONS_IN_BLOCKS else {})) as app:
         
         # State management (исправленное управление состоянием)
-        selected_profile = gr.State("startup")
+        selected_profile = gr.State("startup", time_to_live=SESSION_IDLE_SECONDS)
+        # Результаты последнего расчета: ключ сценария и метрики по странам
+        scenario_state = gr.State(None, time_to_live=SESSION_IDLE_SECONDS)
         
         # Hero Section
         gr.HTML("""
@@ -896,8 +3354,7 @@ def create_world_class_app():
             
             # Используем обычный Radio вместо сложного HTML/JS
             profile_selector = gr.Radio(
-                choices=[(pid, f"{profile.icon} {profile.name} - €{profile.revenue:,}/month · {profile.margin}% margin") 
-                        for pid, profile in PROFILES.items()],
+                choices=profile_choices(startup_data),
                 value="startup",
                 label="Business Profile",
                 info="Choose the profile that best describes your business"
@@ -911,6 +3368,13 @@ def create_world_class_app():
             gr.HTML('<h3 class="section-title">Customize Your Analysis</h3>')
             
             with gr.Row(elem_classes=["input-row"]):
+                currency_selector = gr.Dropdown(
+                    choices=currency_choices(),
+                    value=BASE_CURRENCY,
+                    label="Currency",
+                    info=f"Reference rates as of {FX.as_of}"
+                )
+                
                 custom_revenue = gr.Number(
                     label="Monthly Revenue (€)",
                     value=None,
@@ -921,7 +3385,7 @@ def create_world_class_app():
                 )
                 
                 target_countries = gr.CheckboxGroup(
-                    choices=[(k, f"{v.flag} {v.name}") for k, v in COUNTRIES.items()],
+                    choices=country_choices(startup_data),
                     value=["UAE", "Singapore", "Estonia"],
                     label="Countries to Compare",
                     info="Select up to 4 countries for comparison"
@@ -935,6 +3399,18 @@ def create_world_class_app():
                 size="lg"
             )
         
+        # What-if: поверхность приходит с сервером при смене профиля/стран/валюты,
+        # ползунки пересчитывают полосы в браузере
+        with gr.Accordion("🎚️ Instant What-If", open=False):
+            gr.HTML('<p class="section-subtitle">Drag revenue and margin to see conservative ROI move '
+                    'instantly for the selected countries.</p>')
+            with gr.Row():
+                whatif_revenue = gr.Slider(label="Monthly Revenue", minimum=1000, maximum=1_000_000, step=100)
+                whatif_margin = gr.Slider(label="Profit Margin (%)", minimum=float(WHAT_IF_MARGINS[0]),
+                                          maximum=float(WHAT_IF_MARGINS[-1]), step=1)
+            whatif_bars = gr.HTML()
+            whatif_surface = gr.JSON(visible=False)
+        
         # Results Container (исправленный контейнер результатов)
         results_container = gr.Column(visible=False, elem_classes=["results-container"])
         
@@ -945,237 +3421,592 @@ def create_world_class_app():
             # Charts
             with gr.Row():
                 comparison_chart = gr.Plot(elem_classes=["chart-container"])
-                timeline_chart = gr.Plot(elem_classes=["chart-container"])
+                with gr.Column():
+                    # Временная шкала любой из рассчитанных стран строится по запросу
+                    timeline_country = gr.Dropdown(label="Cash Flow Timeline", choices=[], interactive=True)
+                    timeline_chart = gr.Plot(elem_classes=["chart-container"])
+                    driver_chart = gr.Plot(elem_classes=["chart-container"])
             
             # Recommendation
             recommendation_display = gr.HTML()
             
             # CTA Section
             cta_display = gr.HTML()
+            
+            # Постоянная ссылка на сценарий
+            permalink_display = gr.HTML()
+        
+        # Portfolio Analytics (анализ портфеля клиентов из CSV)
+        with gr.Accordion("📁 Client Portfolio Analytics", open=False):
+            gr.HTML('<p class="section-subtitle">Upload a CSV with columns <code>profile</code>, '
+                    '<code>revenue</code> (optional), <code>currency</code> (optional, default EUR) '
+                    'and <code>client_id</code> (optional). '
+                    'Every client is scored against the selected countries.</p>')
+            portfolio_file = gr.File(label="Client Book (CSV)", file_types=[".csv"], type="filepath")
+            portfolio_btn = gr.Button("📊 Analyze Portfolio", variant="secondary")
+            portfolio_status = gr.HTML()
+            portfolio_median_roi = gr.Dataframe(label="Median Conservative ROI (%) by Profile")
+            portfolio_fast_payback = gr.Dataframe(label="Clients with Payback under 24 Months (%)")
+            portfolio_best_country = gr.Dataframe(label="Best Country per Segment")
+            with gr.Row():
+                report_format = gr.CheckboxGroup(choices=list(report_formats()), value=["html"],
+                                                 label="Report Formats (offline)")
+                report_btn = gr.Button("📄 Export Client Reports", variant="secondary")
+            report_status = gr.HTML()
+            report_file = gr.File(label="Reports (ZIP)")
+        
+        # Multi-Stage Path (последовательность переездов)
+        with gr.Accordion("🧭 Multi-Stage Relocation Path", open=False):
+            gr.HTML('<p class="section-subtitle">Finds the best sequence of the selected countries and '
+                    'switch years, paying each setup cost on entry. Uses the profile, revenue and currency above.</p>')
+            with gr.Row():
+                path_years = gr.Slider(minimum=3, maximum=20, value=10, step=1, label="Planning Horizon (years)")
+                path_growth = gr.Number(label="Annual Revenue Growth (%)", value=20, minimum=-50, maximum=200)
+            path_btn = gr.Button("🧭 Find Best Path", variant="secondary")
+            path_summary = gr.HTML()
+            path_chart = gr.Plot(elem_classes=["chart-container"])
+        
+        # Holding / Residence (компания и резидентство в разных странах)
+        with gr.Accordion("🏛️ Company & Residence Structures", open=False):
+            gr.HTML('<p class="section-subtitle">Ranks every pairing of company country and residence country '
+                    'by conservative ROI. When they differ, both setup and living costs are paid.</p>')
+            structure_top = gr.Slider(minimum=3, maximum=25, value=10, step=1, label="Structures to Show")
+            structure_btn = gr.Button("🏛️ Rank Structures", variant="secondary")
+            structure_table = gr.Dataframe(label="Best Structures")
         
         # Функция обновления информации о профиле
-        def update_profile_info(profile_id):
+        def update_profile_info(profile_id, currency=BASE_CURRENCY):
             """Обновление информации о выбранном профиле"""
-            if profile_id not in PROFILES:
+            profiles = DATA.snapshot().profiles
+            if profile_id not in profiles or currency not in FX.rates:
                 return ""
             
-            profile = PROFILES[profile_id]
+            return HtmlFragments.profile_card(profiles[profile_id], currency)
+        
+        def error_response(message):
+            return [
+                gr.update(visible=False),
+                f"<div style='color: red; text-align: center; padding: 2rem;'>{message}</div>",
+                go.Figure(),
+                go.Figure(),
+                go.Figure(),
+                "",
+                "",
+                "",
+                gr.update(choices=[], value=None),
+                None
+            ]
+        
+        def permalink_html(key):
             return f"""
-            <div style="background: #f8f9fa; padding: 1rem; border-radius: 0.75rem; margin: 1rem 0;">
-                <h4 style="color: #333; margin-bottom: 0.5rem;">{profile.icon} {profile.name}</h4>
-                <p style="color: #666; margin-bottom: 0.75rem;">{profile.description}</p>
-                <div style="display: flex; gap: 1rem; flex-wrap: wrap;">
-                    <span style="background: #007AFF; color: white; padding: 0.25rem 0.75rem; border-radius: 0.5rem; font-size: 0.875rem;">
-                        Revenue: €{profile.revenue:,}/month
-                    </span>
-                    <span style="background: #34C759; color: white; padding: 0.25rem 0.75rem; border-radius: 0.5rem; font-size: 0.875rem;">
-                        Margin: {profile.margin}%
-                    </span>
-                    <span style="background: #FF9F0A; color: white; padding: 0.25rem 0.75rem; border-radius: 0.5rem; font-size: 0.875rem;">
-                        Risk: {profile.risk_level}
-                    </span>
-                </div>
+            <div class="guarantee-text" style="text-align: center;">
+                🔗 <a href="?scenario={key}">Permanent link to this analysis</a>
             </div>
             """
         
+        def outputs_size(outputs):
+            return sum(len(value.encode("utf-8")) for value in outputs.values())
+        
+        def timeline_selector(results, best_country, data):
+            """Выбор страны для временной шкалы: только рассчитанные страны"""
+            choices = [(f"{data.countries[c].flag} {data.countries[c].name}" if c in data.countries else c, c)
+                       for c in results]
+            return gr.update(choices=choices, value=best_country)
+        
+        def restore_scenario(stored):
+            """Восстановление сохраненного сценария без пересчета"""
+            outputs = stored["outputs"]
+            results = stored["results"]
+            best_country = max(results, key=lambda c: results[c]["conservative_roi"])
+            data = DATA.snapshot()
+            currency = stored["inputs"].get("currency", BASE_CURRENCY)
+            country = data.countries.get(best_country)
+            return (
+                gr.update(visible=True),
+                outputs["kpi_html"],
+                pio.from_json(outputs["comparison"]),
+                pio.from_json(outputs["timeline"]),
+                EliteChartBuilder.create_driver_waterfall(
+                    results[best_country], country.name if country else best_country, currency
+                ),
+                outputs["rec_html"],
+                outputs["cta_html"],
+                permalink_html(stored["key"]),
+                timeline_selector(results, best_country, data),
+                {"key": stored["key"], "results": results, "currency": currency}
+            )
+        
+        # Допуск к расчету: при исчерпании слотов - быстрый отказ вместо ожидания
+        def calculate_world_class_roi(profile_id, revenue, countries, currency, request: gr.Request):
+            """Расчет ROI под глобальным лимитом параллельности; каждый расчет - запись в журнале"""
+            started = time.perf_counter()
+            record = {"profile": profile_id, "revenue": revenue, "countries": list(countries or []),
+                      "currency": currency, "best_country": None, "cached": False, "error": None}
+            try:
+                if not ADMISSION.try_start():
+                    record["error"] = "busy"
+                    return error_response("The calculator is busy right now. Please try again in a few seconds.")
+                try:
+                    return run_calculation(profile_id, revenue, countries, currency, session_id(request), record)
+                finally:
+                    ADMISSION.finish()
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                EVENTS.emit("calculation", latency_ms=round((time.perf_counter() - started) * 1000, 2), **record)
+        
         # Main calculation function (исправленная функция расчета)
-        def calculate_world_class_roi(profile_id, revenue, countries):
-            """Исправленный расчет ROI с улучшенной обработкой ошибок"""
+        def run_calculation(profile_id, revenue, countries, currency=BASE_CURRENCY, session="anonymous",
+                            record=None):
+            """Исправленный расчет ROI с улучшенной обработкой ошибок; итог пишется в record"""
+            record = {} if record is None else record
+            
+            def fail(message):
+                record["error"] = message
+                return error_response(message)
+            
+            # Один снимок данных на весь запрос
+            data = DATA.snapshot()
+            usage = SESSIONS.touch(session)
+            record["data_version"] = data.version
             
             # Валидация входных данных
-            if not profile_id or profile_id not in PROFILES:
-                return [
-                    gr.update(visible=False),
-                    "<div style='color: red; text-align: center; padding: 2rem;'>Please select a valid business profile.</div>",
-                    go.Figure(),
-                    go.Figure(),
-                    "",
-                    ""
-                ]
+            if not profile_id or profile_id not in data.profiles:
+                return fail("Please select a valid business profile.")
             
             if not countries:
-                return [
-                    gr.update(visible=False),
-                    "<div style='color: red; text-align: center; padding: 2rem;'>Please select at least one country to compare.</div>",
-                    go.Figure(),
-                    go.Figure(),
-                    "",
-                    ""
-                ]
+                return fail("Please select at least one country to compare.")
+            
+            currency = currency or BASE_CURRENCY
+            if currency not in FX.rates:
+                return fail(f"Unsupported currency {currency}.")
             
-            profile = PROFILES[profile_id]
+            # Сценарий уже рассчитывался на этой версии данных
+            key = scenario_key(profile_id, revenue, countries, data.version, currency)
+            stored = SCENARIOS.get(key)
+            if stored is not None:
+                usage.output_bytes = outputs_size(stored["outputs"])
+                results = stored["results"]
+                record.update(cached=True, best_country=max(results, key=lambda c: results[c]["conservative_roi"]))
+                return restore_scenario(stored)
+            
+            profile = data.profiles[profile_id]
             calculator = WorldClassROICalculator()
             results = {}
+            # Расчет в EUR: выручка переводится на входе, результаты - один раз на выходе
+            revenue_eur = float(FX.to_base(revenue, currency)) if revenue else revenue
             
             # Calculate for each country
             for country_id in countries:
-                if country_id in COUNTRIES:
-                    country = COUNTRIES[country_id]
+                if country_id in data.countries:
+                    country = data.countries[country_id]
                     try:
                         results[country_id] = calculator.calculate_comprehensive_roi(
-                            profile, country, revenue
+                            profile, country, revenue_eur
                         )
                     except Exception as e:
-                        print(f"Error calculating ROI for {country_id}: {e}")
+                        EVENTS.emit("country_calculation_failed", profile=profile_id, country=country_id,
+                                    error=f"{type(e).__name__}: {e}",
+                                    message=f"Error calculating ROI for {country_id}: {e}")
                         continue
             
             if not results:
-                return [
-                    gr.update(visible=False),
-                    "<div style='color: red; text-align: center; padding: 2rem;'>Unable to calculate results. Please check your inputs.</div>",
-                    go.Figure(),
-                    go.Figure(),
-                    "",
-                    ""
-                ]
+                return fail("Unable to calculate results. Please check your inputs.")
+            results = convert_results(results, currency)
             
             # Find best option
             best_country = max(results.keys(), key=lambda c: results[c]["conservative_roi"])
+            record["best_country"] = best_country
             best_result = results[best_country]
-            best_country_data = COUNTRIES[best_country]
-            
-            # Generate KPI Dashboard
-            roi_status = "success" if best_result["conservative_roi"] > 150 else "warning" if best_result["conservative_roi"] > 75 else "error"
-            payback_str = f"{best_result['payback_months']:.0f}" if best_result['payback_months'] < 120 else "120+"
+            best_country_data = data.countries[best_country]
             
-            kpi_html = f"""
-            <div class="kpi-grid">
-                <div class="kpi-card {roi_status}">
-                    <div class="kpi-label">Conservative ROI</div>
-                    <div class="kpi-value">{best_result['conservative_roi']:.0f}%</div>
-                    <div class="kpi-note">5-year risk-adjusted return</div>
-                </div>
-                <div class="kpi-card">
-                    <div class="kpi-label">Annual Savings</div>
-                    <div class="kpi-value">€{best_result['annual_savings']:,.0f}</div>
-                    <div class="kpi-note">Per year after relocation</div>
-                </div>
-                <div class="kpi-card">
-                    <div class="kpi-label">Payback Period</div>
-                    <div class="kpi-value">{payback_str}</div>
-                    <div class="kpi-note">Months to break even</div>
-                </div>
-                <div class="kpi-card">
-                    <div class="kpi-label">Confidence Score</div>
-                    <div class="kpi-value">{best_result['confidence_score']:.0f}/100</div>
-                    <div class="kpi-note">Success probability rating</div>
-                </div>
-            </div>
-            """
+            # KPI, рекомендация и CTA из предкомпилированных шаблонов
+            kpi_html, rec_html, cta_html = HtmlFragments.render_results(
+                best_result, best_country_data, profile, currency
+            )
             
             # Generate Charts
             comparison = EliteChartBuilder.create_executive_dashboard(results, countries)
             timeline = EliteChartBuilder.create_timeline_visualization(
-                best_result, best_country_data.name
+                best_result, best_country_data.name, currency
             )
+            drivers = EliteChartBuilder.create_driver_waterfall(best_result, best_country_data.name, currency)
             
-            # Generate Recommendation
-            rec_html = f"""
-            <div class="recommendation-card">
-                <div class="recommendation-header">
-                    <div class="recommendation-icon">🏆</div>
-                    <div class="recommendation-title">Recommended: {best_country_data.name}</div>
-                </div>
-                <div class="recommendation-content">
-                    <strong>{best_country_data.key_benefit}</strong><br>
-                    {best_country_data.why_good}
-                    <br><br>
-                    <strong>For {profile.name}s:</strong> {best_result['conservative_roi']:.0f}% conservative ROI 
-                    with {best_result['payback_months']:.0f}-month payback period.
-                </div>
-            </div>
-            """
-            
-            # Generate CTA based on ROI performance
-            if best_result['conservative_roi'] > 200:
-                price_old = "€2,497"
-                price_new = "€1,497"
-                title = f"Complete {best_country_data.name} Relocation Concierge"
-                description = "White-glove service with personal immigration lawyer, tax optimization, and 12-month support"
-            elif best_result['conservative_roi'] > 100:
-                price_old = "€997"
-                price_new = "€497"
-                title = f"{best_country_data.name} Business Migration Blueprint"
-                description = "Comprehensive guide with legal requirements, tax strategies, and step-by-step timeline"
-            else:
-                price_old = "€297"
-                price_new = "€97"
-                title = f"{best_country_data.name} Exploration Package"
-                description = "Essential information to evaluate your relocation opportunity"
-            
-            cta_html = f"""
-            <div class="cta-section">
-                <div class="value-badge">Limited Time: 40% Off</div>
-                <h3 class="cta-title">{title}</h3>
-                <p class="cta-description">{description}</p>
-                
-                <div class="price-container">
-                    <span class="price-old">{price_old}</span>
-                    <span class="price-new">{price_new}</span>
-                </div>
-                
-                <button class="cta-button">Get Your Migration Plan</button>
-                
-                <div class="guarantee-text">
-                    30-day money-back guarantee • Secure payment • Instant access
-                </div>
-            </div>
-            """
+            outputs = {
+                "kpi_html": kpi_html,
+                "comparison": comparison.to_json(),
+                "timeline": timeline.to_json(),
+                "rec_html": rec_html,
+                "cta_html": cta_html,
+            }
+            sizes = {name: len(value.encode("utf-8")) for name, value in outputs.items()}
+            # Водопад не сохраняется в сценарии: он строится из результатов при восстановлении
+            sizes["drivers"] = len(drivers.to_json())
+            PAYLOAD_BUDGET.check("calculate", sizes)
+            usage.output_bytes = sum(sizes.values())
+            SESSIONS.cache(session).put(("timeline", key, best_country), (timeline, drivers),
+                                        sizes["timeline"] + sizes["drivers"])
+            SCENARIOS.put(
+                key, data.version,
+                inputs={"profile_id": profile_id, "revenue": revenue, "countries": list(countries),
+                        "currency": currency},
+                results=results,
+                outputs=outputs
+            )
             
             return (
                 gr.update(visible=True),
                 kpi_html,
                 comparison,
                 timeline,
+                drivers,
                 rec_html,
-                cta_html
+                cta_html,
+                permalink_html(key),
+                timeline_selector(results, best_country, data),
+                {"key": key, "results": results, "currency": currency}
+            )
+        
+        # Временная шкала и водопад факторов выбранной страны: метрики берутся из результатов
+        # расчета, готовые графики кэшируются в сессии по (сценарий, страна)
+        def select_timeline(country_id, scenario, request: gr.Request):
+            if not scenario or country_id not in scenario["results"]:
+                return gr.update(), gr.update()
+            cache = SESSIONS.cache(session_id(request))
+            cache_key = ("timeline", scenario["key"], country_id)
+            figures = cache.get(cache_key)
+            if figures is None:
+                country = DATA.snapshot().countries.get(country_id)
+                name = country.name if country else country_id
+                currency = scenario.get("currency", BASE_CURRENCY)
+                figures = (
+                    EliteChartBuilder.create_timeline_visualization(scenario["results"][country_id], name, currency),
+                    EliteChartBuilder.create_driver_waterfall(scenario["results"][country_id], name, currency),
+                )
+                cache.put(cache_key, figures, sum(len(figure.to_json()) for figure in figures))
+            return figures
+        
+        # Анализ загруженного портфеля клиентов
+        def analyze_uploaded_portfolio(path, countries):
+            empty = (None, None, None)
+            if not path:
+                return ("<div style='color: red; text-align: center;'>Please upload a CSV file.</div>", *empty)
+            if not countries:
+                return ("<div style='color: red; text-align: center;'>Please select at least one country to compare.</div>", *empty)
+            data = DATA.snapshot()
+            started = time.perf_counter()
+            try:
+                portfolio = read_portfolio_csv(path)
+                summary = analyze_portfolio(portfolio, [c for c in countries if c in data.countries], data)
+            except (ValueError, KeyError, pd.errors.ParserError) as e:
+                return (f"<div style='color: red; text-align: center;'>{e}</div>", *empty)
+            elapsed = time.perf_counter() - started
+            status = (f"<div class='guarantee-text' style='text-align: center;'>"
+                      f"{len(portfolio):,} clients × {len(countries)} countries scored in {elapsed:.2f}s</div>")
+            return (
+                status,
+                summary["median_roi"].reset_index(),
+                summary["fast_payback_share"].reset_index(),
+                summary["best_by_segment"].reset_index()
+            )
+        
+        def export_client_reports(path, countries, formats, currency):
+            if not path:
+                return "<div style='color: red; text-align: center;'>Please upload a CSV file.</div>", None
+            data = DATA.snapshot()
+            countries = [c for c in (countries or []) if c in data.countries]
+            if not countries or not formats:
+                return ("<div style='color: red; text-align: center;'>Please select at least one country "
+                        "and one report format.</div>", None)
+            started = time.perf_counter()
+            out_path = os.path.join(tempfile.mkdtemp(prefix="visatier-reports-"), "visatier_reports.zip")
+            try:
+                stats = REPORTS.export(read_portfolio_csv(path), countries, out_path, formats,
+                                       currency if currency in FX.rates else BASE_CURRENCY, data)
+            except (ValueError, KeyError, pd.errors.ParserError) as e:
+                return f"<div style='color: red; text-align: center;'>{e}</div>", None
+            status = (f"<div class='guarantee-text' style='text-align: center;'>{stats['reports']:,} reports "
+                      f"({stats['cache_hits']:,} from cache) in {time.perf_counter() - started:.1f}s</div>")
+            return status, out_path
+        
+        def update_what_if(profile_id, countries, currency, revenue):
+            data = DATA.snapshot()
+            countries = [c for c in (countries or []) if c in data.countries]
+            if profile_id not in data.profiles:
+                return None, gr.update(), gr.update()
+            currency = currency if currency in FX.rates else BASE_CURRENCY
+            profile = data.profiles[profile_id]
+            surface = response_surface(profile, data, countries, currency)
+            PAYLOAD_BUDGET.check("what_if", {"surface": len(json.dumps(surface, separators=(",", ":")))})
+            low, high = surface["revenue"][0], surface["revenue"][-1]
+            value = min(max(revenue or profile.revenue * FX.rate(currency), low), high)
+            return (
+                surface,
+                gr.update(minimum=low, maximum=high, value=value, label=f"Monthly Revenue ({currency})"),
+                gr.update(value=profile.margin),
+            )
+        
+        # Оптимальная последовательность переездов
+        def plan_relocation_path(profile_id, revenue, countries, currency, years, growth):
+            data = DATA.snapshot()
+            countries = [c for c in (countries or []) if c in data.countries]
+            if profile_id not in data.profiles or not countries:
+                return "<div style='color: red; text-align: center;'>Please select a profile and at least one country.</div>", None
+            currency = currency if currency in FX.rates else BASE_CURRENCY
+            revenue_eur = float(FX.to_base(revenue, currency)) if revenue else None
+            plan = RelocationPathOptimizer.optimize(
+                data.profiles[profile_id], data, countries, int(years), revenue_eur, (growth or 0) / 100
+            )
+            rate = FX.rate(currency)
+            
+            def label(state):
+                return "🇪🇺 Stay in EU" if state == HOME_STATE else \
+                    f"{data.countries[state].flag} {data.countries[state].name}"
+            
+            rows = "".join(
+                f"<li><strong>{label(stage['country'])}</strong> · "
+                + (f"year {stage['from_year']}" if stage["from_year"] == stage["to_year"]
+                   else f"years {stage['from_year']}–{stage['to_year']}")
+                + (f" · setup {format_money(stage['setup_cost'] * rate, currency)}"
+                   if stage["country"] != HOME_STATE else "")
+                + f" · benefit {format_money(stage['benefit'] * rate, currency)}</li>"
+                for stage in plan["stages"]
+            )
+            if plan["stay"]:
+                comparison = f"No move pays off over {plan['years']} years; staying in the EU is the best option"
+            elif plan["best_single_country"] == HOME_STATE:
+                comparison = (f"{format_money(plan['gain_vs_single_move'] * rate, currency)} more than staying "
+                              f"in the EU; no single move pays off")
+            else:
+                comparison = (f"{format_money(plan['gain_vs_single_move'] * rate, currency)} more than moving once "
+                              f"to {label(plan['best_single_country'])}")
+            summary = (
+                f"<div class='recommendation-card'><div class='recommendation-title'>"
+                f"Net benefit over {plan['years']} years: {format_money(plan['total_benefit'] * rate, currency)}</div>"
+                f"<ol>{rows}</ol><div class='guarantee-text'>{comparison}</div></div>"
+            )
+            chart = EliteChartBuilder.create_path_chart(
+                (np.asarray(plan["cumulative"]) * rate).tolist(),
+                [label(state) for state in plan["path"]], currency
             )
+            return summary, chart
+        
+        def rank_structures(profile_id, revenue, currency, top):
+            data = DATA.snapshot()
+            if profile_id not in data.profiles:
+                return None
+            currency = currency if currency in FX.rates else BASE_CURRENCY
+            revenue_eur = float(FX.to_base(revenue, currency)) if revenue else None
+            table = top_structures(data.profiles[profile_id], data, k=int(top), custom_revenue=revenue_eur)
+            
+            def label(country_id):
+                return f"{data.countries[country_id].flag} {data.countries[country_id].name}"
+            
+            rate = FX.rate(currency)
+            return pd.DataFrame({
+                "Company": table["corp_country"].map(label),
+                "Residence": table["residence_country"].map(label),
+                "Conservative ROI (%)": table["conservative_roi"].round(1),
+                f"Annual Savings ({currency})": (table["annual_savings"] * rate).round(0),
+                "Payback (months)": table["payback_months"].round(1),
+                f"Setup Cost ({currency})": (table["setup_cost"] * rate).round(0),
+                "Success (%)": table["success_probability"].round(0),
+            })
         
         # Event handlers (исправленные обработчики событий)
         
         # Обновление информации о профиле при его изменении
         profile_selector.change(
             update_profile_info,
-            inputs=[profile_selector],
+            inputs=[profile_selector, currency_selector],
             outputs=[profile_info]
         )
         
         # Обновление плейсхолдера дохода при изменении профиля
-        def update_revenue_placeholder(profile_id):
-            if profile_id in PROFILES:
+        def update_revenue_placeholder(profile_id, currency=BASE_CURRENCY):
+            profiles = DATA.snapshot().profiles
+            if profile_id in profiles and currency in FX.rates:
+                default = format_money(profiles[profile_id].revenue * FX.rate(currency), currency)
                 return gr.update(
-                    placeholder=f"Default: €{PROFILES[profile_id].revenue:,}",
-                    info=f"Your current monthly business revenue (default: €{PROFILES[profile_id].revenue:,})"
+                    label=f"Monthly Revenue ({FX.symbol(currency).strip()})",
+                    placeholder=f"Default: {default}",
+                    info=f"Your current monthly business revenue (default: {default})"
                 )
             return gr.update()
         
         profile_selector.change(
             update_revenue_placeholder,
-            inputs=[profile_selector],
+            inputs=[profile_selector, currency_selector],
             outputs=[custom_revenue]
         )
         
+        # Смена валюты: подписи профилей, карточка и плейсхолдер в новой валюте
+        def update_currency_labels(profile_id, currency):
+            if currency not in FX.rates:
+                return gr.update(), gr.update(), gr.update()
+            return (
+                gr.update(choices=profile_choices(DATA.snapshot(), currency)),
+                update_profile_info(profile_id, currency),
+                update_revenue_placeholder(profile_id, currency)
+            )
+        
+        currency_selector.change(
+            update_currency_labels,
+            inputs=[profile_selector, currency_selector],
+            outputs=[profile_selector, profile_info, custom_revenue]
+        )
+        
         # Основной расчет
         calculate_btn.click(
             calculate_world_class_roi,
-            inputs=[profile_selector, custom_revenue, target_countries],
+            inputs=[profile_selector, custom_revenue, target_countries, currency_selector],
             outputs=[
                 results_container,
                 kpi_display,
                 comparison_chart,
                 timeline_chart,
+                driver_chart,
                 recommendation_display,
-                cta_display
-            ]
+                cta_display,
+                permalink_display,
+                timeline_country,
+                scenario_state
+            ],
+            api_name="calculate",
+            concurrency_limit=None  # Параллельность ограничивает ADMISSION
+        )
+        
+        portfolio_btn.click(
+            analyze_uploaded_portfolio,
+            inputs=[portfolio_file, target_countries],
+            outputs=[portfolio_status, portfolio_median_roi, portfolio_fast_payback, portfolio_best_country]
+        )
+        
+        report_btn.click(
+            export_client_reports,
+            inputs=[portfolio_file, target_countries, report_format, currency_selector],
+            outputs=[report_status, report_file]
+        )
+        
+        path_btn.click(
+            plan_relocation_path,
+            inputs=[profile_selector, custom_revenue, target_countries, currency_selector, path_years, path_growth],
+            outputs=[path_summary, path_chart],
+            api_name="relocation_path"
+        )
+        
+        structure_btn.click(
+            rank_structures,
+            inputs=[profile_selector, custom_revenue, currency_selector, structure_top],
+            outputs=[structure_table],
+            api_name="structures"
+        )
+        
+        # Поверхность пересчитывается сервером только при смене профиля, стран или валюты;
+        # ползунки перерисовывают полосы и ROI-трассы панели в браузере
+        what_if_inputs = [whatif_surface, whatif_revenue, whatif_margin, comparison_chart]
+        what_if_outputs = [whatif_bars, comparison_chart]
+        for trigger in (profile_selector.change, target_countries.change, currency_selector.change, app.load):
+            trigger(
+                update_what_if,
+                inputs=[profile_selector, target_countries, currency_selector, custom_revenue],
+                outputs=[whatif_surface, whatif_revenue, whatif_margin],
+                api_name=False
+            ).then(None, inputs=what_if_inputs, outputs=what_if_outputs, js=WHAT_IF_JS)
+        for slider in (whatif_revenue, whatif_margin):
+            slider.input(None, inputs=what_if_inputs, outputs=what_if_outputs, js=WHAT_IF_JS)
+        
+        # Только действия пользователя: выбор, выставленный расчетом, не перестраивает график
+        timeline_country.input(
+            select_timeline,
+            inputs=[timeline_country, scenario_state],
+            outputs=[timeline_chart, driver_chart]
         )
         
         # Инициализация интерфейса при загрузке
         app.load(
             update_profile_info,
-            inputs=[profile_selector],
+            inputs=[profile_selector, currency_selector],
             outputs=[profile_info]
         )
         
+        # Новая вкладка получает списки из актуального снимка данных,
+        # постоянная ссылка ?scenario=<key> открывается без пересчета
+        def initialize_session(profile_id, countries, currency, request: gr.Request):
+            data = DATA.snapshot()
+            key = request.query_params.get("scenario") if request else None
+            stored = SCENARIOS.get(key) if key else None
+            if stored is not None:
+                inputs = stored["inputs"]
+                profile_id, countries = inputs["profile_id"], inputs["countries"]
+                currency = inputs.get("currency", BASE_CURRENCY)
+                restored = (gr.update(value=inputs["revenue"]), gr.update(value=currency),
+                            *restore_scenario(stored))
+                SESSIONS.touch(session_id(request), outputs_size(stored["outputs"]))
+            else:
+                restored = (gr.update(),) * 12
+                SESSIONS.touch(session_id(request))
+            return (
+                gr.update(choices=profile_choices(data, currency if currency in FX.rates else BASE_CURRENCY),
+                          value=profile_id if profile_id in data.profiles else next(iter(data.profiles))),
+                gr.update(choices=country_choices(data),
+                          value=[c for c in (countries or []) if c in data.countries]),
+                *restored
+            )
+        
+        app.load(
+            initialize_session,
+            inputs=[profile_selector, target_countries, currency_selector],
+            outputs=[
+                profile_selector,
+                target_countries,
+                custom_revenue,
+                currency_selector,
+                results_container,
+                kpi_display,
+                comparison_chart,
+                timeline_chart,
+                driver_chart,
+                recommendation_display,
+                cta_display,
+                permalink_display,
+                timeline_country,
+                scenario_state
+            ]
+        )
+        
+        # Открытые вкладки подхватывают профили и страны горячей перезагрузки без перезагрузки страницы
+        data_version = gr.State(startup_data.version, time_to_live=SESSION_IDLE_SECONDS)
+        choices_timer = gr.Timer(CHOICES_REFRESH_SECONDS, active=CHOICES_REFRESH_SECONDS > 0)
+        
+        def refresh_choices(version, profile_id, countries, currency):
+            data = DATA.snapshot()
+            if version == data.version:
+                return gr.update(), gr.update(), gr.update()
+            countries = countries or []
+            valid = [c for c in countries if c in data.countries]
+            return (
+                data.version,
+                gr.update(choices=profile_choices(data, currency if currency in FX.rates else BASE_CURRENCY),
+                          **({} if profile_id in data.profiles else {"value": next(iter(data.profiles))})),
+                gr.update(choices=country_choices(data), **({} if valid == countries else {"value": valid}))
+            )
+        
+        choices_timer.tick(
+            refresh_choices,
+            inputs=[data_version, profile_selector, target_countries, currency_selector],
+            outputs=[data_version, profile_selector, target_countries],
+            show_progress="hidden",
+            api_name=False
+        )
+        
+        # Закрытая вкладка освобождает состояние сессии, не дожидаясь тайм-аута
+        def release_session(request: gr.Request):
+            SESSIONS.drop(session_id(request))
+        
+        app.unload(release_session)
+        
         # World-class footer
         gr.HTML("""
         <div class="footer">
@@ -1191,17 +4022,645 @@ def create_world_class_app():
         </div>
         """)
     
+    # Глубокая очередь отклоняется сразу, а не копит задержку для всех
+    app.queue(max_size=ADMISSION_QUEUE_MAX_SIZE)
+    SESSIONS.attach(app)
     return app
 
+# =========================
+# RESPONSE COMPRESSION & PAYLOAD BUDGET (Сжатие и бюджет ответа)
+# =========================
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+COMPRESSION_MIN_BYTES = 500
+PAYLOAD_BUDGET_BYTES = int(os.environ.get("VISATIER_PAYLOAD_BUDGET_BYTES", "16000"))
+
+
+class CompressionMiddleware:
+    """ASGI-сжатие br/gzip по Accept-Encoding, включая потоковые ответы (SSE очереди Gradio).
+
+    Каждый фрагмент потока сбрасывается компрессором сразу, поэтому события
+    доходят до клиента без задержки.
+    """
+
+    def __init__(self, app, min_bytes: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.min_bytes = min_bytes
+
+    @staticmethod
+    def negotiate(accept_encoding: str) -> str:
+        """br или gzip по Accept-Encoding; кодировки с q=0 (в любой записи) отклонены клиентом"""
+        offered = set()
+        for part in accept_encoding.split(","):
+            name, *params = [item.strip() for item in part.split(";")]
+            weight = next((param[2:] for param in params if param.lower().startswith("q=")), "1")
+            try:
+                if float(weight) > 0:
+                    offered.add(name.lower())
+            except ValueError:
+                continue
+        if brotli is not None and "br" in offered:
+            return "br"
+        if "gzip" in offered:
+            return "gzip"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        encoding = self.negotiate(headers.get(b"accept-encoding", b"").decode("latin-1"))
+        if encoding is None:
+            return await self.app(scope, receive, send)
+        
+        compressor = None
+        
+        async def send_compressed(message):
+            nonlocal compressor
+            if message["type"] == "http.response.start":
+                response_headers = [(k.lower(), v) for k, v in message.get("headers", [])]
+                lookup = dict(response_headers)
+                content_type = lookup.get(b"content-type", b"").decode("latin-1")
+                length = lookup.get(b"content-length")
+                if (b"content-encoding" not in lookup
+                        and content_type.startswith(COMPRESSIBLE_TYPES)
+                        and (length is None or int(length) >= self.min_bytes)
+                        and message.get("status", 200) not in (204, 304)):
+                    compressor = brotli.Compressor(quality=5) if encoding == "br" else \
+                        zlib.compressobj(6, zlib.DEFLATED, 31)
+                    response_headers = [(k, v) for k, v in response_headers if k != b"content-length"]
+                    response_headers += [(b"content-encoding", encoding.encode()), (b"vary", b"Accept-Encoding")]
+                    message = {**message, "headers": response_headers}
+            elif message["type"] == "http.response.body" and compressor is not None:
+                body = message.get("body", b"")
+                more = message.get("more_body", False)
+                if encoding == "br":
+                    chunk = compressor.process(body) + (compressor.flush() if more else compressor.finish())
+                else:
+                    chunk = compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH if more else zlib.Z_FINISH)
+                message = {**message, "body": chunk}
+            await send(message)
+        
+        await self.app(scope, receive, send_compressed)
+
+
+class PayloadBudget:
+    """Учет размера ответов обработчиков; превышение бюджета логируется"""
+
+    def __init__(self, budget_bytes: int = PAYLOAD_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self.responses = 0
+        self.over_budget = 0
+        self.max_bytes = 0
+
+    def check(self, endpoint: str, parts: Dict[str, int]) -> int:
+        total = sum(parts.values())
+        self.responses += 1
+        self.max_bytes = max(self.max_bytes, total)
+        if total > self.budget_bytes:
+            self.over_budget += 1
+            breakdown = ", ".join(f"{name}={size:,}" for name, size in sorted(parts.items(), key=lambda p: -p[1]))
+            EVENTS.emit("payload_over_budget", endpoint=endpoint, bytes=total, parts=parts,
+                        message=f"Payload budget exceeded on {endpoint}: {total:,} > {self.budget_bytes:,} bytes ({breakdown})")
+        return total
+
+
+PAYLOAD_BUDGET = PayloadBudget()
+
+# =========================
+# ADMISSION CONTROL (Ограничение частоты и параллельности расчетов)
+# =========================
+
+ADMISSION_RATE_PER_MINUTE = float(os.environ.get("VISATIER_RATE_PER_MINUTE", "30"))
+ADMISSION_BURST = float(os.environ.get("VISATIER_RATE_BURST", "10"))
+ADMISSION_MAX_CONCURRENT = int(os.environ.get("VISATIER_MAX_CONCURRENT", "8"))
+ADMISSION_TRUST_PROXY = os.environ.get("VISATIER_TRUST_PROXY", "0") == "1"
+ADMISSION_QUEUE_MAX_SIZE = int(os.environ.get("VISATIER_QUEUE_MAX_SIZE", "64"))
+ADMISSION_MAX_CLIENTS = 10_000
+
+
+class AdmissionController:
+    """Token bucket на клиента + глобальный лимит одновременных расчетов, без внешних сервисов"""
+
+    def __init__(self, rate_per_minute: float = ADMISSION_RATE_PER_MINUTE, burst: float = ADMISSION_BURST,
+                 max_concurrent: int = ADMISSION_MAX_CONCURRENT, max_clients: int = ADMISSION_MAX_CLIENTS):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()  # client -> [tokens, updated]
+        self._active = 0
+        self._lock = threading.Lock()
+        self.counters = {"admitted": 0, "rate_limited": 0, "overloaded": 0}
+
+    def allow(self, client_id: str) -> bool:
+        """Списать токен клиента; False - превышен лимит частоты"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client_id, None) or [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            allowed = bucket[0] >= 1
+            if allowed:
+                bucket[0] -= 1
+            else:
+                self.counters["rate_limited"] += 1
+            # LRU: давно неактивные клиенты вытесняются
+            self._buckets[client_id] = bucket
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return allowed
+
+    def try_start(self) -> bool:
+        """Неблокирующий захват слота расчета; при перегрузке - немедленный отказ"""
+        with self._lock:
+            if self._active >= self.max_concurrent:
+                self.counters["overloaded"] += 1
+                return False
+            self._active += 1
+            self.counters["admitted"] += 1
+            return True
+
+    def finish(self) -> None:
+        with self._lock:
+            self._active -= 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {**self.counters, "active": self._active, "tracked_clients": len(self._buckets)}
+
+
+ADMISSION = AdmissionController()
+
+
+class AdmissionMiddleware:
+    """Проверка лимита частоты до постановки запроса расчета в очередь Gradio"""
+
+    def __init__(self, app, controller: AdmissionController, fn_indices: set, api_names: set):
+        self.app = app
+        self.controller = controller
+        self.fn_indices = fn_indices
+        self.api_paths = tuple(f"/{prefix}/{name}" for name in api_names for prefix in ("call", "run", "api"))
+
+    def client_id(self, scope) -> str:
+        if ADMISSION_TRUST_PROXY:
+            for key, value in scope.get("headers") or []:
+                if key == b"x-forwarded-for":
+                    return value.decode("latin-1").split(",")[0].strip()
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        path = scope["path"].rstrip("/")
+        guarded = path.endswith(self.api_paths)
+        if not guarded and path.endswith("/queue/join"):
+            # Тело нужно прочитать, чтобы узнать fn_index, и затем отдать приложению повторно
+            messages = []
+            while True:
+                message = await receive()
+                messages.append(message)
+                if not message.get("more_body"):
+                    break
+            try:
+                guarded = json.loads(b"".join(m.get("body", b"") for m in messages)).get("fn_index") in self.fn_indices
+            except (ValueError, AttributeError):
+                guarded = False
+            pending = iter(messages)
+            
+            async def replay():
+                return next(pending, None) or await receive()
+            
+            receive = replay
+        if guarded and not self.controller.allow(client := self.client_id(scope)):
+            EVENTS.emit("rate_limited", client=client, path=path)
+            retry_after = str(max(1, math.ceil(1 / self.controller.rate))) if self.controller.rate > 0 else "60"
+            response = JSONResponse({"detail": "Too many calculations, please slow down."},
+                                    status_code=429, headers={"Retry-After": retry_after})
+            return await response(scope, receive, send)
+        return await self.app(scope, receive, send)
+
+# =========================
+# WARM-UP & READINESS (Прогрев при запуске)
+# =========================
+
+class Readiness:
+    """Состояние прогрева для /readyz"""
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.started_at = None
+        self.warmup_seconds = None
+        self.error = None
+
+    def status(self) -> Dict:
+        return {
+            "ready": self.ready.is_set(),
+            "warmup_seconds": self.warmup_seconds,
+            "data_version": DATA.snapshot().version,
+            "error": self.error,
+        }
+
+
+READINESS = Readiness()
+
+
+def warm_up(snapshot: DataSnapshot = None) -> float:
+    """Прогон калькулятора, обоих графиков, сериализации и HTML-кэшей для каждого профиля"""
+    started = time.perf_counter()
+    data = snapshot or DATA.snapshot()
+    country_ids = list(data.countries)
+    plot = gr.Plot(render=False)
+    SCENARIOS.get("warm-up")  # Открытие SQLite и создание схемы
+    for profile in data.profiles.values():
+        HtmlFragments.profile_card(profile)
+        results = {
+            cid: WorldClassROICalculator.calculate_comprehensive_roi(profile, country)
+            for cid, country in data.countries.items()
+        }
+        for cid, country in data.countries.items():
+            HtmlFragments.recommendation_head(country, profile)
+            for tier in HtmlFragments.CTA_TIERS:
+                HtmlFragments.cta(country, tier)
+        comparison = EliteChartBuilder.create_executive_dashboard(results, country_ids)
+        best = max(results, key=lambda c: results[c]["conservative_roi"])
+        timeline = EliteChartBuilder.create_timeline_visualization(results[best], data.countries[best].name)
+        EliteChartBuilder.create_driver_waterfall(results[best], data.countries[best].name).to_json()
+        # Первая сериализация (собственная и через компонент Gradio) и обратная загрузка из хранилища
+        pio.from_json(comparison.to_json())
+        timeline.to_json()
+        plot.postprocess(comparison)
+    return time.perf_counter() - started
+
+
+def warm_up_changes(old: DataSnapshot, new: DataSnapshot) -> Dict[str, set]:
+    """После перезагрузки прогреваются только HTML-блоки изменившихся профилей и стран.
+
+    Кэши HtmlFragments заданы ключами-записями, поэтому неизмененные записи попадают
+    в уже прогретые элементы; графики и сериализация прогреты при старте.
+    """
+    changed = old.diff(new)
+    profiles = [pid for pid in changed["profiles"] if pid in new.profiles]
+    countries = [cid for cid in changed["countries"] if cid in new.countries]
+    for pid in profiles:
+        HtmlFragments.profile_card(new.profiles[pid])
+    for cid in countries:
+        for tier in HtmlFragments.CTA_TIERS:
+            HtmlFragments.cta(new.countries[cid], tier)
+    for pid, profile in new.profiles.items():
+        for cid in (new.countries if pid in profiles else countries):
+            HtmlFragments.recommendation_head(new.countries[cid], profile)
+    EVENTS.emit("data_rewarmed", profiles=sorted(changed["profiles"]), countries=sorted(changed["countries"]))
+    return changed
+
+
+def run_startup_warm_up() -> None:
+    READINESS.started_at = time.time()
+    try:
+        READINESS.warmup_seconds = round(warm_up(), 3)
+    except Exception as e:
+        # Готовность не выставляется: балансировщик не направит трафик на сломанный инстанс
+        READINESS.error = f"{type(e).__name__}: {e}"
+        EVENTS.emit("warm_up_failed", error=READINESS.error, message=f"Warm-up failed: {READINESS.error}")
+        return
+    READINESS.ready.set()
+    EVENTS.emit("warm_up_finished", seconds=READINESS.warmup_seconds,
+                message=f"Warm-up finished in {READINESS.warmup_seconds}s, instance is ready")
+
+
+@asynccontextmanager
+async def warm_up_lifespan(server: FastAPI):
+    threading.Thread(target=run_startup_warm_up, name="warm-up", daemon=True).start()
+    # После горячей перезагрузки прогреваем в фоне только изменившиеся записи, не снимая готовность
+    DATA.subscribe(lambda old, new: threading.Thread(target=warm_up_changes, args=(old, new), daemon=True).start())
+    yield
+
+
+def readiness_probe() -> JSONResponse:
+    status = READINESS.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+# =========================
+# SCORING API (JSON-расчет для CRM с микро-батчингом)
+# =========================
+
+SCORING_MAX_WAIT_MS = float(os.environ.get("VISATIER_SCORING_MAX_WAIT_MS", "5"))
+SCORING_MAX_BATCH = int(os.environ.get("VISATIER_SCORING_MAX_BATCH", "256"))
+SCORING_MAX_YEARS = 30
+SCORE_FIELDS = ("roi", "conservative_roi", "annual_savings", "monthly_improvement", "payback_months",
+                "total_benefit", "setup_cost", "success_probability", "net_opportunity_value", "confidence_score",
+                *DRIVER_FIELDS)
+
+
+def parse_score_request(body, snapshot: DataSnapshot) -> Dict:
+    """Проверка тела POST /api/score: {"profile", "country", "revenue"?, "years"?, "currency"?}"""
+    if not isinstance(body, dict):
+        raise ValueError("Body must be a JSON object.")
+    profile_id, country_id = body.get("profile"), body.get("country")
+    if profile_id not in snapshot.profiles:
+        raise ValueError(f"Unknown profile {profile_id!r}.")
+    if country_id not in snapshot.countries:
+        raise ValueError(f"Unknown country {country_id!r}.")
+    revenue = body.get("revenue")
+    if revenue is not None and (isinstance(revenue, bool) or not isinstance(revenue, (int, float))
+                                or not math.isfinite(revenue) or revenue <= 0):
+        raise ValueError("'revenue' must be a positive finite number.")
+    years = body.get("years", 5)
+    if isinstance(years, bool) or not isinstance(years, int) or not 1 <= years <= SCORING_MAX_YEARS:
+        raise ValueError(f"'years' must be an integer from 1 to {SCORING_MAX_YEARS}.")
+    currency = body.get("currency", BASE_CURRENCY)
+    if currency not in FX.rates:
+        raise ValueError(f"Unknown currency {currency!r}.")
+    # Выручка приходит в валюте запроса, расчет - в EUR
+    revenue = float(FX.to_base(revenue, currency)) if revenue is not None else None
+    return {"profile": profile_id, "country": country_id, "revenue": revenue, "years": years, "currency": currency}
+
+
+def score_batch(items: List[Dict], snapshot: DataSnapshot = None) -> List:
+    """Партия запросов (выручка в EUR) одним вызовом calculate_batch на горизонт расписаний.
+
+    Результат каждого запроса совпадает с calculate_comprehensive_roi; запрос,
+    чей профиль или страна исчезли при горячей перезагрузке, получает ValueError.
+    """
+    data = snapshot or DATA.snapshot()
+    results = [None] * len(items)
+    groups = {}
+    for i, item in enumerate(items):
+        if item["profile"] not in data.profiles or item["country"] not in data.countries:
+            results[i] = ValueError(f"Profile {item['profile']!r} or country {item['country']!r} is no longer available.")
+        else:
+            # Один горизонт на вызов: окупаемость за пределами расписаний считается от его конца
+            groups.setdefault(schedule_horizon(item["years"]), []).append(i)
+    
+    for horizon, rows in groups.items():
+        batch = [items[i] for i in rows]
+        p = data.profile_index([item["profile"] for item in batch])
+        c = data.country_index([item["country"] for item in batch])
+        revenue = np.array([item["revenue"] or 0 for item in batch], dtype=float)
+        clients = {name: values[p] for name, values in data.profile_table.items()}
+        clients["revenue"] = np.where(revenue > 0, revenue, clients["revenue"])
+        year_table = data.year_table(horizon)
+        metrics = WorldClassROICalculator.calculate_batch(
+            clients, {name: values[c] for name, values in data.country_table.items()},
+            np.array([item["years"] for item in batch]),
+            {name: values[c] for name, values in year_table.items()} if year_table else None
+        )
+        columns = {name: np.asarray(metrics[name], dtype=float).tolist() for name in SCORE_FIELDS}
+        for j, (i, item) in enumerate(zip(rows, batch)):
+            result = {name: columns[name][j] for name in SCORE_FIELDS}
+            result["risk_level"] = data.profiles[item["profile"]].risk_level
+            if data.countries[item["country"]].schedules:
+                result["monthly_by_year"] = metrics["monthly_by_year"][j].tolist()
+            results[i] = convert_results({"": result}, item["currency"])[""]
+    return results
+
+
+class MicroBatcher:
+    """Склейка одновременных запросов в партии.
+
+    Первый запрос открывает окно max_wait; партия уходит на расчет по истечении окна
+    или при max_batch запросах. Расчет идет в потоке, пока следующая партия набирается.
+    """
+
+    def __init__(self, evaluate: Callable[[List], List], max_wait_ms: float = SCORING_MAX_WAIT_MS,
+                 max_batch: int = SCORING_MAX_BATCH):
+        self.evaluate = evaluate
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self._loop = None
+        self._queue = None
+        self._worker = None
+        self.counters = {"requests": 0, "batches": 0, "largest_batch": 0}
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._worker.done():
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.counters["requests"] += len(batch)
+            self.counters["batches"] += 1
+            self.counters["largest_batch"] = max(self.counters["largest_batch"], len(batch))
+            started = time.perf_counter()
+            try:
+                results = await asyncio.to_thread(self.evaluate, [item for item, _ in batch])
+                EVENTS.emit("scoring_batch", size=len(batch),
+                            latency_ms=round((time.perf_counter() - started) * 1000, 2))
+            except Exception as e:
+                EVENTS.emit("scoring_batch_failed", size=len(batch), error=f"{type(e).__name__}: {e}",
+                            message=f"Scoring batch failed: {type(e).__name__}: {e}")
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                # Клиент мог отключиться, не дождавшись ответа
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self) -> Dict:
+        requests, batches = self.counters["requests"], self.counters["batches"]
+        return {**self.counters, "mean_batch": round(requests / batches, 2) if batches else 0.0,
+                "queued": self._queue.qsize() if self._queue else 0,
+                "max_wait_ms": self.max_wait * 1000, "max_batch": self.max_batch}
+
+
+SCORER = MicroBatcher(score_batch)
+
+
+async def score_endpoint(request: Request) -> JSONResponse:
+    """POST /api/score: метрики calculate_comprehensive_roi одного клиента и страны"""
+    try:
+        body = await request.json()
+    except ValueError:
+        return JSONResponse({"detail": "Body must be valid JSON."}, status_code=400)
+    try:
+        result = await SCORER.submit(parse_score_request(body, DATA.snapshot()))
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=422)
+    return JSONResponse(result)
+
+# =========================
+# HTTP SERVER (FastAPI + Gradio)
+# =========================
+
+def create_server(app: gr.Blocks = None) -> FastAPI:
+    """FastAPI-приложение: собственные маршруты + смонтированный интерфейс Gradio"""
+    
+    app = app or create_world_class_app()
+    server = FastAPI(lifespan=warm_up_lifespan)
+    server.add_middleware(CompressionMiddleware)
+    server.add_middleware(
+        AdmissionMiddleware, controller=ADMISSION, api_names={"calculate"},
+        fn_indices={index for index, fn in app.fns.items() if fn.api_name == "calculate"}
+    )
+    server.add_api_route(f"{STYLESHEET_ROUTE}/{{filename}}", serve_stylesheet, methods=["GET"])
+    server.add_api_route("/admission", lambda: ADMISSION.stats(), methods=["GET"])
+    server.add_api_route("/sessions", lambda: SESSIONS.stats(), methods=["GET"])
+    server.add_api_route("/api/score", score_endpoint, methods=["POST"])
+    server.add_api_route("/scoring", lambda: SCORER.stats(), methods=["GET"])
+    server.add_api_route("/reports", lambda: REPORTS.stats(), methods=["GET"])
+    server.add_api_route("/events", lambda: EVENTS.stats(), methods=["GET"])
+    server.add_api_route("/healthz", lambda: {"alive": True}, methods=["GET"])
+    server.add_api_route("/readyz", readiness_probe, methods=["GET"])
+    server = gr.mount_gradio_app(
+        server, app, path="/",
+        **({} if PAGE_OPTIONS_IN_BLOCKS else page_options())
+    )
+    SESSIONS.check_gradio_internals()
+    return server
+
+# =========================
+# MULTI-PROCESS SERVING (Несколько процессов за одним портом)
+# =========================
+
+WORKER_COOKIE = "visatier_worker"
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te",
+                      "trailers", "transfer-encoding", "upgrade", "host", "content-length"}
+
+
+def create_worker_proxy(worker_urls: List[str]) -> FastAPI:
+    """Обратный прокси с привязкой сессии к процессу: cookie, а без нее - хэш IP клиента.
+
+    Очередь Gradio открывает несколько HTTP-запросов на одно событие (join + SSE),
+    поэтому все запросы сессии обязаны попадать в один и тот же процесс.
+    """
+    client = httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=1024))
+    
+    @asynccontextmanager
+    async def lifespan(proxy: FastAPI):
+        yield
+        await client.aclose()
+    
+    proxy = FastAPI(lifespan=lifespan)
+    
+    def pick_worker(request: Request) -> int:
+        cookie = request.cookies.get(WORKER_COOKIE, "")
+        if cookie.isdigit() and int(cookie) < len(worker_urls):
+            return int(cookie)
+        peer = request.client.host if request.client else ""
+        return zlib.crc32(peer.encode("utf-8")) % len(worker_urls)
+    
+    async def readiness():
+        statuses = []
+        for url in worker_urls:
+            try:
+                statuses.append((await client.get(f"{url}/readyz", timeout=2)).json())
+            except (httpx.HTTPError, ValueError) as e:
+                statuses.append({"ready": False, "error": str(e)})
+        ready = all(status.get("ready") for status in statuses)
+        return JSONResponse({"ready": ready, "workers": statuses}, status_code=200 if ready else 503)
+    
+    async def forward(request: Request, path: str):
+        index = pick_worker(request)
+        url = worker_urls[index] + request.url.path + (f"?{request.url.query}" if request.url.query else "")
+        headers = [(k, v) for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS
+                   and k.lower() != "x-forwarded-for"]
+        # Перезаписываем X-Forwarded-For реальным адресом: рабочие процессы доверяют только прокси
+        headers += [("x-forwarded-for", request.client.host if request.client else ""),
+                    ("x-forwarded-host", request.headers.get("host", "")),
+                    ("x-forwarded-proto", request.url.scheme)]
+        upstream = await client.send(
+            client.build_request(request.method, url, headers=headers, content=request.stream()),
+            stream=True
+        )
+        response = StreamingResponse(upstream.aiter_raw(), status_code=upstream.status_code,
+                                     background=BackgroundTask(upstream.aclose))
+        response.raw_headers = [(k.encode("latin-1"), v.encode("latin-1"))
+                                for k, v in upstream.headers.multi_items() if k.lower() not in HOP_BY_HOP_HEADERS]
+        if request.cookies.get(WORKER_COOKIE) != str(index):
+            response.set_cookie(WORKER_COOKIE, str(index), httponly=True, samesite="lax")
+        return response
+    
+    proxy.add_api_route("/readyz", readiness, methods=["GET"])
+    proxy.add_api_route("/{path:path}", forward,
+                        methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"])
+    return proxy
+
+
+def serve_multi(workers: int, host: str, port: int) -> None:
+    """N рабочих процессов на внутренних портах + прокси на публичном порту.
+
+    Родитель один раз загружает и отслеживает файл данных и публикует снимки в shared memory;
+    рабочие процессы подключаются к ним без копирования.
+    """
+    publisher = SharedDataPublisher()
+    publisher.publish(DATA.snapshot())
+    DATA.subscribe(lambda old, new: publisher.publish(new))
+    DATA.start_watching()
+    
+    base_port = int(os.environ.get("VISATIER_WORKER_BASE_PORT", port + 1))
+    env = dict(os.environ, VISATIER_SHARED_DATA=publisher.control_name, VISATIER_TRUST_PROXY="1")
+    # Журнал событий - свой файл у каждого процесса: ротация без межпроцессных блокировок
+    stem, ext = os.path.splitext(EVENT_LOG_PATH)
+    processes = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker-port", str(base_port + i)],
+                         env={**env, "VISATIER_EVENT_LOG": f"{stem}.worker{i}{ext}" if EVENT_LOG_PATH else ""})
+        for i in range(workers)
+    ]
+    # uvicorn после остановки повторно посылает пойманный сигнал; превращаем его в SystemExit,
+    # чтобы рабочие процессы и сегменты shared memory были освобождены
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        uvicorn.run(create_worker_proxy([f"http://127.0.0.1:{base_port + i}" for i in range(workers)]),
+                    host=host, port=port)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+        publisher.close()
+
 # =========================
 # LAUNCH APPLICATION
 # =========================
 
 if __name__ == "__main__":
-    app = create_world_class_app()
-    app.launch(
-        server_name="0.0.0.0",
-        server_port=7860,
-        share=False,
-        show_error=True
-    )
+    parser = argparse.ArgumentParser(description="VisaTier Immigration ROI Calculator")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("VISATIER_WORKERS", "1")),
+                        help="number of worker processes behind one port")
+    parser.add_argument("--worker-port", type=int, help=argparse.SUPPRESS)
+    batch = parser.add_argument_group("batch run (instead of serving the UI)")
+    batch.add_argument("--batch", metavar="CSV", help="portfolio CSV (profile, optional revenue/currency/client_id)")
+    batch.add_argument("--batch-out", default=os.path.join("data", "batch"), help="directory for the result columns")
+    batch.add_argument("--countries", help="comma-separated country ids (default: all)")
+    batch.add_argument("--horizons", default="5", help="comma-separated horizons in years")
+    batch.add_argument("--simulations", type=int, default=1, help="Monte-Carlo revenue-growth draws per scenario")
+    batch.add_argument("--seed", type=int, default=0)
+    batch.add_argument("--by", default="country", choices=list(BATCH_KEY_COLUMNS), help="summary grouping")
+    batch.add_argument("--metric", default="conservative_roi", choices=list(BATCH_METRIC_COLUMNS))
+    args = parser.parse_args()
+    port = int(os.environ.get("VISATIER_PORT", "7860"))
+
+    if args.batch:
+        run_batch_cli(args)
+    elif args.worker_port:
+        # Рабочий процесс многопроцессного режима: доступен только прокси
+        uvicorn.run(create_server(), host="127.0.0.1", port=args.worker_port, log_level="warning")
+    elif args.workers > 1:
+        serve_multi(args.workers, "0.0.0.0", port)
+    else:
+        uvicorn.run(
+            create_server(),
+            host="0.0.0.0",
+            port=port
+        )
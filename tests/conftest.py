@@ -0,0 +1,33 @@
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Журнал событий, сценарии и кэш отчетов тестов - во временном каталоге, а не в data/
+SCRATCH = tempfile.mkdtemp(prefix="visatier-tests-")
+os.environ.setdefault("VISATIER_EVENT_LOG", os.path.join(SCRATCH, "events.jsonl"))
+os.environ.setdefault("VISATIER_SCENARIO_DB", os.path.join(SCRATCH, "scenarios.sqlite3"))
+os.environ.setdefault("VISATIER_REPORT_CACHE", os.path.join(SCRATCH, "reports"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def snapshot():
+    return app.DATA.snapshot()
+
+
+@pytest.fixture(scope="session")
+def scheduled_snapshot(tmp_path_factory):
+    """Данные репозитория плюс расписания и расходы в местной валюте"""
+    with open(app.DATA_PATH, encoding="utf-8") as fh:
+        raw = json.load(fh)
+    raw["countries"]["UAE"]["schedules"] = {"corp_tax": {"3": 0.15}, "living_cost": {"2": 9500, "7": 11000}}
+    raw["countries"]["Portugal"]["schedules"] = {"pers_tax": {"1": 0.20, "4": 0.48}, "setup_cost": {"2": 30000}}
+    raw["countries"]["Singapore"]["cost_currency"] = "SGD"
+    path = tmp_path_factory.mktemp("data") / "visatier_data.json"
+    path.write_text(json.dumps(raw), encoding="utf-8")
+    return app.load_data_file(str(path))
@@ -0,0 +1,80 @@
+import pandas as pd
+import pytest
+
+import app
+
+negotiate = app.CompressionMiddleware.negotiate
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("", None),
+    ("identity", None),
+    ("gzip, deflate", "gzip"),
+    ("GZIP", "gzip"),
+    ("br;q=1.0, gzip", "br" if app.brotli is not None else "gzip"),
+    ("gzip;q=0", None),
+    ("gzip; q=0", None),
+    ("gzip;q=0.000", None),
+    ("br;q=0.0, gzip", "gzip"),
+    ("br ; Q=0.5", "br" if app.brotli is not None else None),
+    ("gzip;q=abc", None),
+])
+def test_negotiate(header, expected):
+    assert negotiate(header) == expected
+
+
+def test_score_request_defaults(snapshot):
+    item = app.parse_score_request({"profile": "startup", "country": "UAE"}, snapshot)
+    assert item == {"profile": "startup", "country": "UAE", "revenue": None, "years": 5,
+                    "currency": app.BASE_CURRENCY}
+
+
+def test_score_request_converts_revenue(snapshot):
+    item = app.parse_score_request({"profile": "startup", "country": "UAE", "revenue": 11_720,
+                                    "currency": "USD"}, snapshot)
+    assert item["revenue"] == pytest.approx(11_720 / app.FX.rate("USD"))
+
+
+@pytest.mark.parametrize("body, error", [
+    ([], "JSON object"),
+    ({"profile": "nope", "country": "UAE"}, "Unknown profile"),
+    ({"profile": "startup", "country": "Mars"}, "Unknown country"),
+    ({"profile": "startup", "country": "UAE", "revenue": 0}, "revenue"),
+    ({"profile": "startup", "country": "UAE", "revenue": -5}, "revenue"),
+    ({"profile": "startup", "country": "UAE", "revenue": float("nan")}, "revenue"),
+    ({"profile": "startup", "country": "UAE", "revenue": "100"}, "revenue"),
+    ({"profile": "startup", "country": "UAE", "revenue": True}, "revenue"),
+    ({"profile": "startup", "country": "UAE", "years": 0}, "years"),
+    ({"profile": "startup", "country": "UAE", "years": app.SCORING_MAX_YEARS + 1}, "years"),
+    ({"profile": "startup", "country": "UAE", "years": 2.5}, "years"),
+    ({"profile": "startup", "country": "UAE", "currency": "XYZ"}, "currency"),
+])
+def test_score_request_rejected(snapshot, body, error):
+    with pytest.raises(ValueError, match=error):
+        app.parse_score_request(body, snapshot)
+
+
+def test_portfolio_blank_revenue_uses_profile_default(snapshot):
+    portfolio = pd.DataFrame({"client_id": ["a", "b"], "profile": ["crypto", "crypto"], "revenue": [None, 12_000]})
+    columns = app.portfolio_columns(snapshot, portfolio)
+    assert columns["revenue"].tolist() == [snapshot.profiles["crypto"].revenue, 12_000]
+
+
+def test_portfolio_revenue_converted_per_client(snapshot):
+    portfolio = pd.DataFrame({"profile": ["startup", "startup"], "revenue": [10_000, 10_000],
+                              "currency": ["usd", None]})
+    columns = app.portfolio_columns(snapshot, portfolio)
+    assert columns["revenue"].tolist() == pytest.approx([10_000 / app.FX.rate("USD"), 10_000])
+
+
+@pytest.mark.parametrize("revenue", ["abc", 0, -5])
+def test_portfolio_invalid_revenue_reported(snapshot, revenue):
+    portfolio = pd.DataFrame({"client_id": ["ok", "bad"], "profile": ["crypto", "crypto"],
+                              "revenue": [50_000, revenue]})
+    with pytest.raises(ValueError, match="bad"):
+        app.portfolio_columns(snapshot, portfolio)
+
+
+def test_portfolio_unknown_profile_reported(snapshot):
+    with pytest.raises(ValueError, match="ghost"):
+        app.portfolio_columns(snapshot, pd.DataFrame({"profile": ["startup", "ghost"]}))
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+import app
+
+Calculator = app.WorldClassROICalculator
+
+
+@pytest.fixture(params=["plain", "scheduled"])
+def data(request, snapshot, scheduled_snapshot):
+    return snapshot if request.param == "plain" else scheduled_snapshot
+
+
+def grid(data, years, revenue=None):
+    """Все профили x все страны одним вызовом calculate_batch"""
+    clients = {name: values[:, None] for name, values in data.profile_table.items()}
+    if revenue:
+        clients["revenue"] = np.full_like(clients["revenue"], revenue)
+    countries = {name: values[None, :] for name, values in data.country_table.items()}
+    year_table = data.year_table(app.schedule_horizon(years))
+    schedules = {name: values[None, :, :] for name, values in year_table.items()} if year_table else None
+    return Calculator.calculate_batch(clients, countries, years, schedules)
+
+
+@pytest.mark.parametrize("years", [1, 5, 12])
+@pytest.mark.parametrize("revenue", [None, 12_345.0])
+def test_batch_matches_scalar(data, years, revenue):
+    metrics = grid(data, years, revenue)
+    for i, (profile_id, profile) in enumerate(data.profiles.items()):
+        for j, (country_id, country) in enumerate(data.countries.items()):
+            scalar = Calculator.calculate_comprehensive_roi(profile, country, revenue, years)
+            for name, value in scalar.items():
+                if name == "risk_level":
+                    continue
+                expected = metrics[name][i, j]
+                np.testing.assert_allclose(value, expected, rtol=1e-12, err_msg=f"{profile_id}/{country_id}/{name}")
+
+
+def test_schedules_change_only_scheduled_countries(snapshot, scheduled_snapshot):
+    plain, scheduled = grid(snapshot, 5), grid(scheduled_snapshot, 5)
+    assert "monthly_by_year" in scheduled
+    same = [j for j, c in enumerate(scheduled_snapshot.countries.values())
+            if not c.schedules and c.cost_currency == app.BASE_CURRENCY]
+    assert same
+    np.testing.assert_allclose(scheduled["roi"][:, same], plain["roi"][:, same], rtol=1e-12)
+
+
+def test_score_batch_matches_scalar(snapshot):
+    items = [{"profile": p, "country": c, "revenue": revenue, "years": years, "currency": app.BASE_CURRENCY}
+             for p in snapshot.profiles for c in snapshot.countries
+             for revenue, years in ((None, 5), (40_000.0, 3), (9_000.0, 15))]
+    for item, result in zip(items, app.score_batch(items, snapshot)):
+        expected = Calculator.calculate_comprehensive_roi(
+            snapshot.profiles[item["profile"]], snapshot.countries[item["country"]], item["revenue"], item["years"]
+        )
+        for name in app.SCORE_FIELDS:
+            assert result[name] == pytest.approx(expected[name], rel=1e-12)
+
+
+def test_structure_diagonal_matches_single_country(data):
+    country_ids = list(data.countries)
+    countries, schedules = app.structure_columns(data, country_ids)
+    profile = data.profiles["consulting"]
+    metrics = Calculator.calculate_batch(app.client_columns(profile), countries, 5, schedules)
+    for j, country in enumerate(data.countries.values()):
+        expected = Calculator.calculate_comprehensive_roi(profile, country)
+        assert metrics["roi"][j, j] == pytest.approx(expected["roi"], rel=1e-12)
+        assert metrics["annual_savings"][j, j] == pytest.approx(expected["annual_savings"], rel=1e-12)
+
+
+def test_split_structure_pays_both_living_costs(snapshot):
+    countries, _ = app.structure_columns(snapshot, ["UAE", "Estonia"])
+    living = snapshot.country_table["living_cost"][snapshot.country_index(["UAE", "Estonia"])]
+    assert countries["living_cost"][0, 1] == living.sum()
+    assert countries["living_cost"][1, 1] == living[1]
+
+
+@pytest.mark.parametrize("years", [1, 4, 10])
+def test_path_never_loses_to_a_single_decision(data, years):
+    for profile in data.profiles.values():
+        plan = app.RelocationPathOptimizer.optimize(profile, data, list(data.countries), years, revenue_growth=0.2)
+        assert plan["gain_vs_single_move"] >= -1e-6
+        assert plan["cumulative"][-1] == pytest.approx(plan["total_benefit"])
+
+
+def test_path_reports_stay_without_gain(snapshot):
+    plan = app.RelocationPathOptimizer.optimize(snapshot.profiles["consulting"], snapshot, ["UAE"], 1,
+                                                custom_revenue=3000)
+    assert plan["stay"] and plan["path"] == [app.HOME_STATE]
+    assert plan["best_single_country"] == app.HOME_STATE
+    assert plan["gain_vs_single_move"] == 0.0
@@ -0,0 +1,71 @@
+import json
+
+import numpy as np
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("code", list(app.FX.rates))
+def test_round_trip(code):
+    amounts = np.array([1.0, 999.99, 1_234_567.0])
+    np.testing.assert_allclose(app.FX.to_base(amounts * app.FX.rate(code), code), amounts, rtol=1e-12)
+
+
+def test_column_conversion_matches_scalar():
+    codes = np.array(list(app.FX.rates) * 3)
+    amounts = np.arange(1, len(codes) + 1) * 1000.0
+    expected = [app.FX.to_base(amount, code) for amount, code in zip(amounts, codes)]
+    np.testing.assert_allclose(app.FX.to_base(amounts, codes), expected, rtol=1e-12)
+
+
+def test_unknown_currency_rejected():
+    with pytest.raises(ValueError, match="XYZ"):
+        app.FX.rate("XYZ")
+    with pytest.raises(ValueError, match="XYZ"):
+        app.FX.rates_for(["EUR", "XYZ"])
+
+
+def test_convert_results_scales_money_fields_only(snapshot):
+    profile = snapshot.profiles["startup"]
+    results = {cid: app.WorldClassROICalculator.calculate_comprehensive_roi(profile, country)
+               for cid, country in snapshot.countries.items()}
+    assert app.convert_results(results, app.BASE_CURRENCY) is results
+    rate = app.FX.rate("USD")
+    converted = app.convert_results(results, "USD")
+    for cid, result in results.items():
+        for name, value in result.items():
+            if name in app.MONEY_FIELDS:
+                assert converted[cid][name] == pytest.approx(value * rate, rel=1e-12)
+            else:
+                assert converted[cid][name] == value
+
+
+def test_convert_results_scales_yearly_values(scheduled_snapshot):
+    result = app.WorldClassROICalculator.calculate_comprehensive_roi(
+        scheduled_snapshot.profiles["crypto"], scheduled_snapshot.countries["UAE"], years=7
+    )
+    converted = app.convert_results({"UAE": result}, "GBP")["UAE"]
+    np.testing.assert_allclose(converted["monthly_by_year"],
+                               np.array(result["monthly_by_year"]) * app.FX.rate("GBP"), rtol=1e-12)
+
+
+def test_local_costs_converted_to_base(scheduled_snapshot):
+    singapore = scheduled_snapshot.countries["Singapore"]
+    columns = app.country_columns(singapore)
+    assert columns["living_cost"] == pytest.approx(singapore.living_cost / app.FX.rate("SGD"))
+    assert columns["setup_cost"] == pytest.approx(singapore.setup_cost / app.FX.rate("SGD"))
+    assert columns["corp_tax"] == singapore.corp_tax
+
+
+@pytest.mark.parametrize("raw, error", [
+    ({"base": "USD", "rates": {"USD": 1}}, "quoted against"),
+    ({"base": "EUR", "rates": {"EUR": 1, "USD": 0}}, "positive number"),
+    ({"base": "EUR", "rates": {"EUR": 1, "USD": True}}, "positive number"),
+    ({"base": "EUR", "rates": {"EUR": 1.2}}, "EUR rate must be 1"),
+])
+def test_invalid_rate_file_rejected(tmp_path, raw, error):
+    path = tmp_path / "fx.json"
+    path.write_text(json.dumps(raw), encoding="utf-8")
+    with pytest.raises(ValueError, match=error):
+        app.load_fx_rates(str(path))
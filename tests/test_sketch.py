@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+QUANTILES = np.array([0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99])
+
+
+@pytest.fixture
+def values():
+    rng = np.random.default_rng(7)
+    mixed = np.concatenate([rng.lognormal(8, 2, 40_000), -rng.lognormal(5, 1, 10_000)])
+    return rng.permutation(mixed[np.abs(mixed) >= app.SKETCH_MIN_VALUE])
+
+
+def test_merged_chunks_equal_single_pass(values):
+    keys = np.arange(len(values)) % 3
+    single = app.MetricSketch(3).update(values, keys)
+    merged = app.MetricSketch(3)
+    for part in np.array_split(np.arange(len(values)), 7):
+        merged.merge(app.MetricSketch(3).update(values[part], keys[part]))
+    np.testing.assert_array_equal(merged.counts, single.counts)
+    np.testing.assert_array_equal(merged.finite, single.finite)
+    np.testing.assert_allclose(merged.mean, single.mean, rtol=1e-12)
+    np.testing.assert_allclose(merged.m2, single.m2, rtol=1e-9)
+    np.testing.assert_array_equal(merged.quantile(QUANTILES), single.quantile(QUANTILES))
+
+
+def test_quantiles_within_relative_accuracy(values):
+    sketch = app.MetricSketch().update(values)
+    estimates = sketch.quantile(QUANTILES)[0]
+    lower = np.quantile(values, QUANTILES, method="lower")
+    higher = np.quantile(values, QUANTILES, method="higher")
+    accuracy = app.SKETCH_RELATIVE_ACCURACY
+    bounds = np.stack([lower * (1 - accuracy), lower * (1 + accuracy),
+                       higher * (1 - accuracy), higher * (1 + accuracy)])
+    assert (estimates >= bounds.min(axis=0)).all() and (estimates <= bounds.max(axis=0)).all()
+
+
+def test_summary_moments_match_pandas(values):
+    keys = (values > 1000).astype(int)
+    summary = app.MetricSketch(2).update(values, keys).summary(["low", "high"], "band", percentiles=[])
+    exact = pd.Series(values).groupby(keys).agg(["count", "mean", "std", "min", "max"])
+    np.testing.assert_array_equal(summary["count"].to_numpy(), exact["count"].to_numpy())
+    np.testing.assert_allclose(summary["mean"].to_numpy(), exact["mean"].to_numpy(), rtol=1e-9)
+    # Сводка дает стандартное отклонение генеральной совокупности (ddof=0)
+    np.testing.assert_allclose(summary["std"].to_numpy(),
+                               pd.Series(values).groupby(keys).std(ddof=0).to_numpy(), rtol=1e-9)
+    np.testing.assert_array_equal(summary["min"].to_numpy(), exact["min"].to_numpy())
+    np.testing.assert_array_equal(summary["max"].to_numpy(), exact["max"].to_numpy())
+
+
+def test_nan_skipped_and_infinities_counted():
+    sketch = app.MetricSketch().update(np.array([1.0, np.nan, np.inf, 3.0]))
+    assert sketch.counts.sum() == 3
+    assert sketch.finite[0] == 2 and sketch.mean[0] == pytest.approx(2.0)
+    assert sketch.quantile([1.0])[0, 0] == np.inf
+
+
+def test_empty_group_is_nan():
+    sketch = app.MetricSketch(2).update(np.array([5.0]), np.array([0]))
+    assert np.isnan(sketch.quantile([0.5])[1, 0])
+
+
+def test_merge_rejects_other_layout():
+    with pytest.raises(ValueError):
+        app.MetricSketch(2).merge(app.MetricSketch(3))
+    with pytest.raises(ValueError):
+        app.MetricSketch(relative_accuracy=0.02).merge(app.MetricSketch())
+
+
+def test_sketch_batch_matches_run_batch(snapshot, tmp_path):
+    portfolio = pd.DataFrame({"client_id": [f"c{i}" for i in range(40)],
+                              "profile": np.resize(list(snapshot.profiles), 40),
+                              "revenue": np.linspace(5_000, 150_000, 40)})
+    countries = list(snapshot.countries)
+    summary = app.sketch_batch(portfolio, countries, [3, 5], by="country", metrics=["roi"],
+                               simulations=4, chunk_rows=97, snapshot=snapshot)["roi"]
+    results = app.run_batch(portfolio, countries, [3, 5], str(tmp_path), simulations=4, chunk_rows=97,
+                            snapshot=snapshot)
+    exact = pd.Series(np.asarray(results.column("roi"))).groupby(np.asarray(results.column("country"))).agg(
+        ["count", "mean"])
+    np.testing.assert_array_equal(summary["count"].to_numpy(), exact["count"].to_numpy())
+    np.testing.assert_allclose(summary["mean"].to_numpy(), exact["mean"].to_numpy(), rtol=1e-9)
+    stored = results.aggregate("country", "roi", chunk_rows=1000, percentiles=app.SKETCH_PERCENTILES)
+    np.testing.assert_array_equal(summary.filter(like="p").to_numpy(), stored.filter(like="p").to_numpy())
@@ -0,0 +1,199 @@
+# VisaTier - нагрузочное тестирование через HTTP API Gradio
+# Запускает приложение локально и имитирует N одновременных пользователей
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILES = ["startup", "crypto", "consulting", "ecommerce"]
+COUNTRIES = ["UAE", "Singapore", "Estonia", "Portugal"]
+CURRENCIES = ["EUR", "USD", "GBP", "AED"]
+
+
+class Recorder:
+    """Потокобезопасный сбор задержек и ошибок по типам запросов"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def record(self, name: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / 2 ** 20
+    except Exception:
+        return float("nan")
+
+
+def tree_rss_mb(pid: int) -> float:
+    """RSS процесса вместе с дочерними (рабочие процессы многопроцессного режима)"""
+    total = rss_mb(pid)
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as fh:
+            children = [int(c) for c in fh.read().split()]
+    except OSError:
+        children = []
+    return total + sum(tree_rss_mb(child) for child in children)
+
+
+def call(client: httpx.Client, base: str, api_name: str, data: List) -> bool:
+    """Один вызов события через /call/<api_name>: POST постановки + чтение SSE до результата"""
+    response = client.post(f"{base}/call/{api_name}", json={"data": data})
+    if response.status_code != 200:
+        return False
+    event_id = response.json()["event_id"]
+    ok = False
+    with client.stream("GET", f"{base}/call/{api_name}/{event_id}") as stream:
+        for line in stream.iter_lines():
+            if line.startswith("event:"):
+                ok = line.strip() == "event: complete"
+    return ok
+
+
+def simulate_user(base: str, recorder: Recorder, stop: threading.Event, think_time: float, seed: int):
+    """Реалистичная сессия: смена профиля, правка выручки, несколько расчетов"""
+    rng = random.Random(seed)
+    with httpx.Client(timeout=60) as client:
+        while not stop.is_set():
+            profile = rng.choice(PROFILES)
+            currency = rng.choice(CURRENCIES)
+            steps = [("update_profile_info", [profile, currency])]
+            for _ in range(rng.randint(1, 4)):
+                revenue = rng.choice([None, round(rng.uniform(5_000, 250_000), -3)])
+                countries = rng.sample(COUNTRIES, rng.randint(1, len(COUNTRIES)))
+                steps.append(("calculate", [profile, revenue, countries, currency]))
+            for api_name, data in steps:
+                if stop.is_set():
+                    return
+                started = time.perf_counter()
+                try:
+                    ok = call(client, base, api_name, data)
+                except httpx.HTTPError:
+                    ok = False
+                recorder.record(api_name, time.perf_counter() - started, ok)
+                stop.wait(rng.expovariate(1 / think_time) if think_time > 0 else 0)
+
+
+def start_server(port: int, keep_limits: bool, workers: int) -> subprocess.Popen:
+    # Хранилище сценариев и журнал событий - во временном каталоге, а не в data/ репозитория
+    scratch = tempfile.mkdtemp(prefix="visatier-load-")
+    env = dict(os.environ, VISATIER_PORT=str(port),
+               VISATIER_SCENARIO_DB=os.path.join(scratch, "scenarios.sqlite3"),
+               VISATIER_EVENT_LOG=os.path.join(scratch, "events.jsonl"))
+    if not keep_limits:
+        # Все виртуальные пользователи приходят с 127.0.0.1 - снимаем лимит частоты
+        env.setdefault("VISATIER_RATE_PER_MINUTE", "1000000")
+        env.setdefault("VISATIER_RATE_BURST", "1000000")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "app.py"), "--workers", str(workers)],
+                            cwd=ROOT, env=env)
+
+
+def wait_until_up(base: str, timeout: float = 120) -> Dict:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            response = httpx.get(f"{base}/config", timeout=5)
+            if response.status_code == 200:
+                return response.json()
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server at {base} did not start within {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive a local VisaTier app with simulated users")
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=60, help="test duration, seconds")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean pause between actions, seconds")
+    parser.add_argument("--port", type=int, default=7870)
+    parser.add_argument("--url", help="target an already running server instead of launching one")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the launched server")
+    parser.add_argument("--keep-limits", action="store_true", help="keep the per-client rate limit")
+    parser.add_argument("--sample-every", type=float, default=5.0, help="RSS sampling interval, seconds")
+    parser.add_argument("--json", help="write the report to this file for release-to-release comparison")
+    args = parser.parse_args()
+
+    server = None if args.url else start_server(args.port, args.keep_limits, args.workers)
+    root_url = (args.url or f"http://127.0.0.1:{args.port}").rstrip("/")
+    try:
+        config = wait_until_up(root_url)
+        base = root_url + config.get("api_prefix", "")
+        recorder = Recorder()
+        stop = threading.Event()
+        users = [threading.Thread(target=simulate_user, args=(base, recorder, stop, args.think_time, seed), daemon=True)
+                 for seed in range(args.users)]
+        
+        rss_samples = []
+        started = time.time()
+        for user in users:
+            user.start()
+        while time.time() - started < args.duration:
+            if server is not None:
+                rss_samples.append((round(time.time() - started, 1), round(tree_rss_mb(server.pid), 1)))
+                print(f"t={rss_samples[-1][0]:>6}s  rss={rss_samples[-1][1]:>7} MB  "
+                      f"requests={sum(len(v) for v in recorder.latencies.values())}", flush=True)
+            time.sleep(args.sample_every)
+        stop.set()
+        for user in users:
+            user.join(timeout=60)
+        elapsed = time.time() - started
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+
+    report = {"users": args.users, "duration_s": round(elapsed, 1), "endpoints": {}, "rss_mb": rss_samples}
+    print(f"\n{'endpoint':<22}{'requests':>10}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>9}")
+    for name, values in sorted(recorder.latencies.items()):
+        errors = recorder.errors.get(name, 0)
+        row = {
+            "requests": len(values),
+            "throughput_rps": len(values) / elapsed,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "error_rate": errors / len(values),
+        }
+        report["endpoints"][name] = row
+        print(f"{name:<22}{row['requests']:>10}{row['throughput_rps']:>9.1f}{row['p50_ms']:>10.0f}"
+              f"{row['p95_ms']:>10.0f}{row['p99_ms']:>10.0f}{row['error_rate']:>8.1%}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# VisaTier - soak-тест памяти сессий
+# Тысячи браузерных сессий (загрузка страницы + расчеты), вкладки не закрываются;
+# проверяем, что после прогрева RSS сервера не растет благодаря вытеснению неактивных сессий
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from typing import Dict, List
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from loadtest import COUNTRIES, CURRENCIES, PROFILES, rss_mb, start_server, wait_until_up  # noqa: E402
+
+
+def fn_indices(config: Dict) -> Dict[str, int]:
+    """api_name -> fn_index из /config"""
+    return {dep["api_name"]: dep.get("id", index)
+            for index, dep in enumerate(config["dependencies"]) if dep.get("api_name")}
+
+
+def run_event(client: httpx.Client, base: str, session_hash: str, fn_index: int, data: List) -> bool:
+    """Событие как из браузера: queue/join с session_hash и чтение SSE до завершения"""
+    response = client.post(f"{base}/queue/join", json={
+        "data": data, "fn_index": fn_index, "session_hash": session_hash,
+        "event_data": None, "trigger_id": None
+    })
+    if response.status_code != 200:
+        return False
+    with client.stream("GET", f"{base}/queue/data", params={"session_hash": session_hash}) as stream:
+        for line in stream.iter_lines():
+            if line.startswith("data:"):
+                message = json.loads(line[5:])
+                if message.get("msg") == "process_completed":
+                    return bool(message.get("success"))
+    return False
+
+
+def simulate_sessions(base: str, indices: Dict[str, int], queue: List[int], lock: threading.Lock,
+                      counters: Dict[str, int], seed: int):
+    rng = random.Random(seed)
+    with httpx.Client(timeout=60) as client:
+        while True:
+            with lock:
+                if not queue:
+                    return
+                queue.pop()
+            session_hash = uuid.uuid4().hex[:11]
+            profile = rng.choice(PROFILES)
+            countries = rng.sample(COUNTRIES, rng.randint(1, len(COUNTRIES)))
+            currency = rng.choice(CURRENCIES)
+            ok = run_event(client, base, session_hash, indices["initialize_session"], [profile, countries, currency])
+            for _ in range(rng.randint(1, 2)):
+                revenue = rng.choice([None, round(rng.uniform(5_000, 250_000), -3)])
+                ok = run_event(client, base, session_hash, indices["calculate"], [profile, revenue, countries, currency]) and ok
+            with lock:
+                counters["sessions"] += 1
+                counters["failed"] += not ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that server RSS stays flat over many abandoned sessions")
+    parser.add_argument("--sessions", type=int, default=2000, help="simulated browser sessions")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--idle-seconds", type=float, default=10,
+                        help="VISATIER_SESSION_IDLE_SECONDS for the launched server")
+    parser.add_argument("--port", type=int, default=7871)
+    parser.add_argument("--sample-every", type=int, default=200, help="RSS sample every N sessions")
+    parser.add_argument("--warm-up", type=float, default=0.25, help="share of sessions before the RSS baseline")
+    parser.add_argument("--max-growth-mb", type=float, default=20, help="allowed RSS growth after warm-up")
+    parser.add_argument("--json", help="write the RSS samples to this file")
+    args = parser.parse_args()
+
+    os.environ["VISATIER_SESSION_IDLE_SECONDS"] = str(args.idle_seconds)
+    server = start_server(args.port, keep_limits=False, workers=1)
+    root_url = f"http://127.0.0.1:{args.port}"
+    samples = []
+    try:
+        config = wait_until_up(root_url)
+        base = root_url + config.get("api_prefix", "")
+        indices = fn_indices(config)
+        queue = list(range(args.sessions))
+        lock = threading.Lock()
+        counters = {"sessions": 0, "failed": 0}
+        workers = [threading.Thread(target=simulate_sessions, args=(base, indices, queue, lock, counters, seed),
+                                    daemon=True) for seed in range(args.concurrency)]
+        started = time.time()
+        for worker in workers:
+            worker.start()
+        next_sample = 0
+        while any(worker.is_alive() for worker in workers) or next_sample <= counters["sessions"]:
+            if counters["sessions"] >= next_sample:
+                sessions = httpx.get(f"{root_url}/sessions", timeout=10).json()
+                samples.append({"sessions_done": counters["sessions"], "t_s": round(time.time() - started, 1),
+                                "rss_mb": round(rss_mb(server.pid), 1), "live_sessions": sessions["sessions"],
+                                "gradio_sessions": sessions["gradio_sessions"],
+                                "evicted": sessions["evicted_idle"] + sessions["evicted_capacity"]})
+                print(f"sessions={samples[-1]['sessions_done']:>6}  t={samples[-1]['t_s']:>6}s  "
+                      f"rss={samples[-1]['rss_mb']:>7} MB  live={samples[-1]['live_sessions']:>5}  "
+                      f"gradio={samples[-1]['gradio_sessions']:>5}  evicted={samples[-1]['evicted']:>6}", flush=True)
+                next_sample += args.sample_every
+                if not any(worker.is_alive() for worker in workers):
+                    break
+            time.sleep(0.5)
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    baseline = next(s for s in samples if s["sessions_done"] >= args.sessions * args.warm_up)
+    peak = max(s["rss_mb"] for s in samples if s["sessions_done"] >= baseline["sessions_done"])
+    growth = peak - baseline["rss_mb"]
+    print(f"\n{counters['sessions']} sessions ({counters['failed']} failed), "
+          f"RSS after warm-up {baseline['rss_mb']} MB, peak {peak} MB, growth {growth:+.1f} MB")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fh:
+            json.dump({"sessions": args.sessions, "idle_seconds": args.idle_seconds, "samples": samples}, fh, indent=2)
+    if growth > args.max_growth_mb or counters["failed"]:
+        print(f"FAIL: RSS grew more than {args.max_growth_mb} MB or sessions failed")
+        sys.exit(1)
+    print("OK: RSS is flat")
+
+
+if __name__ == "__main__":
+    main()